@@ -0,0 +1,116 @@
+"""
+Tiempo de arranque en frío: lanza `uvicorn main:app` varias veces y mide desde el spawn hasta la primera
+respuesta (uvicorn no acepta conexiones hasta terminar el lifespan). Con --comparar-con se repite la medida
+sobre otro commit (git worktree) para ver la diferencia, p. ej. con el arranque que creaba el esquema al importar.
+
+Sin DATABASE_URL usa una SQLite temporal ya inicializada con `python migraciones.py`:
+    python benchmarks/arranque.py --repeticiones 5 --comparar-con HEAD~1
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def entorno() -> dict:
+    variables = dict(os.environ)
+    if "DATABASE_URL" not in variables:
+        ruta = os.path.join(tempfile.mkdtemp(), "arranque.sqlite")
+        variables["DATABASE_URL"] = f"sqlite:///{ruta}"
+        variables["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{ruta}"
+    variables.setdefault("SECRET_KEY", "benchmark")
+    variables.setdefault("ALGORITHM", "HS256")
+    variables.setdefault("LOG_LEVEL", "WARNING")
+    variables.pop("UDP_PUERTO", None)
+    return variables
+
+
+def arrancar(directorio: str, variables: dict, limite_s: float = 120) -> float:
+    """ Segundos hasta que /docs responde 200 """
+    puerto = puerto_libre()
+    inicio = time.perf_counter()
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(puerto)],
+        cwd=directorio, env=variables, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - inicio < limite_s:
+            if proceso.poll() is not None:
+                raise RuntimeError(f"uvicorn terminó con código {proceso.returncode}")
+            try:
+                if httpx.get(f"http://127.0.0.1:{puerto}/docs", timeout=1).status_code == 200:
+                    return time.perf_counter() - inicio
+            except httpx.TransportError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("uvicorn no respondió a tiempo")
+    finally:
+        proceso.terminate()
+        proceso.wait()
+
+
+def medir(directorio: str, repeticiones: int) -> dict:
+    variables = entorno()
+    # El árbol actual necesita el esquema creado de antemano. Las versiones que lo creaban al importar
+    # tenían migraciones solo para Postgres: ahí un fallo con SQLite no importa
+    subprocess.run([sys.executable, "migraciones.py"], cwd=directorio, env=variables, check=directorio == RAIZ,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    tiempos = sorted(arrancar(directorio, variables) for _ in range(repeticiones))
+    resultado = {
+        "repeticiones": repeticiones,
+        "mediana_s": statistics.median(tiempos),
+        "min_s": tiempos[0],
+        "max_s": tiempos[-1],
+    }
+    if directorio == RAIZ:
+        # Lo que antes pagaba cada arranque (y cada worker) al importar database.py
+        salida = subprocess.run(
+            [sys.executable, "-c", "import time, database; t = time.perf_counter(); database.inicializar_bbdd(); "
+                                   "print(time.perf_counter() - t)"],
+            cwd=directorio, env=variables, check=True, capture_output=True, text=True,
+        ).stdout
+        resultado["esquema_y_semilla_s"] = float(salida.split()[-1])
+    return resultado
+
+
+def medir_commit(ref: str, repeticiones: int) -> dict:
+    directorio = tempfile.mkdtemp()
+    shutil.rmtree(directorio)
+    subprocess.run(["git", "worktree", "add", "--detach", directorio, ref], cwd=RAIZ, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return medir(directorio, repeticiones)
+    finally:
+        subprocess.run(["git", "worktree", "remove", "--force", directorio], cwd=RAIZ, check=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--comparar-con", help="Commit o rama con el que comparar")
+    args = parser.parse_args()
+
+    resultado = {"actual": medir(RAIZ, args.repeticiones)}
+    if args.comparar_con:
+        resultado[args.comparar_con] = medir_commit(args.comparar_con, args.repeticiones)
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == "__main__":
+    main()
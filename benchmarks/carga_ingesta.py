@@ -0,0 +1,212 @@
+"""
+Prueba de carga de la ingesta (POST /registros) contra un servidor en marcha.
+
+Todas las peticiones repiten el mismo fix de una MAC: para medir la escritura y no el filtro de ingesta,
+el servidor se arranca con INGESTA_ENVIOS_POR_S=0 e INGESTA_DUPLICADO_SEGUNDOS=0.
+    python benchmarks/carga_ingesta.py --url http://localhost:8000 --mac AA:BB:CC:DD:EE:FF
+
+Para comparar con la pila síncrona se lanza la misma carga contra RUTA_SINCRONA y se muestran las dos medidas.
+Esa ruta la añade `aplicacion_con_sincrono`, que hay que servir en lugar de main:app:
+    uvicorn benchmarks.carga_ingesta:aplicacion_con_sincrono --factory
+    python benchmarks/carga_ingesta.py --url http://localhost:8000 --mac AA:BB:CC:DD:EE:FF --comparar-sincrono
+Con --local el script lo hace solo: arranca ese servidor (sin DATABASE_URL, sobre una SQLite temporal; con
+SQLite las escrituras concurrentes se bloquean entre sí y hay que comparar contra Postgres), siembra un
+dispositivo y mide las dos rutas:
+    python benchmarks/carga_ingesta.py --local --total 2000 --concurrencia 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+LINEA_GNSS = "+CGPSINFO: 4025.3456,N,00342.1234,W,180526,101010.0,650.2,0.0,0"
+RUTA = "/api/v2.2/registros"
+RUTA_SINCRONA = "/api/v2.2/registros/sincrono"
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def aplicacion_con_sincrono():
+    """
+    main.app con RUTA_SINCRONA: POST /registros como era antes de la ingesta asíncrona, una función def
+    (threadpool de Starlette) con una Session del engine síncrono y un INSERT con commit por petición.
+    La ruta asíncrona hace además el upsert de ultimas_posiciones: la comparación no la favorece
+    """
+    from fastapi import Depends, HTTPException
+    from sqlalchemy import select
+    from sqlalchemy.orm import Session
+
+    import gnss
+    import main
+    import models
+    from cache import normalizar_mac
+    from database import DispositivoDB, RegistroDB
+
+    @main.app.post(RUTA_SINCRONA, response_model=models.MostrarRegistro)
+    def crear_registro_sincrono(registro: models.CrearRegistro, db: Session = Depends(main.get_db)):
+        clave = normalizar_mac(registro.mac)
+        encontrado, dispositivo = main.cache_dispositivos.obtener(clave)
+        if not encontrado:
+            fila = db.execute(select(DispositivoDB).where(DispositivoDB.mac == registro.mac)).scalars().first()
+            dispositivo = models.Dispositivo.model_validate(fila) if fila else None
+            main.cache_dispositivos.guardar(clave, dispositivo)
+        if dispositivo is None:
+            raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+        fix = gnss.parsear_linea(registro.coordenadas or "")
+        if fix is None:
+            raise HTTPException(status_code=400, detail="Datos GNSS inválidos o no disponibles")
+
+        nuevo_registro = RegistroDB(
+            fecha=registro.fecha or fix.fecha,
+            latitud=fix.latitud,
+            longitud=fix.longitud,
+            altitud=fix.altitud,
+            velocidad=fix.velocidad,
+            dispositivo_id=dispositivo.id,
+        )
+        db.add(nuevo_registro)
+        db.commit()
+        db.refresh(nuevo_registro)
+        return models.MostrarRegistro(
+            id=nuevo_registro.id,
+            fecha=nuevo_registro.fecha,
+            coordenadas=f"{fix.latitud},{fix.longitud}",
+            altitud=fix.altitud,
+            velocidad=fix.velocidad,
+            dispositivo=dispositivo,
+        )
+
+    return main.app
+
+
+async def _trabajador(cliente, url, mac, peticiones, latencias, errores):
+    for _ in range(peticiones):
+        inicio = time.perf_counter()
+        respuesta = await cliente.post(url, json={"mac": mac, "coordenadas": LINEA_GNSS})
+        latencias.append(time.perf_counter() - inicio)
+        if respuesta.status_code != 200:
+            errores.append(respuesta.status_code)
+
+
+async def ejecutar(url: str, mac: str, total: int, concurrencia: int) -> dict:
+    latencias = []
+    errores = []
+    limites = httpx.Limits(max_connections=concurrencia, max_keepalive_connections=concurrencia)
+    async with httpx.AsyncClient(limits=limites, timeout=30) as cliente:
+        inicio = time.perf_counter()
+        await asyncio.gather(*(
+            _trabajador(cliente, url, mac, total // concurrencia, latencias, errores)
+            for _ in range(concurrencia)
+        ))
+        duracion = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        "peticiones": len(latencias),
+        "errores": len(errores),
+        "concurrencia": concurrencia,
+        "duracion_s": duracion,
+        "peticiones_por_s": len(latencias) / duracion,
+        "p50_ms": statistics.median(latencias) * 1000,
+        "p99_ms": latencias[int(len(latencias) * 0.99) - 1] * 1000,
+    }
+
+
+def preparar_local() -> tuple:
+    """ Esquema y un dispositivo sembrado en DATABASE_URL (o una SQLite temporal); devuelve (entorno, mac) """
+    import arranque
+
+    variables = arranque.entorno()
+    variables["INGESTA_ENVIOS_POR_S"] = "0"
+    variables["INGESTA_DUPLICADO_SEGUNDOS"] = "0"
+    subprocess.run([sys.executable, "migraciones.py"], cwd=RAIZ, env=variables, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    os.environ.update(variables)
+    import sembrar
+    from sqlalchemy import select
+    from database import SessionLocal, DispositivoDB, UsuarioDB
+
+    usuario = f"{sembrar.PREFIJO}0"
+    with SessionLocal() as db:
+        if db.execute(select(UsuarioDB.id).where(UsuarioDB.username == usuario)).first() is None:
+            sembrar.sembrar_usuarios(db, 1, 1)
+            db.commit()
+        mac = db.execute(
+            select(DispositivoDB.mac).join(UsuarioDB, DispositivoDB.usuario_id == UsuarioDB.id)
+            .where(UsuarioDB.username == usuario)
+        ).scalars().first()
+    return variables, mac
+
+
+def arrancar_local(variables: dict, limite_s: float = 120) -> tuple:
+    """ uvicorn con aplicacion_con_sincrono; devuelve (proceso, url) cuando /docs responde """
+    import arranque
+
+    puerto = arranque.puerto_libre()
+    proceso = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.carga_ingesta:aplicacion_con_sincrono", "--factory",
+         "--port", str(puerto), "--log-level", "warning"],
+        cwd=RAIZ, env=variables, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{puerto}"
+    inicio = time.perf_counter()
+    while time.perf_counter() - inicio < limite_s:
+        if proceso.poll() is not None:
+            raise RuntimeError(f"uvicorn terminó con código {proceso.returncode}")
+        try:
+            if httpx.get(url + "/docs", timeout=1).status_code == 200:
+                return proceso, url
+        except httpx.TransportError:
+            pass
+        time.sleep(0.05)
+    proceso.terminate()
+    raise RuntimeError("uvicorn no respondió a tiempo")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--ruta", default=RUTA)
+    parser.add_argument("--mac", help="MAC de un dispositivo existente (sin --local)")
+    parser.add_argument("--total", type=int, default=5000)
+    parser.add_argument("--concurrencia", type=int, default=64)
+    parser.add_argument("--comparar-sincrono", action="store_true",
+                        help="Lanza también la carga contra RUTA_SINCRONA (servidor con aplicacion_con_sincrono)")
+    parser.add_argument("--local", action="store_true",
+                        help="Arranca el servidor con aplicacion_con_sincrono y compara las dos rutas")
+    args = parser.parse_args()
+
+    proceso = None
+    if args.local:
+        variables, mac = preparar_local()
+        proceso, url = arrancar_local(variables)
+    elif args.mac:
+        url, mac = args.url.rstrip("/"), args.mac
+    else:
+        parser.error("--mac es obligatorio sin --local")
+
+    try:
+        asincrono = asyncio.run(ejecutar(url + args.ruta, mac, args.total, args.concurrencia))
+        if args.local or args.comparar_sincrono:
+            sincrono = asyncio.run(ejecutar(url + RUTA_SINCRONA, mac, args.total, args.concurrencia))
+            resultado = {
+                "asincrono": asincrono,
+                "sincrono": sincrono,
+                "peticiones_por_s_asincrono_vs_sincrono": asincrono["peticiones_por_s"] / sincrono["peticiones_por_s"],
+            }
+        else:
+            resultado = asincrono
+    finally:
+        if proceso is not None:
+            proceso.terminate()
+            proceso.wait()
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Comprueba que los listados no hacen una consulta por fila (N+1 por cargas perezosas): siembra --filas usuarios,
+dispositivos y registros, cuenta las sentencias SQL de cada listado con contador_consultas, dobla las filas y
+vuelve a contar. Falla (código de salida distinto de 0) si algún listado hace más consultas con el doble de filas
+(la misma comprobación sirve para cualquier listado nuevo: basta añadirlo a `peticiones`):
+
+- GET /usuarios (con su rol)
+- GET /dispositivos (con su usuario y el rol de este)
+- GET /dispositivos/usuario/{usuario_id} (un usuario con --filas y luego el doble de dispositivos)
+- GET /registros
+
+En proceso (TestClient, sin red); sin DATABASE_URL usa una SQLite temporal:
+    python benchmarks/consultas_listados.py --filas 200
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+if "DATABASE_URL" not in os.environ:
+    _ruta = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{_ruta}"
+    os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{_ruta}"
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import sembrar  # noqa: E402
+
+# Las MAC de los dispositivos del propietario van detrás de las de sembrar_usuarios
+INICIO_MAC_PROPIETARIO = 1 << 24
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", type=int, default=200, help="Filas de la primera medida (la segunda, el doble)")
+    args = parser.parse_args()
+
+    from fastapi.testclient import TestClient
+    from sqlalchemy import insert
+    import main as api
+    from contador_consultas import comprobar_consultas_constantes
+    from database import SessionLocal, DispositivoDB, engine, inicializar_bbdd
+    from paginacion import LIMITE_MAXIMO
+
+    if 2 * args.filas + 2 > LIMITE_MAXIMO:
+        # Usuarios y dispositivos incluyen root: todo tiene que caber en una página
+        raise SystemExit(f"--filas como mucho {(LIMITE_MAXIMO - 2) // 2}")
+
+    inicializar_bbdd()
+    estado = {"filas": 0, "propietario": None}
+
+    def sembrar_hasta(filas: int):
+        """ Completa hasta `filas` usuarios (con un dispositivo), registros y dispositivos del propietario """
+        nuevas = filas - estado["filas"]
+        with SessionLocal() as db:
+            dispositivo_ids = sembrar.sembrar_usuarios(db, nuevas, 1, desde=estado["filas"])
+            if estado["propietario"] is None:
+                estado["propietario"] = db.get(DispositivoDB, dispositivo_ids[0]).usuario_id
+            db.execute(insert(DispositivoDB), [
+                {
+                    "mac": sembrar.mac_sintetica(INICIO_MAC_PROPIETARIO + i),
+                    "nombre": f"propietario_{i}",
+                    "active": True,
+                    "usuario_id": estado["propietario"],
+                }
+                for i in range(estado["filas"], filas)
+            ])
+            db.commit()
+        sembrar.sembrar_registros(engine, dispositivo_ids, nuevas, dias=1)
+        estado["filas"] = filas
+
+    api.app.dependency_overrides[api.get_current_user] = lambda: None
+    cliente = TestClient(api.app)
+
+    def listado(ruta):
+        def peticion():
+            respuesta = cliente.get(api.ruta_inicial + ruta(), params={"limite": LIMITE_MAXIMO})
+            respuesta.raise_for_status()
+        return peticion
+
+    peticiones = {
+        "usuarios": listado(lambda: "usuarios"),
+        "dispositivos": listado(lambda: "dispositivos"),
+        "dispositivos_usuario": listado(lambda: f"dispositivos/usuario/{estado['propietario']}"),
+        "registros": listado(lambda: "registros"),
+    }
+    try:
+        conteos = comprobar_consultas_constantes(engine, peticiones, sembrar_hasta, (args.filas, 2 * args.filas))
+    except AssertionError as e:
+        raise SystemExit(str(e))
+    finally:
+        api.app.dependency_overrides.clear()
+    print(json.dumps(conteos, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Estado compartido entre workers: comprueba con dos instancias de EstadoRedis (dos "workers") que las
+invalidaciones y las posiciones publicadas por una llegan a la otra y que los contadores son comunes,
+y mide la latencia de propagación y el ritmo de publicación.
+
+Sin --url levanta en proceso un sustituto mínimo de Redis (PING, SELECT, AUTH, GET, SET NX PX, INCRBY,
+PUBLISH, SUBSCRIBE), suficiente para probar el protocolo sin instalar nada:
+    python benchmarks/estado_compartido.py --mensajes 20000
+Contra un Redis real:
+    python benchmarks/estado_compartido.py --url redis://localhost:6379/0
+Solo el sustituto, para arrancar varios workers (servidor.py) contra él:
+    python benchmarks/estado_compartido.py --servir 6390
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from estado_compartido import EstadoRedis, _codificar, _leer_respuesta  # noqa: E402
+
+
+def _cadena(valor: bytes) -> bytes:
+    return b"$%d\r\n%s\r\n" % (len(valor), valor)
+
+
+class ServidorRESP:
+    """ Sustituto de Redis en un solo event loop: lo justo para EstadoRedis, sin persistencia """
+
+    def __init__(self):
+        self._datos = {}  # clave -> (valor, caducidad monotónica o None)
+        self._suscriptores = defaultdict(set)
+        self.servidor = None
+
+    async def iniciar(self, host: str = "127.0.0.1", puerto: int = 0) -> int:
+        self.servidor = await asyncio.start_server(self._atender, host, puerto)
+        return self.servidor.sockets[0].getsockname()[1]
+
+    async def detener(self):
+        self.servidor.close()
+        # Los clientes ya cerraron: se deja que cada conexión lea su EOF antes de que asyncio.run cancele
+        await asyncio.sleep(0.05)
+        await self.servidor.wait_closed()
+
+    def _leer(self, clave):
+        valor, caduca = self._datos.get(clave, (None, None))
+        if caduca is not None and caduca <= time.monotonic():
+            del self._datos[clave]
+            return None, None
+        return valor, caduca
+
+    async def _atender(self, lector, escritor):
+        try:
+            while True:
+                comando = await _leer_respuesta(lector)
+                nombre = comando[0].decode().upper()
+                argumentos = comando[1:]
+                if nombre == "SUBSCRIBE":
+                    for numero, canal in enumerate(argumentos, 1):
+                        self._suscriptores[canal].add(escritor)
+                        escritor.write(b"*3\r\n" + _cadena(b"subscribe") + _cadena(canal) + b":%d\r\n" % numero)
+                else:
+                    escritor.write(self._ejecutar(nombre, argumentos))
+                await escritor.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for suscriptores in self._suscriptores.values():
+                suscriptores.discard(escritor)
+            escritor.close()
+
+    def _ejecutar(self, nombre: str, argumentos: list) -> bytes:
+        if nombre == "PING":
+            return b"+PONG\r\n"
+        if nombre in ("SELECT", "AUTH"):
+            return b"+OK\r\n"
+        if nombre == "GET":
+            valor, _ = self._leer(argumentos[0])
+            return b"$-1\r\n" if valor is None else _cadena(valor)
+        if nombre == "SET":
+            clave, valor, opciones = argumentos[0], argumentos[1], [a.decode().upper() for a in argumentos[2:]]
+            if "NX" in opciones and self._leer(clave)[0] is not None:
+                return b"$-1\r\n"
+            caduca = None
+            if "PX" in opciones:
+                caduca = time.monotonic() + int(opciones[opciones.index("PX") + 1]) / 1000
+            self._datos[clave] = (valor, caduca)
+            return b"+OK\r\n"
+        if nombre == "INCRBY":
+            valor, caduca = self._leer(argumentos[0])
+            nuevo = int(valor or 0) + int(argumentos[1])
+            self._datos[argumentos[0]] = (str(nuevo).encode(), caduca)
+            return b":%d\r\n" % nuevo
+        if nombre == "PUBLISH":
+            canal, mensaje = argumentos
+            suscriptores = self._suscriptores.get(canal, ())
+            for escritor in suscriptores:
+                escritor.write(_codificar(b"message", canal, mensaje))
+            return b":%d\r\n" % len(suscriptores)
+        return b"-ERR comando no soportado %s\r\n" % nombre.encode()
+
+
+async def esperar(condicion, limite_s: float = 5.0):
+    inicio = time.perf_counter()
+    while not condicion():
+        if time.perf_counter() - inicio > limite_s:
+            raise AssertionError("No llegó a tiempo")
+        await asyncio.sleep(0.001)
+
+
+async def ejecutar(url: str, mensajes: int) -> dict:
+    recibidos = defaultdict(list)
+    workers = [EstadoRedis(url), EstadoRedis(url)]
+    for indice, worker in enumerate(workers):
+        worker.suscribir("invalidaciones", lambda mensaje, i=indice: recibidos[("invalidaciones", i)].append(mensaje))
+        worker.suscribir("tiempo_real", lambda mensaje, i=indice: recibidos[("tiempo_real", i)].append(
+            (mensaje, time.perf_counter())
+        ))
+        await worker.iniciar()
+    await esperar(lambda: all(worker.suscrito for worker in workers))
+    a, b = workers
+
+    # Una invalidación de A llega a B y no vuelve a A
+    a.publicar("invalidaciones", {"cache": "dispositivos", "clave": "AA:BB:CC:DD:EE:FF"})
+    await esperar(lambda: recibidos[("invalidaciones", 1)])
+    await asyncio.sleep(0.05)
+    assert recibidos[("invalidaciones", 1)] == [{"cache": "dispositivos", "clave": "AA:BB:CC:DD:EE:FF"}]
+    assert not recibidos[("invalidaciones", 0)]
+
+    # Contador común: los dos suman sobre la misma clave y caduca
+    clave = f"prueba:{a.origen}"
+    totales = await asyncio.gather(*(worker.incrementar(clave, 1, ttl=0.2) for worker in workers * 50))
+    assert sorted(totales) == list(range(1, 101)), totales
+    await asyncio.sleep(0.25)
+    assert await b.incrementar(clave, 1, ttl=0.2) == 1
+
+    # Publicación desde un hilo (endpoints síncronos)
+    await asyncio.to_thread(a.publicar, "invalidaciones", {"cache": "principales", "clave": 7})
+    await esperar(lambda: len(recibidos[("invalidaciones", 1)]) == 2)
+
+    # Propagación: mensajes sueltos con su instante de envío
+    latencias = []
+    for i in range(200):
+        enviado = time.perf_counter()
+        a.publicar("tiempo_real", {"i": i})
+        await esperar(lambda: len(recibidos[("tiempo_real", 1)]) == i + 1)
+        latencias.append(recibidos[("tiempo_real", 1)][-1][1] - enviado)
+    latencias.sort()
+
+    # Ritmo: ráfaga de `mensajes` publicaciones que se agrupan en pipeline. Lo que no cabe en la cola
+    # de envío se descarta (perdidos) en vez de frenar a quien publica
+    previos = len(recibidos[("tiempo_real", 1)])
+    inicio = time.perf_counter()
+    for i in range(mensajes):
+        a.publicar("tiempo_real", {"dispositivo_id": i, "latitud": 40.4, "longitud": -3.7})
+        if i % 100 == 99:
+            await asyncio.sleep(0)  # como en la API: el envío avanza entre petición y petición
+    await esperar(lambda: len(recibidos[("tiempo_real", 1)]) == previos + mensajes - a.perdidos, limite_s=60)
+    duracion = time.perf_counter() - inicio
+
+    ping = await a.ping()
+    for worker in workers:
+        await worker.detener()
+    return {
+        "ping": ping,
+        "propagacion_p50_ms": latencias[len(latencias) // 2] * 1000,
+        "propagacion_p99_ms": latencias[int(len(latencias) * 0.99)] * 1000,
+        "rafaga_mensajes": mensajes,
+        "rafaga_mensajes_por_s": mensajes / duracion,
+        "perdidos": a.perdidos,
+        "estadisticas": [worker.estadisticas() for worker in workers],
+    }
+
+
+async def principal(args) -> dict:
+    if args.url:
+        return {"backend": args.url, **await ejecutar(args.url, args.mensajes)}
+    servidor = ServidorRESP()
+    puerto = await servidor.iniciar()
+    try:
+        return {"backend": "sustituto en proceso", **await ejecutar(f"redis://127.0.0.1:{puerto}/0", args.mensajes)}
+    finally:
+        await servidor.detener()
+
+
+async def servir(puerto: int):
+    servidor = ServidorRESP()
+    await servidor.iniciar("127.0.0.1", puerto)
+    print(f"Sustituto de Redis en redis://127.0.0.1:{puerto}/0", file=sys.stderr)
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Redis real; sin él se usa el sustituto en proceso")
+    parser.add_argument("--mensajes", type=int, default=20000)
+    parser.add_argument("--servir", type=int, metavar="PUERTO", help="Solo arranca el sustituto en este puerto")
+    args = parser.parse_args()
+    if args.servir:
+        asyncio.run(servir(args.servir))
+        return
+    print(json.dumps(asyncio.run(principal(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
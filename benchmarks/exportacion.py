@@ -0,0 +1,126 @@
+"""
+Exportación de registros (GET /registros/exportar) frente a construir la lista completa en memoria:
+
+- lista_json: todas las filas con .all() y un único JSON (lo que hacía falta antes para sacar el historial).
+- csv: exportacion.csv_gzip sobre el cursor de servidor, por lotes.
+- columnar: exportacion.columnar, el mismo flujo en bloques de columnas binarias.
+
+Para cada tamaño mide filas/s, bytes por fila y el pico de memoria de Python (tracemalloc) mientras se
+genera el cuerpo, que en las exportaciones no debe crecer con el número de filas. Comprueba además que
+CSV y columnar contienen las mismas filas y que reanudar a mitad da el resto exacto. Sin DATABASE_URL usa
+una SQLite temporal que se siembra sola:
+    python benchmarks/exportacion.py --registros 500000
+"""
+import argparse
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SQLITE_TEMPORAL = "DATABASE_URL" not in os.environ
+if SQLITE_TEMPORAL:
+    _ruta = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{_ruta}"
+    os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{_ruta}"
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import orjson  # noqa: E402
+import sembrar  # noqa: E402
+
+
+def ejecutar(generar) -> tuple:
+    """ (segundos, bytes) consumiendo el cuerpo trozo a trozo sin guardarlo """
+    inicio = time.perf_counter()
+    total = sum(len(trozo) for trozo in generar())
+    return time.perf_counter() - inicio, total
+
+
+def pico_memoria(generar) -> int:
+    tracemalloc.start()
+    try:
+        for _ in generar():
+            pass
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--registros", type=int, default=500000, help="Siembra de la SQLite temporal")
+    args = parser.parse_args()
+
+    if SQLITE_TEMPORAL:
+        sembrar.sembrar(20, 5, args.registros, dias=30)
+
+    import main as api
+    import exportacion
+    import serializacion
+    from database import SessionLocal, RegistroDB
+
+    with SessionLocal() as db:
+        ultimo = db.query(api.func.max(RegistroDB.id)).scalar() or 0
+        total = db.query(RegistroDB).count()
+
+        def exportar(formato: str, instantanea: int, reanudar=None):
+            """ El cuerpo que envía el endpoint (sin StreamingResponse, que lo recorre en el threadpool) """
+            def generar():
+                lotes = api.lotes_exportacion(api.consulta_exportacion(instantanea, reanudar=reanudar))
+                if formato == exportacion.FORMATO_CSV:
+                    return exportacion.csv_gzip(lotes, cabecera=reanudar is None)
+                return exportacion.columnar(lotes)
+            return generar
+
+        def lista_json(instantanea: int):
+            def generar():
+                filas = api.consulta_registros(db).filter(RegistroDB.id <= instantanea).order_by(*api.ORDEN_REGISTROS).all()
+                yield orjson.dumps([serializacion.fila_registro(fila) for fila in filas])
+            return generar
+
+        # Mismas filas en CSV y columnar, y reanudar a mitad da el resto
+        csv_completo = gzip.decompress(b"".join(exportar("csv", ultimo)()))
+        filas_csv = list(csv.reader(io.StringIO(csv_completo.decode())))[1:]
+        columnas = exportacion.leer_columnar(b"".join(exportar("columnar", ultimo)()))
+        if [int(fila[0]) for fila in filas_csv] != columnas["id"].tolist() or len(filas_csv) != total:
+            raise SystemExit("CSV y columnar no coinciden")
+        mitad = filas_csv[len(filas_csv) // 2]
+        resto = gzip.decompress(b"".join(exportar("csv", ultimo, (datetime.datetime.fromisoformat(mitad[1]), int(mitad[0])))()))
+        if filas_csv[: len(filas_csv) // 2 + 1] + list(csv.reader(io.StringIO(resto.decode()))) != filas_csv:
+            raise SystemExit("Reanudar no da el resto de la exportación")
+        del csv_completo, filas_csv, columnas, resto
+
+        resultados = {}
+        # Una décima parte y todo: la memoria de las exportaciones debe ser la misma en los dos casos
+        for instantanea in sorted({max(1, ultimo // 10), ultimo}):
+            filas = db.query(RegistroDB).filter(RegistroDB.id <= instantanea).count()
+            variantes = {
+                "lista_json": lista_json(instantanea),
+                "csv": exportar("csv", instantanea),
+                "columnar": exportar("columnar", instantanea),
+            }
+            resultado = {}
+            for nombre, generar in variantes.items():
+                segundos, tamano = ejecutar(generar)
+                resultado[nombre] = {
+                    "filas_por_s": filas / segundos,
+                    "bytes_por_fila": tamano / filas,
+                    "pico_memoria_mb": pico_memoria(generar) / 2**20,
+                }
+            resultados[filas] = resultado
+
+    print(json.dumps({"lote": api.TAMANO_LOTE_EXPORTACION, "resultados": resultados}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
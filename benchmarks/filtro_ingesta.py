@@ -0,0 +1,127 @@
+"""
+Un tracker averiado frente a los demás: durante --segundos, un dispositivo reenvía la misma línea +CGPSINFO
+en bucle (--concurrencia conexiones, cada una esperando --rtt entre respuesta y envío, así que la carga
+ofrecida es la misma con y sin filtro) mientras --dispositivos trackers normales envían un fix distinto
+cada --intervalo segundos. Se ejecuta sin filtro y con el filtro de ingesta (filtro_ingesta.py) y compara
+las filas que escribe el averiado, las respuestas que recibe y la latencia p50/p99 de los trackers normales.
+
+En proceso (httpx + ASGITransport, sin red); sin DATABASE_URL usa una SQLite temporal que se siembra sola:
+    python benchmarks/filtro_ingesta.py --segundos 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+if "DATABASE_URL" not in os.environ:
+    _ruta = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{_ruta}"
+    os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{_ruta}"
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import httpx  # noqa: E402
+import sembrar  # noqa: E402
+
+RUTA = "/api/v2.2/registros"
+LINEA_REPETIDA = "+CGPSINFO: 4025.3456,N,00342.1234,W,180526,101010.0,650.2,0.0,0"
+
+
+def percentil(valores: list, p: float) -> float:
+    return valores[min(len(valores) - 1, int(len(valores) * p))] if valores else 0.0
+
+
+async def escenario(cliente, macs: list, args) -> dict:
+    averiado, normales = macs[0], macs[1:]
+    fin = time.perf_counter() + args.segundos
+    respuestas_averiado = {}
+    latencias = []
+    errores_normales = {}
+    aleatorio = random.Random(3)
+
+    async def bucle_averiado():
+        while time.perf_counter() < fin:
+            respuesta = await cliente.post(RUTA, json={"mac": averiado, "coordenadas": LINEA_REPETIDA})
+            respuestas_averiado[respuesta.status_code] = respuestas_averiado.get(respuesta.status_code, 0) + 1
+            await asyncio.sleep(args.rtt)
+
+    async def tracker(mac: str):
+        await asyncio.sleep(aleatorio.uniform(0, args.intervalo))
+        while time.perf_counter() < fin:
+            lat = aleatorio.uniform(sembrar.LAT_MIN, sembrar.LAT_MAX)
+            lon = -aleatorio.uniform(sembrar.LON_MIN, sembrar.LON_MAX)  # grados oeste
+            inicio = time.perf_counter()
+            respuesta = await cliente.post(RUTA, json={
+                "mac": mac,
+                "coordenadas": f"{int(lat) * 100 + (lat % 1) * 60:.4f},N,{int(lon) * 100 + (lon % 1) * 60:09.4f},W,,,,,",
+            })
+            latencias.append(time.perf_counter() - inicio)
+            if respuesta.status_code >= 400:
+                errores_normales[respuesta.status_code] = errores_normales.get(respuesta.status_code, 0) + 1
+            await asyncio.sleep(args.intervalo)
+
+    await asyncio.gather(
+        *(bucle_averiado() for _ in range(args.concurrencia)),
+        *(tracker(mac) for mac in normales),
+    )
+    latencias.sort()
+    return {
+        "averiado_respuestas": respuestas_averiado,
+        "normales_envios": len(latencias),
+        "normales_errores": errores_normales,
+        "normales_p50_ms": percentil(latencias, 0.5) * 1000,
+        "normales_p99_ms": percentil(latencias, 0.99) * 1000,
+    }
+
+
+async def ejecutar(args) -> dict:
+    import main
+    from database import AsyncSessionLocal, RegistroDB, async_engine
+    from sqlalchemy import func, select
+
+    macs = [sembrar.mac_sintetica(i) for i in range(args.dispositivos + 1)]
+    filtro = main.filtro_ingesta
+    configuracion = (filtro.envios_por_s, filtro.segundos)
+    resultados = {}
+    transporte = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transporte, base_url="http://bench", timeout=60) as cliente:
+            for nombre, (envios_por_s, segundos) in (("sin_filtro", (0, 0)), ("con_filtro", configuracion)):
+                filtro.envios_por_s, filtro.segundos = envios_por_s, segundos
+                filtro.limitados = filtro.duplicados = 0
+                main.cache_dispositivos.limpiar()
+                async with AsyncSessionLocal() as db:
+                    previas = await db.scalar(select(func.count()).select_from(RegistroDB))
+                resultado = await escenario(cliente, macs, args)
+                async with AsyncSessionLocal() as db:
+                    escritas = await db.scalar(select(func.count()).select_from(RegistroDB)) - previas
+                resultado["filas_escritas"] = escritas
+                resultado["filtro"] = filtro.estadisticas()
+                resultados[nombre] = resultado
+    await async_engine.dispose()
+    return resultados
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segundos", type=float, default=5)
+    parser.add_argument("--dispositivos", type=int, default=50, help="Trackers normales")
+    parser.add_argument("--intervalo", type=float, default=1.0, help="Segundos entre fixes de un tracker normal")
+    parser.add_argument("--concurrencia", type=int, default=8, help="Conexiones del averiado")
+    parser.add_argument("--rtt", type=float, default=0.01, help="Segundos entre respuesta y reenvío del averiado")
+    args = parser.parse_args()
+
+    sembrar.sembrar(1, args.dispositivos + 1, 0, dias=1)
+    print(json.dumps(asyncio.run(ejecutar(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Coste de las geocercas en la ingesta.
+
+1. Micro-benchmark de IndiceGeocercas.evaluar con N geocercas (círculos y polígonos repartidos por una ciudad).
+2. Ingesta en proceso (httpx + ASGITransport, sin red) de lotes de registros de un vehículo en marcha,
+   sin geocercas y con N geocercas cargadas para ese mismo dispositivo.
+
+Sin DATABASE_URL usa una SQLite temporal:
+    python benchmarks/geocercas_ingesta.py --geocercas 10000
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if "DATABASE_URL" not in os.environ:
+    _ruta = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{_ruta}"
+    os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{_ruta}"
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+# Se mide la escritura: sin límite de envíos ni descarte de duplicados (ver benchmarks/filtro_ingesta.py)
+os.environ.setdefault("INGESTA_ENVIOS_POR_S", "0")
+os.environ.setdefault("INGESTA_DUPLICADO_SEGUNDOS", "0")
+
+import datetime  # noqa: E402
+import httpx  # noqa: E402
+import geocercas  # noqa: E402
+
+# Caja de unos 20 x 20 km alrededor de Madrid
+LAT_MIN, LAT_MAX = 40.33, 40.51
+LON_MIN, LON_MAX = -3.82, -3.58
+
+
+USUARIOS = 100  # el dispositivo d pertenece al usuario d % USUARIOS + 1
+
+
+def geocercas_aleatorias(n: int, dispositivos: int, aleatorio: random.Random) -> list:
+    resultado = []
+    for geocerca_id in range(1, n + 1):
+        lat = aleatorio.uniform(LAT_MIN, LAT_MAX)
+        lon = aleatorio.uniform(LON_MIN, LON_MAX)
+        dispositivo_id = aleatorio.randint(1, dispositivos)
+        if geocerca_id % 2:
+            resultado.append(geocercas.Geocerca(geocerca_id, geocercas.TIPO_CIRCULO, dispositivo_id, None,
+                                                latitud=lat, longitud=lon, radio=aleatorio.uniform(50, 1000)))
+        else:
+            lado = aleatorio.uniform(0.001, 0.01)
+            vertices = ((lat, lon), (lat + lado, lon), (lat + lado, lon + lado), (lat, lon + lado * 1.5))
+            resultado.append(geocercas.Geocerca(geocerca_id, geocercas.TIPO_POLIGONO, None, aleatorio.randint(1, USUARIOS),
+                                                vertices=vertices))
+    return resultado
+
+
+def percentil(valores: list, p: float) -> float:
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+def micro(n_geocercas: int, n_fixes: int, dispositivos: int) -> dict:
+    aleatorio = random.Random(7)
+    indice = geocercas.IndiceGeocercas()
+    inicio = time.perf_counter()
+    indice.cargar(geocercas_aleatorias(n_geocercas, dispositivos, aleatorio))
+    carga = time.perf_counter() - inicio
+
+    fecha = datetime.datetime(2026, 1, 1)
+    tiempos = []
+    for i in range(n_fixes):
+        lat = aleatorio.uniform(LAT_MIN, LAT_MAX)
+        lon = aleatorio.uniform(LON_MIN, LON_MAX)
+        inicio = time.perf_counter()
+        dispositivo_id = i % dispositivos + 1
+        indice.evaluar(dispositivo_id, dispositivo_id % USUARIOS + 1, lat, lon, fecha + datetime.timedelta(seconds=i))
+        tiempos.append(time.perf_counter() - inicio)
+    tiempos.sort()
+    return {
+        "geocercas": n_geocercas,
+        "carga_s": carga,
+        "fixes": n_fixes,
+        "fixes_por_s": n_fixes / sum(tiempos),
+        "p50_us": percentil(tiempos, 0.5) * 1e6,
+        "p99_us": percentil(tiempos, 0.99) * 1e6,
+        **indice.estadisticas(),
+    }
+
+
+async def ingesta(main, async_engine, lotes: int, tam_lote: int, mac: str, dia: int) -> dict:
+    """ Un vehículo que recorre la ciudad a ~50 km/h con un fix por segundo """
+    aleatorio = random.Random(11)
+    lat, lon = (LAT_MIN + LAT_MAX) / 2, (LON_MIN + LON_MAX) / 2
+    rumbo = 0.0
+    transporte = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://bench") as cliente:
+        inicio = time.perf_counter()
+        for numero in range(lotes):
+            cuerpo = []
+            for i in range(tam_lote):
+                rumbo += aleatorio.uniform(-0.3, 0.3)
+                lat = min(max(lat + 0.000125 * math.cos(rumbo), LAT_MIN), LAT_MAX)
+                lon = min(max(lon + 0.000165 * math.sin(rumbo), LON_MIN), LON_MAX)
+                segundos = numero * tam_lote + i
+                cuerpo.append({
+                    "mac": mac,
+                    "fecha": (datetime.datetime(2026, 1, dia) + datetime.timedelta(seconds=segundos)).isoformat(),
+                    "coordenadas": f"{int(lat) * 100 + (lat % 1) * 60:.4f},N,{int(-lon) * 100 + (-lon % 1) * 60:09.4f},W,,,,,",
+                })
+            respuesta = await cliente.post(main.ruta_inicial + "registros/lote", json=cuerpo)
+            respuesta.raise_for_status()
+        duracion = time.perf_counter() - inicio
+    # Las conexiones del pool quedan ligadas a este event loop
+    await async_engine.dispose()
+    return {"registros": lotes * tam_lote, "duracion_s": duracion, "registros_por_s": lotes * tam_lote / duracion}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--geocercas", type=int, default=10000)
+    parser.add_argument("--fixes", type=int, default=100000)
+    parser.add_argument("--dispositivos", type=int, default=1000)
+    parser.add_argument("--lotes", type=int, default=50)
+    parser.add_argument("--tam-lote", type=int, default=200)
+    args = parser.parse_args()
+
+    resultado = {
+        "micro_sin_geocercas": micro(0, args.fixes, args.dispositivos),
+        "micro_con_geocercas": micro(args.geocercas, args.fixes, args.dispositivos),
+    }
+
+    import main as app_main
+    from database import SessionLocal, DispositivoDB, GeocercaDB, async_engine, inicializar_bbdd
+    from sqlalchemy import delete, insert
+    inicializar_bbdd()
+    mac = "B0:B0:B0:B0:B0:B0"
+    with SessionLocal() as db:
+        dispositivo = db.query(DispositivoDB).filter(DispositivoDB.mac == mac).first()
+        if dispositivo is None:
+            dispositivo = DispositivoDB(mac=mac, nombre="benchmark", active=True, usuario_id=1)
+            db.add(dispositivo)
+            db.commit()
+        dispositivo_id = dispositivo.id
+        db.execute(delete(GeocercaDB).where(GeocercaDB.dispositivo_id == dispositivo_id))
+        db.commit()
+
+    app_main.cargar_geocercas()
+    resultado["ingesta_sin_geocercas"] = asyncio.run(ingesta(app_main, async_engine, args.lotes, args.tam_lote, mac, dia=1))
+
+    # Todas las geocercas aplican al dispositivo del benchmark: es el peor caso
+    with SessionLocal() as db:
+        db.execute(insert(GeocercaDB), [
+            {
+                "nombre": f"bench-{g.id}", "tipo": g.tipo, "latitud": g.latitud, "longitud": g.longitud, "radio": g.radio,
+                "vertices_json": json.dumps(g.vertices) if g.vertices else None,
+                "dispositivo_id": dispositivo_id, "activa": True,
+            }
+            for g in geocercas_aleatorias(args.geocercas, 1, random.Random(7))
+        ])
+        db.commit()
+    app_main.cargar_geocercas()
+    eventos_antes = app_main.indice_geocercas.eventos
+    resultado["ingesta_con_geocercas"] = asyncio.run(ingesta(app_main, async_engine, args.lotes, args.tam_lote, mac, dia=2))
+    resultado["ingesta_con_geocercas"]["eventos"] = app_main.indice_geocercas.eventos - eventos_antes
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == "__main__":
+    main()
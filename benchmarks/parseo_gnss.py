@@ -0,0 +1,86 @@
+"""
+Micro-benchmark del parseo GNSS: `formateo` original, gnss.parsear_linea y gnss.parsear_lote
+sobre un corpus sintético de líneas +CGPSINFO.
+    python benchmarks/parseo_gnss.py --lineas 200000
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gnss  # noqa: E402
+
+
+def formateo_original(datos_gnss):
+    """ Referencia: el formateo anterior de main.py, sin los print de depuración """
+    try:
+        datos_gnss = re.sub(r"^\+CGPSINFO:\s*", "", datos_gnss)
+        partes = datos_gnss.split(',')[:4]
+        if len(partes) < 4:
+            raise ValueError("Formato de datos GNSS incorrecto.")
+        lat_dmm, ns, lon_dmm, ew = map(str.strip, partes)
+        lat_decimal = int(lat_dmm[:2]) + float(lat_dmm[2:]) / 60
+        if ns == 'S':
+            lat_decimal *= -1
+        lon_decimal = int(lon_dmm[:3]) + float(lon_dmm[3:]) / 60
+        if ew == 'W':
+            lon_decimal *= -1
+        return f"{lat_decimal},{lon_decimal}"
+    except Exception:
+        return None
+
+
+def corpus(n: int, proporcion_vacios: float = 0.05) -> list:
+    aleatorio = random.Random(42)
+    lineas = []
+    for _ in range(n):
+        if aleatorio.random() < proporcion_vacios:
+            lineas.append("+CGPSINFO: ,,,,,,,,")
+            continue
+        lat = aleatorio.uniform(0, 89.99)
+        lon = aleatorio.uniform(0, 179.99)
+        lat_dmm = f"{int(lat):02d}{(lat % 1) * 60:09.6f}"
+        lon_dmm = f"{int(lon):03d}{(lon % 1) * 60:09.6f}"
+        lineas.append(
+            f"+CGPSINFO: {lat_dmm},{aleatorio.choice('NS')},{lon_dmm},{aleatorio.choice('EW')},"
+            f"{aleatorio.randint(1, 28):02d}{aleatorio.randint(1, 12):02d}26,"
+            f"{aleatorio.randint(0, 23):02d}{aleatorio.randint(0, 59):02d}{aleatorio.randint(0, 59):02d}.0,"
+            f"{aleatorio.uniform(0, 2000):.1f},{aleatorio.uniform(0, 60):.1f},0"
+        )
+    return lineas
+
+
+def medir(funcion, repeticiones: int = 3) -> float:
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lineas", type=int, default=200000)
+    args = parser.parse_args()
+
+    lineas = corpus(args.lineas)
+    tiempos = {
+        "formateo_original": medir(lambda: [formateo_original(linea) for linea in lineas]),
+        "parsear_linea": medir(lambda: [gnss.parsear_linea(linea) for linea in lineas]),
+        "parsear_lote": medir(lambda: gnss.parsear_lote(lineas)),
+    }
+    resultado = {
+        "lineas": args.lineas,
+        **{f"{nombre}_s": segundos for nombre, segundos in tiempos.items()},
+        **{f"{nombre}_lineas_por_s": args.lineas / segundos for nombre, segundos in tiempos.items()},
+    }
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Banco de pruebas del protocolo binario: comprueba el decodificador con un corpus aleatorio (ida y vuelta,
+tramas corruptas o truncadas) y compara bytes por fix y velocidad de decodificación con el JSON + `+CGPSINFO`.
+    python benchmarks/protocolo_binario.py --fixes 100000
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gnss  # noqa: E402
+import protocolo_binario  # noqa: E402
+
+MAC = "AA:BB:CC:DD:EE:FF"
+
+
+def fixes_aleatorios(n: int, aleatorio: random.Random) -> list:
+    inicio = datetime.datetime(2026, 1, 1)
+    return [
+        (
+            round(aleatorio.uniform(-90, 90), 7),
+            round(aleatorio.uniform(-180, 180), 7),
+            inicio + datetime.timedelta(seconds=i),
+            float(aleatorio.randint(-100, 3000)),
+            round(aleatorio.uniform(0, 200), 1),
+        )
+        for i in range(n)
+    ]
+
+
+def linea_cgpsinfo(latitud: float, longitud: float, fecha: datetime.datetime) -> str:
+    lat, lon = abs(latitud), abs(longitud)
+    return (
+        f"+CGPSINFO: {int(lat) * 100 + (lat % 1) * 60:010.5f},{'N' if latitud >= 0 else 'S'},"
+        f"{int(lon) * 100 + (lon % 1) * 60:011.5f},{'E' if longitud >= 0 else 'W'},"
+        f"{fecha:%d%m%y},{fecha:%H%M%S}.0,650.2,0.0,0"
+    )
+
+
+def comprobar(fixes: list, tam_trama: int):
+    """ Ida y vuelta exacta y errores ante tramas dañadas; lanza AssertionError si algo falla """
+    for extendido in (False, True):
+        datos = b"".join(
+            protocolo_binario.codificar_trama(MAC, fixes[i:i + tam_trama], extendido=extendido)
+            for i in range(0, len(fixes), tam_trama)
+        )
+        decodificados = [fix for trama in protocolo_binario.iterar_tramas(datos) for fix in trama.fixes]
+        assert len(decodificados) == len(fixes)
+        for original, fix in zip(fixes, decodificados):
+            assert abs(fix.latitud - original[0]) < 1e-7 and abs(fix.longitud - original[1]) < 1e-7
+            assert fix.fecha == original[2]
+            if extendido:
+                assert fix.altitud == original[3] and abs(fix.velocidad - original[4]) < 0.051
+            else:
+                assert fix.altitud is None and fix.velocidad is None
+
+    trama = protocolo_binario.codificar_trama(MAC, fixes[:3])
+    for dañada in (trama[:-1], trama[:5], b"XX" + trama[2:], trama[:2] + b"\x09" + trama[3:]):
+        try:
+            protocolo_binario.decodificar(dañada)
+        except protocolo_binario.ErrorTrama:
+            continue
+        raise AssertionError(f"Trama dañada aceptada: {dañada!r}")
+
+    fuera_de_rango = protocolo_binario.codificar_trama(MAC, [(91.0, 0.0, None), (0.0, 181.0, None), (0.0, 0.0, None)])
+    assert [fix is None for fix in protocolo_binario.decodificar(fuera_de_rango)[0].fixes] == [True, True, False]
+
+
+def medir(fixes: list, tam_trama: int) -> dict:
+    binario = b"".join(
+        protocolo_binario.codificar_trama(MAC, fixes[i:i + tam_trama])
+        for i in range(0, len(fixes), tam_trama)
+    )
+    cuerpo_json = json.dumps([
+        {"mac": MAC, "coordenadas": linea_cgpsinfo(lat, lon, fecha)} for lat, lon, fecha, _, _ in fixes
+    ]).encode()
+
+    inicio = time.perf_counter()
+    for trama in protocolo_binario.iterar_tramas(binario):
+        pass
+    tiempo_binario = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    registros = json.loads(cuerpo_json)
+    gnss.parsear_lote([registro["coordenadas"] for registro in registros])
+    tiempo_json = time.perf_counter() - inicio
+
+    return {
+        "fixes": len(fixes),
+        "fixes_por_trama": tam_trama,
+        "bytes_por_fix_binario": len(binario) / len(fixes),
+        "bytes_por_fix_json": len(cuerpo_json) / len(fixes),
+        "fixes_por_s_binario": len(fixes) / tiempo_binario,
+        "fixes_por_s_json": len(fixes) / tiempo_json,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixes", type=int, default=100000)
+    parser.add_argument("--fixes-por-trama", type=int, default=20)
+    args = parser.parse_args()
+
+    fixes = fixes_aleatorios(args.fixes, random.Random(3))
+    comprobar(fixes[:5000], args.fixes_por_trama)
+    print(json.dumps(medir(fixes, args.fixes_por_trama), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Consultas de proximidad (GET /dispositivos/cercanos) sobre proximidad.IndicePosiciones con --dispositivos
+posiciones repartidas por una caja de unos 20 x 20 km en Madrid (el caso denso):
+
+- Carga del índice y coste de actualizar la posición de un dispositivo (lo que añade cada fix a la ingesta).
+- p50/p99 de consultas en puntos aleatorios para varios radios con limite 100, con y sin filtro de usuario,
+  frente a calcular el haversine de todos los dispositivos con NumPy (fuerza bruta) y en Python puro.
+  Comprueba que el índice devuelve lo mismo que la fuerza bruta.
+- p50/p99 del endpoint en proceso (httpx + ASGITransport, sin red ni BBDD) con el índice ya cargado.
+
+    python benchmarks/proximidad.py --dispositivos 100000
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Solo la raíz delante: este fichero se llama como el módulo proximidad.py (sembrar sigue en la ruta del script)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+if "DATABASE_URL" not in os.environ:
+    _ruta = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{_ruta}"
+    os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{_ruta}"
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import numpy as np  # noqa: E402
+import httpx  # noqa: E402
+import geocercas  # noqa: E402
+import proximidad  # noqa: E402
+import sembrar  # noqa: E402
+
+LIMITE = 100
+
+
+def percentiles(tiempos: list) -> dict:
+    tiempos = sorted(tiempos)
+    return {
+        "p50_ms": tiempos[len(tiempos) // 2] * 1000,
+        "p99_ms": tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.99))] * 1000,
+    }
+
+
+def fuerza_bruta(latitudes, longitudes, usuarios, latitud, longitud, radio, usuario_id=None) -> list:
+    distancias = proximidad.distancias_m(latitud, longitud, latitudes, longitudes)
+    dentro = distancias <= radio
+    if usuario_id is not None:
+        dentro &= usuarios == usuario_id
+    indices = np.flatnonzero(dentro)
+    return indices[np.argsort(distancias[indices], kind="stable")][:LIMITE].tolist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dispositivos", type=int, default=100000)
+    parser.add_argument("--usuarios", type=int, default=1000, help="Propietarios entre los que se reparten")
+    parser.add_argument("--consultas", type=int, default=500)
+    parser.add_argument("--radios", default="500,2000,10000", help="Metros, separados por comas")
+    args = parser.parse_args()
+
+    aleatorio = np.random.default_rng(7)
+    n = args.dispositivos
+    latitudes = aleatorio.uniform(sembrar.LAT_MIN, sembrar.LAT_MAX, n)
+    longitudes = aleatorio.uniform(sembrar.LON_MIN, sembrar.LON_MAX, n)
+    usuarios = aleatorio.integers(0, args.usuarios, n)
+    fecha = datetime.datetime(2026, 1, 1)
+
+    import main as api
+    indice = api.indice_posiciones
+    inicio = time.perf_counter()
+    indice.cargar(zip(range(n), usuarios.tolist(), latitudes.tolist(), longitudes.tolist(), [fecha] * n))
+    carga_s = time.perf_counter() - inicio
+
+    # Cada fix mueve su dispositivo unos metros; de vez en cuando cambia de celda
+    muestras = min(n, 20000)
+    desplazamiento = aleatorio.normal(0, 0.0005, muestras)
+    inicio = time.perf_counter()
+    for i in range(muestras):
+        indice.actualizar(i, int(usuarios[i]), float(latitudes[i] + desplazamiento[i]), float(longitudes[i]), fecha)
+    actualizar_us = (time.perf_counter() - inicio) / muestras * 1e6
+    latitudes[:muestras] += desplazamiento
+
+    puntos = np.column_stack([
+        aleatorio.uniform(sembrar.LAT_MIN, sembrar.LAT_MAX, args.consultas),
+        aleatorio.uniform(sembrar.LON_MIN, sembrar.LON_MAX, args.consultas),
+    ])
+    consultas = {}
+    for radio in (float(valor) for valor in args.radios.split(",")):
+        for filtro in ("todos", "usuario"):
+            tiempos_indice, tiempos_numpy, encontrados = [], [], 0
+            for k, (latitud, longitud) in enumerate(puntos):
+                usuario_id = int(usuarios[k % n]) if filtro == "usuario" else None
+                inicio = time.perf_counter()
+                resultado = indice.cercanos(latitud, longitud, radio, usuario_id, LIMITE)
+                tiempos_indice.append(time.perf_counter() - inicio)
+                inicio = time.perf_counter()
+                esperado = fuerza_bruta(latitudes, longitudes, usuarios, latitud, longitud, radio, usuario_id)
+                tiempos_numpy.append(time.perf_counter() - inicio)
+                if [fila[0] for fila in resultado] != esperado:
+                    raise SystemExit(f"El índice no coincide con la fuerza bruta (radio {radio}, {filtro})")
+                encontrados += len(resultado)
+            consultas[f"{int(radio)}m_{filtro}"] = {
+                "resultados_medios": encontrados / len(puntos),
+                "indice": percentiles(tiempos_indice),
+                "fuerza_bruta_numpy": percentiles(tiempos_numpy),
+            }
+
+    # Python puro sobre todos los dispositivos, como haría un cliente con todas las posiciones: pocas repeticiones
+    latitud, longitud = puntos[0]
+    pares = list(zip(latitudes.tolist(), longitudes.tolist()))
+    inicio = time.perf_counter()
+    for _ in range(3):
+        sorted(d for d in (geocercas.distancia_m(latitud, longitud, a, b) for a, b in pares) if d <= 2000)
+    python_puro_ms = (time.perf_counter() - inicio) / 3 * 1000
+
+    endpoint = asyncio.run(medir_endpoint(api, puntos, args.consultas))
+    print(json.dumps({
+        "dispositivos": n,
+        "carga_s": carga_s,
+        "actualizar_us": actualizar_us,
+        "indice": indice.estadisticas(),
+        "consultas": consultas,
+        "python_puro_2000m_ms": python_puro_ms,
+        "endpoint_2000m": endpoint,
+    }, indent=2))
+
+
+async def medir_endpoint(api, puntos, consultas: int) -> dict:
+    # root: la búsqueda recorre los dispositivos de todos los usuarios
+    api.app.dependency_overrides[api.get_current_user] = lambda: api.models.Principal(id=1, username="root", rol="root")
+    tiempos = []
+    transporte = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://bench") as cliente:
+        for latitud, longitud in puntos[:consultas]:
+            inicio = time.perf_counter()
+            respuesta = await cliente.get(api.ruta_inicial + "dispositivos/cercanos", params={
+                "lat": latitud, "lon": longitud, "radio": 2000, "limite": LIMITE,
+            })
+            tiempos.append(time.perf_counter() - inicio)
+            respuesta.raise_for_status()
+    api.app.dependency_overrides.clear()
+    return percentiles(tiempos)
+
+
+if __name__ == "__main__":
+    main()
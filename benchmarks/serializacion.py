@@ -0,0 +1,125 @@
+"""
+Coste por fila de serializar el listado de registros, sin HTTP por medio:
+
+- fastapi_orm: como antes. Objetos ORM con su dispositivo (joinedload), validados con response_model y
+  convertidos por la ruta genérica de FastAPI (serialize_response + JSONResponse).
+- adaptador_orm: los mismos objetos con el TypeAdapter precompilado de models (validate + dump_json),
+  lo que usan ahora los demás listados.
+- tuplas_orjson: tuplas de columnas (main.COLUMNAS_REGISTRO) y serializacion.fila_registro + orjson,
+  lo que usa ahora GET /registros.
+
+Se mide solo la serialización y también consulta + serialización de una página. Comprueba además que
+las tres salidas son el mismo JSON. Sin DATABASE_URL usa una SQLite temporal que se siembra sola:
+    python benchmarks/serializacion.py --filas 1000 --repeticiones 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SQLITE_TEMPORAL = "DATABASE_URL" not in os.environ
+if SQLITE_TEMPORAL:
+    _ruta = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{_ruta}"
+    os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{_ruta}"
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import orjson  # noqa: E402
+import sembrar  # noqa: E402
+from typing import List  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from fastapi.utils import create_model_field  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+from sqlalchemy.orm import joinedload, raiseload  # noqa: E402
+
+
+def medir(funcion, repeticiones: int) -> float:
+    """ Mejor tiempo de `repeticiones` ejecuciones, en segundos """
+    mejor = float("inf")
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        mejor = min(mejor, time.perf_counter() - inicio)
+    return mejor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", type=int, default=1000, help="Tamaño de la página (LIMITE_MAXIMO es 1000)")
+    parser.add_argument("--repeticiones", type=int, default=20)
+    parser.add_argument("--registros", type=int, default=20000, help="Siembra de la SQLite temporal")
+    args = parser.parse_args()
+
+    if SQLITE_TEMPORAL:
+        sembrar.sembrar(20, 5, args.registros, dias=30)
+
+    import main as api
+    import models
+    import serializacion
+    from database import SessionLocal, RegistroDB
+
+    campo = create_model_field(name="Response_obtener_registros", type_=List[models.MostrarRegistro], mode="serialization")
+    adaptador = TypeAdapter(List[models.MostrarRegistro])
+
+    def consulta_orm(db):
+        db.expunge_all()  # sin el mapa de identidad de la ejecución anterior
+        return (
+            db.query(RegistroDB).options(joinedload(RegistroDB.dispositivo), raiseload("*"))
+            .order_by(*api.ORDEN_REGISTROS).limit(args.filas).all()
+        )
+
+    def consulta_tuplas(db):
+        return api.consulta_registros(db).order_by(*api.ORDEN_REGISTROS).limit(args.filas).all()
+
+    bucle = asyncio.new_event_loop()
+
+    def fastapi_orm(objetos) -> bytes:
+        contenido = bucle.run_until_complete(serialize_response(field=campo, response_content=objetos, is_coroutine=True))
+        return JSONResponse(contenido).body
+
+    def adaptador_orm(objetos) -> bytes:
+        return adaptador.dump_json(adaptador.validate_python(objetos, from_attributes=True))
+
+    def tuplas_orjson(filas) -> bytes:
+        return orjson.dumps([serializacion.fila_registro(fila) for fila in filas])
+
+    with SessionLocal() as db:
+        objetos = consulta_orm(db)
+        filas = consulta_tuplas(db)
+        n = len(filas)
+        salidas = [json.loads(fastapi_orm(objetos)), json.loads(adaptador_orm(objetos)), json.loads(tuplas_orjson(filas))]
+        if not (salidas[0] == salidas[1] == salidas[2]):
+            raise SystemExit("Las salidas no coinciden")
+
+        variantes = {
+            "fastapi_orm": (lambda: fastapi_orm(objetos), lambda: fastapi_orm(consulta_orm(db))),
+            "adaptador_orm": (lambda: adaptador_orm(objetos), lambda: adaptador_orm(consulta_orm(db))),
+            "tuplas_orjson": (lambda: tuplas_orjson(filas), lambda: tuplas_orjson(consulta_tuplas(db))),
+        }
+        resultados = {}
+        for nombre, (serializar, completo) in variantes.items():
+            solo = medir(serializar, args.repeticiones)
+            con_consulta = medir(completo, args.repeticiones)
+            resultados[nombre] = {
+                "serializacion_us_por_fila": solo / n * 1e6,
+                "consulta_y_serializacion_ms": con_consulta * 1000,
+            }
+
+    base = resultados["fastapi_orm"]
+    for resultado in resultados.values():
+        resultado["aceleracion_serializacion"] = base["serializacion_us_por_fila"] / resultado["serializacion_us_por_fila"]
+        resultado["aceleracion_total"] = base["consulta_y_serializacion_ms"] / resultado["consulta_y_serializacion_ms"]
+    print(json.dumps({"filas": n, "bytes": len(tuplas_orjson(filas)), "variantes": resultados}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
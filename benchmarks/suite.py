@@ -0,0 +1,249 @@
+"""
+Suite de benchmarks de los caminos calientes de la API: login, ingesta de un registro, listado de registros
+y dispositivos de un usuario. Mide peticiones/s y latencias p50/p99 por escenario y guarda un JSON
+(con commit, base de datos y parámetros) para comparar ejecuciones.
+
+Necesita la siembra de benchmarks/sembrar.py. En proceso (httpx + ASGITransport, sin red) contra DATABASE_URL,
+o sin DATABASE_URL contra una SQLite temporal que se siembra sola:
+    python benchmarks/suite.py --salida antes.json
+    python benchmarks/suite.py --salida despues.json --comparar antes.json
+Contra un servidor en marcha (sembrado con la misma base de datos):
+    python benchmarks/suite.py --url http://localhost:8000 --salida k8s.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SQLITE_TEMPORAL = "DATABASE_URL" not in os.environ
+if SQLITE_TEMPORAL:
+    _ruta = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+    os.environ["DATABASE_URL"] = f"sqlite:///{_ruta}"
+    os.environ["ASYNC_DATABASE_URL"] = f"sqlite+aiosqlite:///{_ruta}"
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("ALGORITHM", "HS256")
+# Se mide la escritura: sin límite de envíos ni descarte de duplicados (ver benchmarks/filtro_ingesta.py)
+os.environ.setdefault("INGESTA_ENVIOS_POR_S", "0")
+os.environ.setdefault("INGESTA_DUPLICADO_SEGUNDOS", "0")
+
+import httpx  # noqa: E402
+import sembrar  # noqa: E402
+
+RUTA = "/api/v2.2/"
+ESCENARIOS = ("login", "ingesta", "listado_registros", "dispositivos_usuario")
+USUARIOS_PRUEBA = 20  # usuarios bench_N con los que se preparan tokens y MACs
+
+
+def percentil(valores: list, p: float) -> float:
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+async def medir(peticion, total: int, concurrencia: int, calentamiento: int) -> dict:
+    """ Lanza `peticion(i) -> respuesta` `total` veces con `concurrencia` trabajadores """
+    for i in range(calentamiento):
+        await peticion(i)
+
+    latencias = []
+    errores = {}
+    siguiente = iter(range(total))
+
+    async def trabajador():
+        for i in siguiente:
+            inicio = time.perf_counter()
+            respuesta = await peticion(i)
+            latencias.append(time.perf_counter() - inicio)
+            if respuesta.status_code >= 400:
+                errores[respuesta.status_code] = errores.get(respuesta.status_code, 0) + 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+    duracion = time.perf_counter() - inicio
+
+    latencias.sort()
+    return {
+        "peticiones": total,
+        "concurrencia": concurrencia,
+        "errores": errores,
+        "duracion_s": duracion,
+        "peticiones_por_s": total / duracion,
+        "p50_ms": percentil(latencias, 0.5) * 1000,
+        "p99_ms": percentil(latencias, 0.99) * 1000,
+    }
+
+
+async def preparar(cliente) -> dict:
+    """ Tokens, ids y MACs de los primeros usuarios sembrados """
+    usuarios = []
+    for i in range(USUARIOS_PRUEBA):
+        respuesta = await cliente.post(RUTA + "token_username", json={"username": f"{sembrar.PREFIJO}{i}", "password": sembrar.PASSWORD})
+        if respuesta.status_code != 200:
+            break
+        usuarios.append(respuesta.json())
+    if not usuarios:
+        raise SystemExit("No hay usuarios sembrados: ejecuta antes benchmarks/sembrar.py")
+    cabeceras = {"Authorization": f"Bearer {usuarios[0]['access_token']}"}
+    dispositivos = []
+    for usuario in usuarios:
+        respuesta = await cliente.get(RUTA + f"dispositivos/usuario/{usuario['usuario_id']}", headers=cabeceras)
+        dispositivos.extend(respuesta.json())
+    return {
+        "cabeceras": cabeceras,
+        "usuario_ids": [usuario["usuario_id"] for usuario in usuarios],
+        "dispositivo_ids": [dispositivo["id"] for dispositivo in dispositivos],
+        "macs": [dispositivo["mac"] for dispositivo in dispositivos],
+    }
+
+
+async def ejecutar(cliente, escenarios: list, args) -> dict:
+    datos = await preparar(cliente)
+    cabeceras = datos["cabeceras"]
+    aleatorio = random.Random(5)
+    resultados = {}
+
+    if "login" in escenarios:
+        async def login(i):
+            return await cliente.post(RUTA + "token_username", json={
+                "username": f"{sembrar.PREFIJO}{i % USUARIOS_PRUEBA}", "password": sembrar.PASSWORD,
+            })
+        resultados["login"] = await medir(login, args.peticiones_login, args.concurrencia, 2)
+
+    if "ingesta" in escenarios:
+        async def ingesta(i):
+            lat = aleatorio.uniform(sembrar.LAT_MIN, sembrar.LAT_MAX)
+            lon = aleatorio.uniform(-sembrar.LON_MAX, -sembrar.LON_MIN)  # grados oeste
+            return await cliente.post(RUTA + "registros", json={
+                "mac": datos["macs"][i % len(datos["macs"])],
+                "coordenadas": f"{int(lat) * 100 + (lat % 1) * 60:.4f},N,{int(lon) * 100 + (lon % 1) * 60:09.4f},W,,,,,",
+            })
+        resultados["ingesta"] = await medir(ingesta, args.peticiones, args.concurrencia, 10)
+
+    if "listado_registros" in escenarios:
+        # Mitad primera página global, mitad historial de un dispositivo en la última semana
+        desde = (datetime.datetime.utcnow() - datetime.timedelta(days=7)).isoformat()
+
+        async def listado(i):
+            parametros = {"limite": args.limite}
+            if i % 2:
+                parametros.update({"dispositivo_id": aleatorio.choice(datos["dispositivo_ids"]), "desde": desde})
+            return await cliente.get(RUTA + "registros", params=parametros, headers=cabeceras)
+        resultados["listado_registros"] = await medir(listado, args.peticiones, args.concurrencia, 10)
+
+    if "dispositivos_usuario" in escenarios:
+        async def dispositivos_usuario(i):
+            usuario_id = datos["usuario_ids"][i % len(datos["usuario_ids"])]
+            return await cliente.get(RUTA + f"dispositivos/usuario/{usuario_id}", headers=cabeceras)
+        resultados["dispositivos_usuario"] = await medir(dispositivos_usuario, args.peticiones, args.concurrencia, 10)
+
+    return resultados
+
+
+async def ejecutar_en_proceso(escenarios: list, args) -> dict:
+    import main
+    from database import async_engine
+    transporte = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transporte, base_url="http://bench", timeout=60) as cliente:
+            resultados = await ejecutar(cliente, escenarios, args)
+    await async_engine.dispose()
+    return resultados
+
+
+async def ejecutar_remoto(url: str, escenarios: list, args) -> dict:
+    limites = httpx.Limits(max_connections=args.concurrencia, max_keepalive_connections=args.concurrencia)
+    async with httpx.AsyncClient(base_url=url, limits=limites, timeout=60) as cliente:
+        return await ejecutar(cliente, escenarios, args)
+
+
+def commit_actual() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconocido"
+
+
+def comparar(anterior: dict, actual: dict):
+    """ Tabla de variaciones por escenario; negativo en latencia o positivo en peticiones/s es mejora """
+    print(f"{'escenario':<22}{'peticiones/s':>16}{'p50':>12}{'p99':>12}", file=sys.stderr)
+    for nombre, resultado in actual["escenarios"].items():
+        previo = anterior["escenarios"].get(nombre)
+        if previo is None:
+            continue
+        variaciones = [
+            (resultado[clave] - previo[clave]) / previo[clave] * 100 if previo[clave] else 0.0
+            for clave in ("peticiones_por_s", "p50_ms", "p99_ms")
+        ]
+        print(f"{nombre:<22}" + "".join(f"{variacion:>+11.1f}% " for variacion in variaciones), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Servidor en marcha; sin él se ejecuta en proceso")
+    parser.add_argument("--escenarios", default=",".join(ESCENARIOS))
+    parser.add_argument("--peticiones", type=int, default=2000)
+    parser.add_argument("--peticiones-login", type=int, default=100, help="bcrypt domina: menos peticiones")
+    parser.add_argument("--concurrencia", type=int, default=32)
+    parser.add_argument("--limite", type=int, default=100, help="Tamaño de página del listado de registros")
+    parser.add_argument("--salida", help="Fichero JSON con los resultados")
+    parser.add_argument("--comparar", help="JSON de una ejecución anterior")
+    # Siembra automática de la SQLite temporal
+    parser.add_argument("--usuarios", type=int, default=200)
+    parser.add_argument("--dispositivos-por-usuario", type=int, default=5)
+    parser.add_argument("--registros", type=int, default=200000)
+    args = parser.parse_args()
+
+    escenarios = [nombre for nombre in args.escenarios.split(",") if nombre]
+    desconocidos = set(escenarios) - set(ESCENARIOS)
+    if desconocidos:
+        parser.error(f"Escenarios desconocidos: {', '.join(sorted(desconocidos))}")
+
+    siembra = None
+    if args.url is None and SQLITE_TEMPORAL:
+        siembra = sembrar.sembrar(args.usuarios, args.dispositivos_por_usuario, args.registros, dias=30)
+
+    if args.url:
+        resultados = asyncio.run(ejecutar_remoto(args.url.rstrip("/"), escenarios, args))
+        base_de_datos = "remota"
+    else:
+        resultados = asyncio.run(ejecutar_en_proceso(escenarios, args))
+        base_de_datos = "sqlite temporal" if SQLITE_TEMPORAL else os.environ["DATABASE_URL"].split("://")[0]
+
+    salida = {
+        "fecha": datetime.datetime.utcnow().isoformat(),
+        "commit": commit_actual(),
+        "python": platform.python_version(),
+        "modo": "remoto" if args.url else "en proceso",
+        "base_de_datos": base_de_datos,
+        "parametros": {
+            "peticiones": args.peticiones,
+            "peticiones_login": args.peticiones_login,
+            "concurrencia": args.concurrencia,
+            "limite": args.limite,
+        },
+        "siembra": siembra,
+        "escenarios": resultados,
+    }
+    texto = json.dumps(salida, indent=2)
+    print(texto)
+    if args.salida:
+        with open(args.salida, "w") as fichero:
+            fichero.write(texto)
+    if args.comparar:
+        with open(args.comparar) as fichero:
+            comparar(json.load(fichero), salida)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheTTL:
+    """ Cache LRU acotada con caducidad por entrada y contadores de aciertos/fallos """
+
+    def __init__(self, max_entradas: int = 10000, ttl: float = 300, ttl_negativo: float = 30):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+
+    def obtener(self, clave):
+        """ Devuelve (encontrado, valor). Un valor None cacheado cuenta como encontrado """
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is not None:
+                caduca, valor = entrada
+                if caduca > ahora:
+                    self._datos.move_to_end(clave)
+                    self.aciertos += 1
+                    return True, valor
+                del self._datos[clave]
+            self.fallos += 1
+            return False, None
+
+    def guardar(self, clave, valor):
+        # Las entradas negativas (valor None) duran menos
+        ttl = self.ttl if valor is not None else self.ttl_negativo
+        with self._lock:
+            self._datos[clave] = (time.monotonic() + ttl, valor)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+                self.expulsiones += 1
+
+    def invalidar(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._datos.clear()
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                "entradas": len(self._datos),
+                "max_entradas": self.max_entradas,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "expulsiones": self.expulsiones,
+                "ratio_aciertos": self.aciertos / total if total else 0.0,
+            }
+
+
+def normalizar_mac(mac: str) -> str:
+    """ AA-bb-CC... y aa:BB:cc... se guardan bajo la misma clave """
+    return mac.strip().upper().replace("-", ":")
+
+
+def variantes_mac(mac: str) -> set:
+    """ Formas en las que una MAC puede estar guardada en la base de datos """
+    normalizada = normalizar_mac(mac)
+    guiones = normalizada.replace(":", "-")
+    return {mac, normalizada, guiones, normalizada.lower(), guiones.lower()}
@@ -0,0 +1,44 @@
+from sqlalchemy import event
+
+
+class ContadorConsultas:
+    """ Cuenta las sentencias SQL que se ejecutan sobre un engine dentro de un bloque with """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.sentencias = []
+
+    @property
+    def total(self) -> int:
+        return len(self.sentencias)
+
+    def _registrar(self, conn, cursor, sentencia, parametros, contexto, executemany):
+        self.sentencias.append(sentencia)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._registrar)
+        return self
+
+    def __exit__(self, *excepcion):
+        event.remove(self.engine, "before_cursor_execute", self._registrar)
+        return False
+
+
+def comprobar_consultas_constantes(engine, peticiones: dict, sembrar, tamanos=(1, 10, 50)) -> dict:
+    """
+    Siembra cada tamaño de filas con `sembrar(n)`, ejecuta cada petición de `peticiones` (nombre -> función)
+    y falla si el número de consultas de alguna cambia con el número de filas (señal de un N+1 por cargas
+    perezosas). Devuelve {nombre: {tamaño: consultas}}.
+    """
+    conteos = {nombre: {} for nombre in peticiones}
+    for tamano in tamanos:
+        sembrar(tamano)
+        for nombre, peticion in peticiones.items():
+            with ContadorConsultas(engine) as contador:
+                peticion()
+            conteos[nombre][tamano] = contador.total
+
+    crecen = {nombre: conteo for nombre, conteo in conteos.items() if len(set(conteo.values())) > 1}
+    if crecen:
+        raise AssertionError(f"El número de consultas crece con las filas: {crecen}")
+    return conteos
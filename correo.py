@@ -0,0 +1,182 @@
+import heapq
+import itertools
+import logging
+import queue
+import smtplib
+import threading
+import time
+from dataclasses import dataclass
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Correo:
+    destinatario: str
+    asunto: str
+    cuerpo: str
+    intentos: int = 0
+    ultimo_error: Optional[str] = None
+
+
+class ColaCorreo:
+    """
+    Cola de correo saliente atendida por un hilo en segundo plano.
+    Reutiliza una única conexión SMTP, envía por lotes y reintenta con espera exponencial;
+    los correos que agotan los intentos se pasan a `al_fallar` (registro de fallidos).
+    """
+
+    def __init__(
+        self,
+        host: str,
+        puerto: int,
+        remitente: str,
+        usuario: Optional[str] = None,
+        password: Optional[str] = None,
+        starttls: bool = True,
+        tam_lote: int = 20,
+        max_intentos: int = 5,
+        espera_base: float = 2.0,
+        max_cola: int = 1000,
+        inactividad: float = 60.0,
+        al_fallar: Optional[Callable[[Correo], None]] = None,
+    ):
+        self.host = host
+        self.puerto = puerto
+        self.remitente = remitente
+        self.usuario = usuario
+        self.password = password
+        self.starttls = starttls
+        self.tam_lote = tam_lote
+        self.max_intentos = max_intentos
+        self.espera_base = espera_base
+        self.inactividad = inactividad
+        self.al_fallar = al_fallar
+
+        self._cola = queue.Queue(maxsize=max_cola)
+        self._reintentos = []  # heap de (cuando, secuencia, correo)
+        self._secuencia = itertools.count()
+        self._smtp = None
+        self._ultimo_uso = 0.0
+        self._parar = threading.Event()
+        self._hilo = None
+
+    def iniciar(self):
+        if self._hilo is None:
+            self._parar.clear()
+            self._hilo = threading.Thread(target=self._bucle, name="cola-correo", daemon=True)
+            self._hilo.start()
+
+    def detener(self, timeout: float = 10.0):
+        """ Envía lo que quede en la cola (hasta `timeout` segundos) y cierra la conexión """
+        if self._hilo is not None:
+            self._parar.set()
+            self._hilo.join(timeout)
+            self._hilo = None
+        self._desconectar()
+
+    def encolar(self, destinatario: str, asunto: str, cuerpo: str) -> bool:
+        """ Devuelve False si la cola está llena """
+        try:
+            self._cola.put_nowait(Correo(destinatario, asunto, cuerpo))
+            return True
+        except queue.Full:
+            return False
+
+    def pendientes(self) -> int:
+        return self._cola.qsize() + len(self._reintentos)
+
+    def _bucle(self):
+        while not (self._parar.is_set() and self._cola.empty()):
+            lote = self._siguiente_lote()
+            if lote:
+                self._enviar_lote(lote)
+            elif self._smtp is not None and time.monotonic() - self._ultimo_uso > self.inactividad:
+                self._desconectar()
+        # Al parar, los reintentos pendientes se dan por fallidos
+        while self._reintentos:
+            self._fallido(heapq.heappop(self._reintentos)[2])
+
+    def _siguiente_lote(self) -> list:
+        lote = []
+        ahora = time.monotonic()
+        while self._reintentos and self._reintentos[0][0] <= ahora and len(lote) < self.tam_lote:
+            lote.append(heapq.heappop(self._reintentos)[2])
+
+        espera = 1.0
+        if self._reintentos:
+            espera = min(espera, max(0.0, self._reintentos[0][0] - ahora))
+        try:
+            if not lote:
+                lote.append(self._cola.get(timeout=espera))
+            while len(lote) < self.tam_lote:
+                lote.append(self._cola.get_nowait())
+        except queue.Empty:
+            pass
+        return lote
+
+    def _conectar(self):
+        if self._smtp is not None:
+            # Dentro de un lote la conexión se acaba de usar; si lleva un rato parada se comprueba
+            if time.monotonic() - self._ultimo_uso < 5:
+                return self._smtp
+            try:
+                self._smtp.noop()
+                return self._smtp
+            except (smtplib.SMTPException, OSError):
+                self._desconectar()
+        smtp = smtplib.SMTP(self.host, self.puerto, timeout=30)
+        if self.starttls:
+            smtp.starttls()
+        if self.usuario:
+            smtp.login(self.usuario, self.password)
+        self._smtp = smtp
+        return smtp
+
+    def _desconectar(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._smtp = None
+
+    def _enviar_lote(self, lote: list):
+        for correo in lote:
+            try:
+                smtp = self._conectar()
+                smtp.sendmail(self.remitente, correo.destinatario, self._componer(correo))
+                self._ultimo_uso = time.monotonic()
+            except Exception as e:
+                # La conexión puede haber quedado inservible: se reabre en el siguiente envío
+                self._desconectar()
+                correo.intentos += 1
+                correo.ultimo_error = str(e) or e.__class__.__name__
+                if not isinstance(e, (smtplib.SMTPException, OSError)):
+                    # Un correo mal formado (p. ej. sin destinatario) no se arregla reintentando;
+                    # no debe tumbar el hilo ni retener al resto de la cola
+                    logger.error("Correo descartado a %r: %s", correo.destinatario, correo.ultimo_error)
+                    self._fallido(correo)
+                elif correo.intentos >= self.max_intentos:
+                    self._fallido(correo)
+                else:
+                    cuando = time.monotonic() + self.espera_base * 2 ** (correo.intentos - 1)
+                    heapq.heappush(self._reintentos, (cuando, next(self._secuencia), correo))
+
+    def _componer(self, correo: Correo) -> str:
+        mensaje = MIMEMultipart()
+        mensaje['From'] = self.remitente
+        mensaje['To'] = correo.destinatario
+        mensaje['Subject'] = correo.asunto
+        mensaje.attach(MIMEText(correo.cuerpo, 'plain', 'utf-8'))
+        return mensaje.as_string()
+
+    def _fallido(self, correo: Correo):
+        if self.al_fallar is not None:
+            try:
+                self.al_fallar(correo)
+            except Exception as e:
+                logger.error("Error al registrar correo fallido: %s", e)
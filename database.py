@@ -1,23 +1,59 @@
+import asyncio
 import os
-from sqlalchemy import create_engine, Column, String, Boolean, ForeignKey, DateTime, Integer, select
+import random
+import time
+from sqlalchemy import create_engine, event, text, Column, String, Text, Boolean, ForeignKey, DateTime, Integer, Float, Index, select
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 import datetime
-from passlib.context import CryptContext
+import json
+import logging
 from dotenv import load_dotenv
+from hashing import get_password_hash
+import observabilidad
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 usuarioDb = os.getenv("BBDD_USER")
 passwordDb = os.getenv("BBDD_PASSWORD")
-DATABASE_URL = f"postgresql://{usuarioDb}:{passwordDb}@db:5432/postgres"
-engine = create_engine(DATABASE_URL)
+DATABASE_URL = os.getenv("DATABASE_URL", f"postgresql://{usuarioDb}:{passwordDb}@db:5432/postgres")
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1))
+
+# Ajustes del pool de conexiones (ver Kubernetes/app-config.yaml)
+opciones_pool = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", "30")),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+}
 
+# Crear los engines no abre conexiones: la primera se hace en esperar_bbdd() durante el arranque
+engine = create_engine(DATABASE_URL, poolclass=observabilidad.QueuePoolMedido, **opciones_pool)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+# Variante asíncrona para los endpoints calientes (ingesta y comprobación del token)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=observabilidad.AsyncQueuePoolMedido, **opciones_pool)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# SQLite no aplica ON DELETE CASCADE salvo que se active en cada conexión
+def _activar_claves_foraneas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", _activar_claves_foraneas)
+if async_engine.dialect.name == "sqlite":
+    event.listen(async_engine.sync_engine, "connect", _activar_claves_foraneas)
+
+# Número y duración de las consultas para /metrics
+observabilidad.instrumentar_engine(engine, "sync")
+observabilidad.instrumentar_engine(async_engine.sync_engine, "async")
+Base = declarative_base()
 
 class UsuarioDB(Base):
     __tablename__ = "usuarios"
@@ -28,7 +64,8 @@ class UsuarioDB(Base):
     email = Column(String, unique=True, index=True, nullable=True)
     rol_id = Column(Integer, ForeignKey("roles.id"))
 
-    dispositivos = relationship("DispositivoDB", back_populates="usuario", cascade="all, delete")
+    # passive_deletes: el borrado en cascada lo hace la BBDD sin cargar los hijos en el ORM
+    dispositivos = relationship("DispositivoDB", back_populates="usuario", cascade="all, delete", passive_deletes=True)
     rol = relationship("RolDB", back_populates="usuarios")
 
 class DispositivoDB(Base):
@@ -41,18 +78,102 @@ class DispositivoDB(Base):
     usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"))
 
     usuario = relationship("UsuarioDB", back_populates="dispositivos")
-    registros = relationship("RegistroDB", back_populates="dispositivo", cascade="all, delete")
+    registros = relationship("RegistroDB", back_populates="dispositivo", cascade="all, delete", passive_deletes=True)
 
 class RegistroDB(Base):
     __tablename__ = "registros"
 
     id = Column(Integer, primary_key=True, index=True)
     fecha = Column(DateTime, default=datetime.datetime.utcnow)
-    coordenadas = Column(String)
+    latitud = Column(Float)
+    longitud = Column(Float)
+    altitud = Column(Float, nullable=True)
+    velocidad = Column(Float, nullable=True)  # km/h
     dispositivo_id = Column(Integer, ForeignKey("dispositivos.id", ondelete="CASCADE"))
 
     dispositivo = relationship("DispositivoDB", back_populates="registros")
 
+    __table_args__ = (
+        Index("ix_registros_lat_lon", "latitud", "longitud"),
+        Index("ix_registros_dispositivo_fecha", "dispositivo_id", "fecha"),
+        Index("ix_registros_fecha_id", "fecha", "id"),
+    )
+
+    @property
+    def coordenadas(self):
+        # Formato "lat,lon" que siguen esperando los clientes
+        if self.latitud is None or self.longitud is None:
+            return None
+        return f"{self.latitud},{self.longitud}"
+
+class ResumenHorarioDB(Base):
+    """ Agregado por dispositivo y hora de los registros que ya han salido del periodo de retención """
+    __tablename__ = "resumen_horario"
+
+    dispositivo_id = Column(Integer, ForeignKey("dispositivos.id", ondelete="CASCADE"), primary_key=True)
+    hora = Column(DateTime, primary_key=True)
+    num_registros = Column(Integer)
+    latitud_media = Column(Float)
+    longitud_media = Column(Float)
+    latitud_min = Column(Float)
+    latitud_max = Column(Float)
+    longitud_min = Column(Float)
+    longitud_max = Column(Float)
+    velocidad_max = Column(Float, nullable=True)
+
+class UltimaPosicionDB(Base):
+    """ Último fix de cada dispositivo, mantenido en cada ingesta para no recorrer el historial """
+    __tablename__ = "ultimas_posiciones"
+
+    dispositivo_id = Column(Integer, ForeignKey("dispositivos.id", ondelete="CASCADE"), primary_key=True)
+    registro_id = Column(Integer)
+    fecha = Column(DateTime)
+    latitud = Column(Float)
+    longitud = Column(Float)
+    altitud = Column(Float, nullable=True)
+    velocidad = Column(Float, nullable=True)
+    actualizado = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+    @property
+    def coordenadas(self):
+        return f"{self.latitud},{self.longitud}"
+
+class GeocercaDB(Base):
+    """ Zona (círculo o polígono) de un dispositivo concreto o de todos los dispositivos de un usuario """
+    __tablename__ = "geocercas"
+
+    id = Column(Integer, primary_key=True, index=True)
+    nombre = Column(String)
+    tipo = Column(String)  # "circulo" | "poligono"
+    latitud = Column(Float, nullable=True)
+    longitud = Column(Float, nullable=True)
+    radio = Column(Float, nullable=True)  # metros
+    vertices_json = Column(Text, nullable=True)  # [[lat, lon], ...]
+    dispositivo_id = Column(Integer, ForeignKey("dispositivos.id", ondelete="CASCADE"), nullable=True, index=True)
+    usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=True, index=True)
+    activa = Column(Boolean, default=True)
+    creada = Column(DateTime, default=datetime.datetime.utcnow)
+
+    @property
+    def vertices(self):
+        return json.loads(self.vertices_json) if self.vertices_json else None
+
+class EventoGeocercaDB(Base):
+    __tablename__ = "eventos_geocerca"
+    __table_args__ = (
+        Index("ix_eventos_geocerca_geocerca_fecha", "geocerca_id", "fecha", "id"),
+        Index("ix_eventos_geocerca_dispositivo_fecha", "dispositivo_id", "fecha"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    geocerca_id = Column(Integer, ForeignKey("geocercas.id", ondelete="CASCADE"))
+    dispositivo_id = Column(Integer, ForeignKey("dispositivos.id", ondelete="CASCADE"))
+    registro_id = Column(Integer)
+    tipo = Column(String)  # "entrada" | "salida"
+    fecha = Column(DateTime)
+    latitud = Column(Float)
+    longitud = Column(Float)
+
 class RolDB(Base):
     __tablename__ = "roles"
 
@@ -60,12 +181,23 @@ class RolDB(Base):
     nombre = Column(String, unique=True, index=True)   
     usuarios = relationship("UsuarioDB", back_populates="rol", cascade="all, delete")  
 
+class CorreoFallidoDB(Base):
+    __tablename__ = "correos_fallidos"
+
+    id = Column(Integer, primary_key=True, index=True)
+    fecha = Column(DateTime, default=datetime.datetime.utcnow)
+    destinatario = Column(String)
+    asunto = Column(String)
+    cuerpo = Column(String)
+    intentos = Column(Integer)
+    error = Column(String)
+
 def create_initial_roles_and_root():
-    print("Analizando si existen roles...")
+    logger.info("Analizando si existen roles...")
     with SessionLocal() as db:
         roles_exist = db.execute(select(RolDB).limit(1)).first()
         if not roles_exist:
-            print("No existen roles. Creando roles y usuario root...")
+            logger.info("No existen roles. Creando roles y usuario root...")
             root_role = RolDB(nombre="root")
             admin_role = RolDB(nombre="admin")
             user_role = RolDB(nombre="user")
@@ -81,9 +213,50 @@ def create_initial_roles_and_root():
             )
             db.add(root_user)
             db.commit()
-            print("Roles y usuario root creados.")
+            logger.info("Roles y usuario root creados.")
         else:
-            print("Roles ya existen. No se hizo nada.")
+            logger.info("Roles ya existen. No se hizo nada.")
+
+def inicializar_bbdd():
+    """ Esquema y datos iniciales; lo ejecuta `python migraciones.py`, no el arranque de la API """
+    Base.metadata.create_all(bind=engine)
+    create_initial_roles_and_root()
+
+
+# Reintentos de la primera conexión: la BBDD puede tardar en estar lista al arrancar el pod o el compose
+BBDD_REINTENTOS = int(os.getenv("BBDD_REINTENTOS", "10"))
+BBDD_ESPERA_MAX = float(os.getenv("BBDD_ESPERA_MAX", "10"))
+
+
+def _espera(intento: int) -> float:
+    """ Backoff exponencial con jitter: 0.5, 1, 2, 4... segundos hasta BBDD_ESPERA_MAX """
+    return min(BBDD_ESPERA_MAX, 0.5 * 2 ** intento) * random.uniform(0.5, 1.0)
+
+
+def esperar_bbdd_sync(intentos: int = BBDD_REINTENTOS):
+    for intento in range(intentos):
+        try:
+            with engine.connect() as conn:
+                conn.execute(text("SELECT 1"))
+            return
+        except (DBAPIError, OSError) as e:
+            if intento == intentos - 1:
+                raise
+            espera = _espera(intento)
+            logger.warning("BBDD no disponible (%s); reintento en %.1f s", e.__class__.__name__, espera)
+            time.sleep(espera)
+
 
-Base.metadata.create_all(bind=engine)
-create_initial_roles_and_root()  
+async def esperar_bbdd(intentos: int = BBDD_REINTENTOS):
+    """ Abre la primera conexión del pool asíncrono; si se agotan los intentos el arranque falla """
+    for intento in range(intentos):
+        try:
+            async with async_engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+            return
+        except (DBAPIError, OSError) as e:
+            if intento == intentos - 1:
+                raise
+            espera = _espera(intento)
+            logger.warning("BBDD no disponible (%s); reintento en %.1f s", e.__class__.__name__, espera)
+            await asyncio.sleep(espera)  
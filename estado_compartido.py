@@ -0,0 +1,350 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Estado compartido entre workers y pods: pub/sub de mensajes JSON (invalidaciones de cache, cambios de geocercas,
+# posiciones en tiempo real) y contadores con caducidad (límites de ritmo).
+# - EstadoMemoria: un solo proceso; publicar no hace nada porque no hay nadie más a quien avisar.
+# - EstadoRedis: cliente RESP propio sobre asyncio (PUBLISH/SUBSCRIBE, SET NX PX, INCRBY, PING), sin dependencias.
+# Los mensajes propios no se reciben: quien publica ya ha aplicado el cambio en su proceso.
+
+
+class EstadoCompartido:
+    """ Interfaz común; los manejadores se llaman en el event loop con los mensajes de otros procesos """
+    distribuido = False  # False: no hay otros procesos a los que avisar
+
+    def __init__(self):
+        self.origen = uuid.uuid4().hex
+        self._manejadores = defaultdict(list)
+        self.publicados = 0
+        self.recibidos = 0
+        self.perdidos = 0
+
+    def suscribir(self, canal: str, manejador: Callable[[dict], None]):
+        self._manejadores[canal].append(manejador)
+
+    def publicar(self, canal: str, mensaje: dict):
+        """ No bloquea y se puede llamar desde cualquier hilo (los endpoints síncronos corren en el threadpool) """
+        raise NotImplementedError
+
+    async def incrementar(self, clave: str, cantidad: int = 1, ttl: float = 1.0) -> int:
+        """ Suma `cantidad` a un contador que caduca `ttl` segundos después de crearse; devuelve el total """
+        raise NotImplementedError
+
+    async def incrementar_varios(self, claves: list, cantidad: int = 1, ttl: float = 1.0) -> list:
+        """ `incrementar` de varias claves (en Redis, en un solo viaje); con cantidad 0 solo las lee """
+        return [await self.incrementar(clave, cantidad, ttl) for clave in claves]
+
+    async def ping(self) -> bool:
+        return True
+
+    async def iniciar(self):
+        pass
+
+    async def detener(self):
+        pass
+
+    def _entregar(self, canal: str, sobre: dict):
+        if sobre.get("o") == self.origen:
+            return
+        self.recibidos += 1
+        for manejador in self._manejadores.get(canal, ()):
+            try:
+                manejador(sobre["m"])
+            except Exception:
+                logger.exception("Error al aplicar un mensaje de %s", canal)
+
+    def estadisticas(self) -> dict:
+        return {
+            "backend": self.__class__.__name__,
+            "publicados": self.publicados,
+            "recibidos": self.recibidos,
+            "perdidos": self.perdidos,
+        }
+
+
+class EstadoMemoria(EstadoCompartido):
+
+    def __init__(self):
+        super().__init__()
+        self._contadores = {}
+
+    def publicar(self, canal: str, mensaje: dict):
+        self.publicados += 1
+
+    async def incrementar(self, clave: str, cantidad: int = 1, ttl: float = 1.0) -> int:
+        ahora = time.monotonic()
+        caduca, valor = self._contadores.get(clave, (0.0, 0))
+        if caduca <= ahora:
+            caduca, valor = ahora + ttl, 0
+            if len(self._contadores) > 100000:
+                self._purgar(ahora)
+        valor += cantidad
+        self._contadores[clave] = (caduca, valor)
+        return valor
+
+    def _purgar(self, ahora: float):
+        for clave in [clave for clave, (caduca, _) in self._contadores.items() if caduca <= ahora]:
+            del self._contadores[clave]
+
+
+class ErrorRESP(Exception):
+    pass
+
+
+def _codificar(*argumentos) -> bytes:
+    partes = [b"*%d\r\n" % len(argumentos)]
+    for argumento in argumentos:
+        if not isinstance(argumento, bytes):
+            argumento = str(argumento).encode()
+        partes.append(b"$%d\r\n%s\r\n" % (len(argumento), argumento))
+    return b"".join(partes)
+
+
+async def _leer_respuesta(lector: asyncio.StreamReader):
+    linea = await lector.readline()
+    if not linea:
+        raise ConnectionError("Conexión cerrada por el servidor")
+    tipo, resto = linea[:1], linea[1:-2]
+    if tipo == b"+":
+        return resto.decode()
+    if tipo == b"-":
+        raise ErrorRESP(resto.decode())
+    if tipo == b":":
+        return int(resto)
+    if tipo == b"$":
+        longitud = int(resto)
+        if longitud < 0:
+            return None
+        datos = await lector.readexactly(longitud + 2)
+        return datos[:-2]
+    if tipo == b"*":
+        cantidad = int(resto)
+        if cantidad < 0:
+            return None
+        return [await _leer_respuesta(lector) for _ in range(cantidad)]
+    raise ConnectionError(f"Respuesta RESP inesperada: {linea!r}")
+
+
+class ConexionRESP:
+    """ Una conexión con pipelining: los comandos se envían juntos y las respuestas llegan en el mismo orden """
+
+    def __init__(self, host: str, puerto: int, bbdd: int = 0, password: Optional[str] = None):
+        self.host = host
+        self.puerto = puerto
+        self.bbdd = bbdd
+        self.password = password
+        self.lector = None
+        self.escritor = None
+        self._lock = asyncio.Lock()
+
+    async def abrir(self):
+        self.lector, self.escritor = await asyncio.open_connection(self.host, self.puerto)
+        try:
+            if self.password:
+                await self._ejecutar([("AUTH", self.password)])
+            if self.bbdd:
+                await self._ejecutar([("SELECT", self.bbdd)])
+        except BaseException:
+            self.cerrar()
+            raise
+
+    def cerrar(self):
+        if self.escritor is not None:
+            self.escritor.close()
+        self.lector = self.escritor = None
+
+    async def ejecutar(self, *comandos) -> list:
+        """ Reabre la conexión si hace falta; si falla la deja cerrada y propaga el error """
+        async with self._lock:
+            try:
+                if self.escritor is None:
+                    await self.abrir()
+                return await self._ejecutar(comandos)
+            except ErrorRESP:
+                # Ya se han leído todas las respuestas: la conexión sigue sincronizada
+                raise
+            except BaseException:
+                # Error de red o cancelación (p. ej. por wait_for) con respuestas sin leer en el socket:
+                # reutilizarla haría que el siguiente comando leyera una respuesta ajena
+                self.cerrar()
+                raise
+
+    async def _ejecutar(self, comandos) -> list:
+        self.escritor.write(b"".join(_codificar(*comando) for comando in comandos))
+        await self.escritor.drain()
+        respuestas = []
+        error = None
+        for _ in comandos:
+            try:
+                respuestas.append(await _leer_respuesta(self.lector))
+            except ErrorRESP as e:
+                # Se leen todas las respuestas para no desincronizar la conexión
+                error = error or e
+                respuestas.append(None)
+        if error is not None:
+            raise error
+        return respuestas
+
+
+class EstadoRedis(EstadoCompartido):
+    """
+    redis://[:password@]host:puerto/bbdd. Los mensajes se encolan sin bloquear y una tarea los envía en pipeline;
+    otra mantiene la suscripción y se reconecta con espera exponencial. Si Redis cae, lo publicado mientras tanto
+    se pierde (las caches caducan por TTL igualmente) y los contadores fallan con ConnectionError
+    """
+    distribuido = True
+
+    def __init__(self, url: str, max_pendientes: int = 10000, timeout: float = 2.0):
+        super().__init__()
+        partes = urlparse(url)
+        self.host = partes.hostname or "localhost"
+        self.puerto = partes.port or 6379
+        self.bbdd = int(partes.path.lstrip("/") or 0)
+        self.password = partes.password
+        self.max_pendientes = max_pendientes
+        self.timeout = timeout
+        self._comandos = ConexionRESP(self.host, self.puerto, self.bbdd, self.password)
+        self._loop = None
+        self._cola = None
+        self._tareas = []
+        self.suscrito = False
+        self.reconexiones = 0
+
+    async def iniciar(self):
+        self._loop = asyncio.get_running_loop()
+        self._cola = asyncio.Queue(maxsize=self.max_pendientes)
+        self._tareas = [asyncio.create_task(self._bucle_envio()), asyncio.create_task(self._bucle_suscripcion())]
+
+    async def detener(self):
+        if self._cola is not None:
+            # Da una oportunidad a lo pendiente antes de cortar
+            try:
+                await asyncio.wait_for(self._cola.join(), self.timeout)
+            except asyncio.TimeoutError:
+                pass
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+        self._comandos.cerrar()
+
+    def publicar(self, canal: str, mensaje: dict):
+        if self._loop is None:
+            return
+        datos = json.dumps({"o": self.origen, "m": mensaje}, default=str)
+        try:
+            en_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            en_loop = False
+        if en_loop:
+            self._encolar(canal, datos)
+        else:
+            self._loop.call_soon_threadsafe(self._encolar, canal, datos)
+
+    def _encolar(self, canal: str, datos: str):
+        try:
+            self._cola.put_nowait((canal, datos))
+        except asyncio.QueueFull:
+            self.perdidos += 1
+
+    async def _bucle_envio(self):
+        espera = 0.1
+        while True:
+            lote = [await self._cola.get()]
+            while not self._cola.empty() and len(lote) < 500:
+                lote.append(self._cola.get_nowait())
+            try:
+                await asyncio.wait_for(
+                    self._comandos.ejecutar(*(("PUBLISH", canal, datos) for canal, datos in lote)), self.timeout
+                )
+                self.publicados += len(lote)
+                espera = 0.1
+            except (OSError, ConnectionError, ErrorRESP, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                self.perdidos += len(lote)
+                self._comandos.cerrar()
+                logger.warning("No se pudieron publicar %d mensajes en Redis: %s", len(lote), e)
+                await asyncio.sleep(espera)
+                espera = min(espera * 2, 5.0)
+            finally:
+                for _ in lote:
+                    self._cola.task_done()
+
+    async def _bucle_suscripcion(self):
+        espera = 0.1
+        while True:
+            conexion = ConexionRESP(self.host, self.puerto, self.bbdd, self.password)
+            try:
+                await conexion.abrir()
+                canales = list(self._manejadores)
+                conexion.escritor.write(_codificar("SUBSCRIBE", *canales))
+                await conexion.escritor.drain()
+                while True:
+                    respuesta = await _leer_respuesta(conexion.lector)
+                    tipo = respuesta[0]
+                    if tipo == b"subscribe":
+                        self.suscrito = True
+                        espera = 0.1
+                    elif tipo == b"message":
+                        self._entregar(respuesta[1].decode(), json.loads(respuesta[2]))
+            except asyncio.CancelledError:
+                raise
+            except (OSError, ConnectionError, ErrorRESP, asyncio.IncompleteReadError) as e:
+                if self.suscrito:
+                    logger.warning("Suscripción a Redis perdida: %s", e)
+                self.suscrito = False
+                self.reconexiones += 1
+                await asyncio.sleep(espera)
+                espera = min(espera * 2, 5.0)
+            finally:
+                conexion.cerrar()
+
+    async def incrementar(self, clave: str, cantidad: int = 1, ttl: float = 1.0) -> int:
+        # SET NX PX crea el contador con su caducidad; así nunca queda una clave sin TTL
+        _, valor = await asyncio.wait_for(self._comandos.ejecutar(
+            ("SET", clave, 0, "PX", max(1, int(ttl * 1000)), "NX"),
+            ("INCRBY", clave, cantidad),
+        ), self.timeout)
+        return valor
+
+    async def incrementar_varios(self, claves: list, cantidad: int = 1, ttl: float = 1.0) -> list:
+        if not claves:
+            return []
+        milisegundos = max(1, int(ttl * 1000))
+        comandos = []
+        for clave in claves:
+            comandos.append(("SET", clave, 0, "PX", milisegundos, "NX"))
+            comandos.append(("INCRBY", clave, cantidad))
+        respuestas = await asyncio.wait_for(self._comandos.ejecutar(*comandos), self.timeout)
+        return respuestas[1::2]
+
+    async def ping(self) -> bool:
+        try:
+            respuesta, = await asyncio.wait_for(self._comandos.ejecutar(("PING",)), self.timeout)
+        except (OSError, ConnectionError, ErrorRESP, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return False
+        return respuesta == "PONG" and self.suscrito
+
+    def estadisticas(self) -> dict:
+        return {
+            **super().estadisticas(),
+            "pendientes": self._cola.qsize() if self._cola is not None else 0,
+            "suscrito": self.suscrito,
+            "reconexiones": self.reconexiones,
+        }
+
+
+def crear_estado(url: Optional[str]) -> EstadoCompartido:
+    """ Sin URL (o "memoria") el estado vive en el proceso: vale solo con un worker """
+    if not url or url == "memoria":
+        return EstadoMemoria()
+    if urlparse(url).scheme != "redis":
+        raise ValueError(f"Backend de estado compartido no soportado: {url}")
+    return EstadoRedis(url)
@@ -0,0 +1,102 @@
+import csv
+import datetime
+import io
+import struct
+import zlib
+from typing import Iterable
+
+import numpy as np
+
+# Exportación de registros en flujo: cada lote de filas se escribe y se envía antes de leer el siguiente,
+# así que la memoria no depende del tamaño de la exportación.
+# - "csv": CSV comprimido con gzip, con una fila de cabecera (salvo al reanudar).
+# - "columnar" (little endian), para cargar con NumPy sin parsear texto:
+#     cabecera  "GX" | versión u8 | número de columnas u8                                       -> 4 bytes
+#     bloque    filas u32 | cada columna seguida: `filas` valores de 8 bytes
+#     fin       bloque de 0 filas; si no llega, la descarga está incompleta
+#   columnas: id i64 | fecha i64 (µs Unix) | dispositivo_id i64 | latitud, longitud, altitud, velocidad f64
+#   (NaN = sin dato)
+COLUMNAS = ("id", "fecha", "dispositivo_id", "latitud", "longitud", "altitud", "velocidad")
+TIPOS = ("<i8", "<i8", "<i8", "<f8", "<f8", "<f8", "<f8")
+MAGIA = b"GX"
+VERSION = 1
+CABECERA = struct.Struct("<2sBB")
+BLOQUE = struct.Struct("<I")
+EPOCA = datetime.datetime(1970, 1, 1)
+MICROSEGUNDO = datetime.timedelta(microseconds=1)
+
+FORMATO_CSV = "csv"
+FORMATO_COLUMNAR = "columnar"
+# formato -> (media type, nombre de fichero)
+FORMATOS = {
+    FORMATO_CSV: ("application/gzip", "registros.csv.gz"),
+    FORMATO_COLUMNAR: ("application/octet-stream", "registros.gx"),
+}
+
+
+def csv_gzip(lotes: Iterable[list], cabecera: bool = True):
+    """ `lotes` produce listas de tuplas en el orden de COLUMNAS """
+    compresor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: formato gzip
+    texto = io.StringIO()
+    escritor = csv.writer(texto, lineterminator="\n")
+    if cabecera:
+        escritor.writerow(COLUMNAS)
+    for lote in lotes:
+        escritor.writerows(
+            (id_, fecha.isoformat(), dispositivo_id, latitud, longitud, altitud, velocidad)
+            for id_, fecha, dispositivo_id, latitud, longitud, altitud, velocidad in lote
+        )
+        comprimido = compresor.compress(texto.getvalue().encode())
+        texto.seek(0)
+        texto.truncate()
+        if comprimido:
+            yield comprimido
+    yield compresor.compress(texto.getvalue().encode()) + compresor.flush()
+
+
+def columnar(lotes: Iterable[list]):
+    yield CABECERA.pack(MAGIA, VERSION, len(COLUMNAS))
+    for lote in lotes:
+        if not lote:
+            continue
+        id_, fecha, dispositivo_id, latitud, longitud, altitud, velocidad = zip(*lote)
+        columnas = (
+            np.array(id_, dtype=TIPOS[0]),
+            np.array([(valor - EPOCA) // MICROSEGUNDO for valor in fecha], dtype=TIPOS[1]),
+            np.array(dispositivo_id, dtype=TIPOS[2]),
+            # None pasa a NaN al convertir a float
+            np.array(latitud, dtype=TIPOS[3]),
+            np.array(longitud, dtype=TIPOS[4]),
+            np.array(altitud, dtype=TIPOS[5]),
+            np.array(velocidad, dtype=TIPOS[6]),
+        )
+        yield BLOQUE.pack(len(lote)) + b"".join(columna.tobytes() for columna in columnas)
+    yield BLOQUE.pack(0)
+
+
+def leer_columnar(datos: bytes) -> dict:
+    """ Columnas como arrays de NumPy (fecha en datetime64[us]); ValueError si el fichero está incompleto """
+    magia, version, numero = CABECERA.unpack_from(datos, 0)
+    if magia != MAGIA or version != VERSION or numero != len(COLUMNAS):
+        raise ValueError("No es una exportación columnar compatible")
+    partes = {columna: [] for columna in COLUMNAS}
+    posicion = CABECERA.size
+    while True:
+        if posicion + BLOQUE.size > len(datos):
+            raise ValueError("Exportación incompleta: falta el bloque final")
+        filas, = BLOQUE.unpack_from(datos, posicion)
+        posicion += BLOQUE.size
+        if filas == 0:
+            break
+        for columna, tipo in zip(COLUMNAS, TIPOS):
+            fin = posicion + filas * 8
+            if fin > len(datos):
+                raise ValueError("Exportación incompleta: bloque cortado")
+            partes[columna].append(np.frombuffer(datos, dtype=tipo, count=filas, offset=posicion))
+            posicion = fin
+    resultado = {
+        columna: np.concatenate(bloques) if bloques else np.empty(0, dtype=tipo)
+        for (columna, bloques), tipo in zip(partes.items(), TIPOS)
+    }
+    resultado["fecha"] = resultado["fecha"].astype("datetime64[us]")
+    return resultado
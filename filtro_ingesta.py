@@ -0,0 +1,186 @@
+import datetime
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from geocercas import METROS_POR_GRADO, distancia_m
+
+logger = logging.getLogger(__name__)
+
+MOTIVO_LIMITE = "Límite de envíos superado"
+MOTIVO_DUPLICADO = "Fix duplicado"
+
+
+class _Estado:
+    __slots__ = ("fichas", "instante", "ultimo")
+
+    def __init__(self, fichas: float, instante: float):
+        self.fichas = fichas
+        self.instante = instante
+        self.ultimo = None  # (fecha, latitud, longitud) del último fix aceptado
+
+
+class FiltroIngesta:
+    """
+    Filtro delante de la escritura en BBDD, por dispositivo:
+    - Cubo de fichas: cada envío (petición, trama o datagrama) gasta una ficha, hay `rafaga` como mucho y se
+      recuperan `envios_por_s` por segundo. Se cuentan envíos y no fixes: un lote atrasado es una sola escritura.
+    - Duplicados: se descarta un fix a `metros` o menos y a menos de `segundos` (por su fecha) del último fix
+      aceptado del dispositivo, lo que incluye el mismo fix reenviado.
+    El último fix se recuerda al escribir: envíos simultáneos del mismo dispositivo se comparan con el anterior.
+    El estado de cada proceso vive en un LRU de `max_dispositivos`. Con un `estado` distribuido (varios workers
+    o pods) se comprueba además contra contadores compartidos, para que el límite y los reenvíos que caen en
+    otro worker cuenten igual: `rafaga` envíos por ventana de `rafaga / envios_por_s` segundos, y un fix por
+    celda de `metros` y ventana de `segundos`. Si el estado compartido falla se aplica solo el filtro local.
+    `envios_por_s` <= 0 desactiva el límite y `segundos` <= 0 los duplicados.
+    """
+
+    def __init__(self, envios_por_s: float = 2, rafaga: int = 10, metros: float = 0, segundos: float = 1,
+                 max_dispositivos: int = 100000, estado=None):
+        self.envios_por_s = envios_por_s
+        self.rafaga = rafaga
+        self.metros = metros
+        self.segundos = segundos
+        self.max_dispositivos = max_dispositivos
+        self.estado = estado
+        self._estados = OrderedDict()
+        self._lock = threading.Lock()
+        self._compartido_caido = False
+        self.limitados = 0
+        self.duplicados = 0
+        self.errores_compartido = 0
+
+    @property
+    def _compartido(self) -> bool:
+        return self.estado is not None and self.estado.distribuido
+
+    def _estado(self, dispositivo_id: int, ahora: float) -> _Estado:
+        estado = self._estados.get(dispositivo_id)
+        if estado is None:
+            estado = self._estados[dispositivo_id] = _Estado(self.rafaga, ahora)
+            while len(self._estados) > self.max_dispositivos:
+                self._estados.popitem(last=False)
+        else:
+            self._estados.move_to_end(dispositivo_id)
+        return estado
+
+    async def _contadores(self, claves: list, cantidad: int, ttl: float) -> Optional[list]:
+        """ Valores de los contadores compartidos, o None si el estado compartido no responde """
+        try:
+            valores = await self.estado.incrementar_varios(claves, cantidad, ttl)
+        except Exception as e:
+            self.errores_compartido += 1
+            if not self._compartido_caido:
+                logger.warning("Filtro de ingesta sin estado compartido, solo local: %s", e)
+            self._compartido_caido = True
+            return None
+        self._compartido_caido = False
+        return valores
+
+    def _permitir_local(self, dispositivo_id: int, ahora: float) -> float:
+        with self._lock:
+            estado = self._estado(dispositivo_id, ahora)
+            estado.fichas = min(self.rafaga, estado.fichas + (ahora - estado.instante) * self.envios_por_s)
+            estado.instante = ahora
+            if estado.fichas >= 1:
+                estado.fichas -= 1
+                return 0.0
+            return (1 - estado.fichas) / self.envios_por_s
+
+    async def permitir_envios(self, dispositivo_ids) -> dict:
+        """
+        Gasta una ficha de cada dispositivo del envío; devuelve dispositivo_id -> 0 si había o los segundos
+        hasta la siguiente si no
+        """
+        if self.envios_por_s <= 0:
+            return {dispositivo_id: 0.0 for dispositivo_id in dispositivo_ids}
+        ahora = time.monotonic()
+        esperas = {dispositivo_id: self._permitir_local(dispositivo_id, ahora) for dispositivo_id in dispositivo_ids}
+        permitidos = [dispositivo_id for dispositivo_id, espera in esperas.items() if not espera]
+        if permitidos and self._compartido:
+            ventana = max(self.rafaga, 1) / self.envios_por_s
+            reloj = time.time()
+            numero = int(reloj // ventana)
+            claves = [f"ingesta:envios:{dispositivo_id}:{numero}" for dispositivo_id in permitidos]
+            totales = await self._contadores(claves, 1, ventana + 1)
+            if totales is not None:
+                for dispositivo_id, total in zip(permitidos, totales):
+                    if total > self.rafaga:
+                        esperas[dispositivo_id] = (numero + 1) * ventana - reloj
+        self.limitados += sum(1 for espera in esperas.values() if espera)
+        return esperas
+
+    def _repetido(self, ultimo, fila: dict) -> bool:
+        fecha, latitud, longitud = ultimo
+        return (
+            abs((fila["fecha"] - fecha).total_seconds()) < self.segundos
+            and distancia_m(latitud, longitud, fila["latitud"], fila["longitud"]) <= self.metros
+        )
+
+    def _clave_fix(self, fila: dict) -> str:
+        # Celda de `metros` (1 cm como mínimo: la precisión de los fixes) y ventana de `segundos`
+        paso = max(self.metros, 0.01) / METROS_POR_GRADO
+        ventana = math.floor(fila["fecha"].replace(tzinfo=datetime.timezone.utc).timestamp() / self.segundos)
+        return (
+            f"ingesta:fix:{fila['dispositivo_id']}:{math.floor(fila['latitud'] / paso)}:"
+            f"{math.floor(fila['longitud'] / paso)}:{ventana}"
+        )
+
+    async def duplicados_de(self, filas: list) -> list:
+        """
+        Para cada fila (ya validada, con dispositivo_id) si es un duplicado del último fix aceptado o de una
+        fila anterior no descartada del mismo envío. No guarda nada: eso lo hace `recordar` tras escribir
+        """
+        if self.segundos <= 0:
+            return [False] * len(filas)
+        with self._lock:
+            ultimos = {}
+            for fila in filas:
+                if fila["dispositivo_id"] not in ultimos:
+                    estado = self._estados.get(fila["dispositivo_id"])
+                    ultimos[fila["dispositivo_id"]] = estado.ultimo if estado is not None else None
+        resultado = []
+        for fila in filas:
+            ultimo = ultimos[fila["dispositivo_id"]]
+            repetido = ultimo is not None and self._repetido(ultimo, fila)
+            if not repetido:
+                ultimos[fila["dispositivo_id"]] = (fila["fecha"], fila["latitud"], fila["longitud"])
+            resultado.append(repetido)
+
+        pendientes = [i for i, repetido in enumerate(resultado) if not repetido]
+        if pendientes and self._compartido:
+            # Solo se leen (cantidad 0): el fix cuenta como escrito cuando otro worker lo ha recordado
+            vistos = await self._contadores([self._clave_fix(filas[i]) for i in pendientes], 0, 2 * self.segundos)
+            if vistos is not None:
+                for i, visto in zip(pendientes, vistos):
+                    resultado[i] = visto > 0
+        self.duplicados += sum(resultado)
+        return resultado
+
+    async def recordar(self, filas: list):
+        """ Último fix aceptado de cada dispositivo, una vez escritas (o encoladas) las filas """
+        if self.segundos <= 0:
+            return
+        ahora = time.monotonic()
+        with self._lock:
+            for fila in filas:
+                self._estado(fila["dispositivo_id"], ahora).ultimo = (fila["fecha"], fila["latitud"], fila["longitud"])
+        if self._compartido:
+            await self._contadores([self._clave_fix(fila) for fila in filas], 1, 2 * self.segundos)
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {
+                "dispositivos": len(self._estados),
+                "envios_por_s": self.envios_por_s,
+                "rafaga": self.rafaga,
+                "metros": self.metros,
+                "segundos": self.segundos,
+                "compartido": self._compartido,
+                "limitados": self.limitados,
+                "duplicados": self.duplicados,
+                "errores_compartido": self.errores_compartido,
+            }
@@ -0,0 +1,212 @@
+import datetime
+import math
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+RADIO_TIERRA_M = 6371008.8
+METROS_POR_GRADO = math.pi * RADIO_TIERRA_M / 180
+
+TIPO_CIRCULO = "circulo"
+TIPO_POLIGONO = "poligono"
+EVENTO_ENTRADA = "entrada"
+EVENTO_SALIDA = "salida"
+_NINGUNA = frozenset()
+
+
+@dataclass(frozen=True)
+class Geocerca:
+    id: int
+    tipo: str
+    dispositivo_id: Optional[int]
+    usuario_id: Optional[int]
+    latitud: Optional[float] = None
+    longitud: Optional[float] = None
+    radio: Optional[float] = None  # metros
+    vertices: Tuple[Tuple[float, float], ...] = ()  # (latitud, longitud)
+
+    def caja(self) -> Tuple[float, float, float, float]:
+        """ (lat_min, lat_max, lon_min, lon_max) que envuelve la geocerca """
+        if self.tipo == TIPO_CIRCULO:
+            margen_lat = self.radio / METROS_POR_GRADO
+            margen_lon = margen_lat / max(math.cos(math.radians(self.latitud)), 1e-6)
+            return (self.latitud - margen_lat, self.latitud + margen_lat,
+                    self.longitud - margen_lon, self.longitud + margen_lon)
+        latitudes = [vertice[0] for vertice in self.vertices]
+        longitudes = [vertice[1] for vertice in self.vertices]
+        return min(latitudes), max(latitudes), min(longitudes), max(longitudes)
+
+    def contiene(self, latitud: float, longitud: float) -> bool:
+        if self.tipo == TIPO_CIRCULO:
+            return distancia_m(self.latitud, self.longitud, latitud, longitud) <= self.radio
+        return punto_en_poligono(self.vertices, latitud, longitud)
+
+
+def distancia_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """ Haversine en metros """
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(math.sqrt(a))
+
+
+def punto_en_poligono(vertices, latitud: float, longitud: float) -> bool:
+    """ Ray casting; el polígono se cierra solo (el último vértice enlaza con el primero) """
+    dentro = False
+    lat_j, lon_j = vertices[-1]
+    for lat_i, lon_i in vertices:
+        if (lat_i > latitud) != (lat_j > latitud):
+            corte = lon_i + (latitud - lat_i) * (lon_j - lon_i) / (lat_j - lat_i)
+            if longitud < corte:
+                dentro = not dentro
+        lat_j, lon_j = lat_i, lon_i
+    return dentro
+
+
+class IndiceGeocercas:
+    """
+    Índice en memoria de geocercas sobre una rejilla de celdas de `celda` grados, separada por propietario
+    (dispositivo o usuario). Cada fix solo se compara con las geocercas que le aplican en su celda, y el estado "dentro de" de cada dispositivo
+    se guarda aquí para detectar entradas y salidas sin consultar la BBDD. El primer fix de un dispositivo
+    solo fija su estado inicial. Las geocercas que ocuparían demasiadas celdas se comprueban siempre.
+    """
+
+    def __init__(self, celda: float = 0.01, max_celdas: int = 400):
+        self.celda = celda
+        self.max_celdas = max_celdas
+        self._geocercas = {}
+        self._cajas = {}
+        self._celdas = defaultdict(set)
+        self._grandes = defaultdict(set)
+        self._estado = {}  # dispositivo_id -> (fecha del último fix evaluado, ids de geocercas que lo contienen)
+        self._lock = threading.Lock()
+        self.evaluados = 0
+        self.eventos = 0
+
+    def _clave(self, latitud: float, longitud: float) -> Tuple[int, int]:
+        return math.floor(latitud / self.celda), math.floor(longitud / self.celda)
+
+    @staticmethod
+    def _propietario(geocerca: Geocerca) -> tuple:
+        if geocerca.dispositivo_id is not None:
+            return ("d", geocerca.dispositivo_id)
+        return ("u", geocerca.usuario_id)
+
+    def _celdas_de(self, geocerca: Geocerca):
+        lat_min, lat_max, lon_min, lon_max = geocerca.caja()
+        i_min, j_min = self._clave(lat_min, lon_min)
+        i_max, j_max = self._clave(lat_max, lon_max)
+        if (i_max - i_min + 1) * (j_max - j_min + 1) > self.max_celdas:
+            return None
+        return [(i, j) for i in range(i_min, i_max + 1) for j in range(j_min, j_max + 1)]
+
+    def guardar(self, geocerca: Geocerca):
+        """ Añade o reemplaza una geocerca """
+        with self._lock:
+            self._quitar(geocerca.id)
+            self._geocercas[geocerca.id] = geocerca
+            self._cajas[geocerca.id] = geocerca.caja()
+            propietario = self._propietario(geocerca)
+            celdas = self._celdas_de(geocerca)
+            if celdas is None:
+                self._grandes[propietario].add(geocerca.id)
+            else:
+                for clave in celdas:
+                    self._celdas[propietario + clave].add(geocerca.id)
+
+    def eliminar(self, geocerca_id: int):
+        with self._lock:
+            self._quitar(geocerca_id)
+            for _, dentro in self._estado.values():
+                dentro.discard(geocerca_id)
+
+    def _quitar(self, geocerca_id: int):
+        geocerca = self._geocercas.pop(geocerca_id, None)
+        if geocerca is None:
+            return
+        del self._cajas[geocerca_id]
+        propietario = self._propietario(geocerca)
+        grandes = self._grandes.get(propietario)
+        if grandes is not None:
+            grandes.discard(geocerca_id)
+            if not grandes:
+                del self._grandes[propietario]
+        for clave in self._celdas_de(geocerca) or ():
+            ids = self._celdas.get(propietario + clave)
+            if ids is not None:
+                ids.discard(geocerca_id)
+                if not ids:
+                    del self._celdas[propietario + clave]
+
+    def cargar(self, geocercas):
+        with self._lock:
+            self._geocercas.clear()
+            self._cajas.clear()
+            self._celdas.clear()
+            self._grandes.clear()
+        for geocerca in geocercas:
+            self.guardar(geocerca)
+
+    def olvidar_dispositivo(self, dispositivo_id: int):
+        with self._lock:
+            self._estado.pop(dispositivo_id, None)
+
+    def estados(self, dispositivo_ids) -> list:
+        """ [(dispositivo_id, fecha, ids de geocercas que lo contienen)] para sincronizar otros procesos """
+        with self._lock:
+            return [
+                (dispositivo_id, estado[0], sorted(estado[1]))
+                for dispositivo_id in dispositivo_ids
+                if (estado := self._estado.get(dispositivo_id)) is not None
+            ]
+
+    def fijar_estado(self, dispositivo_id: int, fecha: datetime.datetime, dentro):
+        """ Estado evaluado en otro proceso; solo se aplica si es más reciente que el propio """
+        with self._lock:
+            anterior = self._estado.get(dispositivo_id)
+            if anterior is None or anterior[0] <= fecha:
+                self._estado[dispositivo_id] = (fecha, {geocerca_id for geocerca_id in dentro if geocerca_id in self._geocercas})
+
+    def evaluar(self, dispositivo_id: int, usuario_id: Optional[int], latitud: float, longitud: float,
+                fecha: datetime.datetime) -> list:
+        """ Devuelve [(geocerca_id, EVENTO_ENTRADA | EVENTO_SALIDA)] para este fix """
+        with self._lock:
+            anterior = self._estado.get(dispositivo_id)
+            # Un fix más antiguo que el último evaluado llega tarde: no cambia el estado
+            if anterior is not None and fecha < anterior[0]:
+                return []
+            self.evaluados += 1
+
+            clave = self._clave(latitud, longitud)
+            candidatas = []
+            for propietario in (("d", dispositivo_id), ("u", usuario_id)):
+                candidatas.extend(self._celdas.get(propietario + clave, _NINGUNA))
+                candidatas.extend(self._grandes.get(propietario, _NINGUNA))
+            dentro = set()
+            for geocerca_id in candidatas:
+                # La caja envolvente descarta casi todas las candidatas sin trigonometría
+                lat_min, lat_max, lon_min, lon_max = self._cajas[geocerca_id]
+                if lat_min <= latitud <= lat_max and lon_min <= longitud <= lon_max \
+                        and self._geocercas[geocerca_id].contiene(latitud, longitud):
+                    dentro.add(geocerca_id)
+            self._estado[dispositivo_id] = (fecha, dentro)
+            if anterior is None:
+                return []
+
+            eventos = [(geocerca_id, EVENTO_ENTRADA) for geocerca_id in sorted(dentro - anterior[1])]
+            eventos += [(geocerca_id, EVENTO_SALIDA) for geocerca_id in sorted(anterior[1] - dentro)]
+            self.eventos += len(eventos)
+            return eventos
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {
+                "geocercas": len(self._geocercas),
+                "celdas": len(self._celdas),
+                "grandes": sum(len(ids) for ids in self._grandes.values()),
+                "dispositivos": len(self._estado),
+                "evaluados": self.evaluados,
+                "eventos": self.eventos,
+            }
@@ -0,0 +1,221 @@
+import datetime
+import math
+from typing import List, NamedTuple, Optional
+import numpy as np
+
+PREFIJO = "+CGPSINFO:"
+NUM_CAMPOS = 9  # lat, N/S, lon, E/W, fecha (ddmmyy), hora UTC (hhmmss.s), altitud, velocidad (nudos), rumbo
+NUDOS_A_KMH = 1.852
+
+# Motivos de rechazo, en el orden en que se comprueban
+MOTIVO_VACIO = "Fix vacío (sin cobertura GNSS)"
+MOTIVO_FORMATO = "Formato de datos GNSS incorrecto"
+MOTIVO_HEMISFERIO = "Hemisferio inválido"
+MOTIVO_RANGO = "Coordenadas fuera de rango"
+
+
+class Fix(NamedTuple):
+    latitud: float
+    longitud: float
+    fecha: Optional[datetime.datetime]
+    altitud: Optional[float]
+    velocidad: Optional[float]  # km/h
+
+
+class LoteGNSS(NamedTuple):
+    """ Resultado columnar de parsear_lote; las posiciones inválidas llevan NaN/NaT y su motivo """
+    validos: np.ndarray
+    motivos: np.ndarray
+    latitud: np.ndarray
+    longitud: np.ndarray
+    fecha: np.ndarray  # datetime64[ms]
+    altitud: np.ndarray
+    velocidad: np.ndarray
+
+    def fix(self, indice: int) -> Optional[Fix]:
+        if not self.validos[indice]:
+            return None
+        fecha = self.fecha[indice]
+        return Fix(
+            latitud=float(self.latitud[indice]),
+            longitud=float(self.longitud[indice]),
+            fecha=None if np.isnat(fecha) else fecha.astype("datetime64[ms]").item(),
+            altitud=_opcional(self.altitud[indice]),
+            velocidad=_opcional(self.velocidad[indice]),
+        )
+
+
+def _opcional(valor) -> Optional[float]:
+    return None if np.isnan(valor) else float(valor)
+
+
+def coordenadas_validas(latitud: float, longitud: float) -> bool:
+    return -90.0 <= latitud <= 90.0 and -180.0 <= longitud <= 180.0
+
+
+def _campos(linea: str) -> List[str]:
+    linea = linea.strip()
+    if linea.startswith(PREFIJO):
+        linea = linea[len(PREFIJO):]
+    partes = [parte.strip() for parte in linea.split(",", NUM_CAMPOS)[:NUM_CAMPOS]]
+    return partes + [""] * (NUM_CAMPOS - len(partes))
+
+
+def _float_o_nan(texto: str) -> float:
+    try:
+        return float(texto) if texto else float("nan")
+    except ValueError:
+        return float("nan")
+
+
+'''--------------------- LÍNEA A LÍNEA ---------------------'''
+
+def _grados(dmm: float) -> float:
+    """ ddmm.mmmm / dddmm.mmmm -> grados decimales (sin signo) """
+    grados = dmm // 100
+    return grados + (dmm - grados * 100) / 60
+
+
+def _fecha_hora(fecha: str, hora: str) -> Optional[datetime.datetime]:
+    try:
+        dia, mes, anio = int(fecha[0:2]), int(fecha[2:4]), 2000 + int(fecha[4:6])
+        segundos = float(hora[4:])
+        if not 0 <= segundos < 60:
+            return None
+        # Al milisegundo y redondeando, igual que parsear_lote
+        return datetime.datetime(anio, mes, dia, int(hora[0:2]), int(hora[2:4])) + datetime.timedelta(
+            milliseconds=round(segundos * 1000)
+        )
+    except ValueError:
+        return None
+
+
+def parsear_linea(linea: str) -> Optional[Fix]:
+    """ Convierte una línea +CGPSINFO en un Fix, o None si está vacía o es inválida """
+    lat_dmm, ns, lon_dmm, ew, fecha, hora, altitud, velocidad, _ = _campos(linea)
+    if not lat_dmm and not lon_dmm:
+        return None
+    try:
+        lat_valor = float(lat_dmm)
+        lon_valor = float(lon_dmm)
+    except ValueError:
+        return None
+    if ns not in ("N", "S") or ew not in ("E", "W"):
+        return None
+    if lat_valor % 100 >= 60 or lon_valor % 100 >= 60:
+        return None
+
+    latitud = _grados(lat_valor) * (-1 if ns == "S" else 1)
+    longitud = _grados(lon_valor) * (-1 if ew == "W" else 1)
+    if not coordenadas_validas(latitud, longitud):
+        return None
+
+    velocidad_nudos = _float_o_nan(velocidad)
+    altitud_valor = _float_o_nan(altitud)
+    return Fix(
+        latitud=latitud,
+        longitud=longitud,
+        fecha=_fecha_hora(fecha, hora),
+        altitud=None if math.isnan(altitud_valor) else altitud_valor,
+        velocidad=None if math.isnan(velocidad_nudos) else velocidad_nudos * NUDOS_A_KMH,
+    )
+
+
+'''--------------------- POR LOTES ---------------------'''
+
+def _columna_float(columna: List[str]) -> np.ndarray:
+    try:
+        return np.array([valor or "nan" for valor in columna], dtype=np.float64)
+    except ValueError:
+        # Algún valor no numérico: se convierte elemento a elemento solo en este caso
+        return np.array([_float_o_nan(valor) for valor in columna], dtype=np.float64)
+
+
+def _filas_normalizadas(lineas: List[str]) -> List[str]:
+    """ Quita prefijos y espacios de todo el lote a la vez y deja cada fila con exactamente NUM_CAMPOS campos """
+    texto = "\n".join(lineas).replace(PREFIJO, "").replace(" ", "").replace("\t", "").replace("\r", "")
+    filas = texto.split("\n")
+    if len(filas) != len(lineas):
+        # Alguna línea traía saltos de línea propios
+        return [",".join(_campos(linea)) for linea in lineas]
+    separadores = NUM_CAMPOS - 1
+    for indice, fila in enumerate(filas):
+        if fila.count(",") != separadores:
+            filas[indice] = ",".join(_campos(fila))
+    return filas
+
+
+def _fechas(ddmmyy: np.ndarray, hhmmss: np.ndarray) -> np.ndarray:
+    dia = ddmmyy // 10000
+    mes = (ddmmyy // 100) % 100
+    anio = 2000 + ddmmyy % 100
+    horas = hhmmss // 10000
+    minutos = (hhmmss // 100) % 100
+    segundos = hhmmss % 100
+
+    validas = (
+        np.isfinite(ddmmyy) & np.isfinite(hhmmss)
+        & (dia >= 1) & (dia <= 31) & (mes >= 1) & (mes <= 12)
+        & (horas < 24) & (minutos < 60) & (segundos < 60)
+    )
+    meses = np.where(validas, (anio - 1970) * 12 + mes - 1, 0).astype("int64").astype("datetime64[M]")
+    dias = meses.astype("datetime64[D]") + np.where(validas, dia - 1, 0).astype("int64")
+    # np.rint: hhmmss llega como float (45.4 s es 45.39999...) y truncar daría 45.399 s
+    milisegundos = np.where(validas, np.rint(((horas * 60 + minutos) * 60 + segundos) * 1000), 0).astype("int64")
+    resultado = dias.astype("datetime64[ms]") + milisegundos
+    # 31/02 y similares se desbordan al mes siguiente: se descartan
+    validas &= resultado.astype("datetime64[M]") == meses
+    return np.where(validas, resultado, np.datetime64("NaT", "ms"))
+
+
+def parsear_lote(lineas: List[str]) -> LoteGNSS:
+    """
+    Convierte muchas líneas +CGPSINFO a la vez. El troceado se hace sobre el lote entero
+    y la conversión numérica, la validación y las fechas van vectorizadas con NumPy
+    """
+    n = len(lineas)
+    if n == 0:
+        vacio = np.empty(0, dtype=np.float64)
+        return LoteGNSS(np.empty(0, dtype=bool), np.empty(0, dtype=object), vacio, vacio,
+                        np.empty(0, dtype="datetime64[ms]"), vacio, vacio)
+
+    campos = ",".join(_filas_normalizadas(lineas)).split(",")
+    lat_texto = campos[0::NUM_CAMPOS]
+    lon_texto = campos[2::NUM_CAMPOS]
+    lat_dmm = _columna_float(lat_texto)
+    lon_dmm = _columna_float(lon_texto)
+    ns = np.array(campos[1::NUM_CAMPOS], dtype="U2")
+    ew = np.array(campos[3::NUM_CAMPOS], dtype="U2")
+
+    vacio = np.array([not lat and not lon for lat, lon in zip(lat_texto, lon_texto)], dtype=bool)
+    formato = ~vacio & (
+        np.isnan(lat_dmm) | np.isnan(lon_dmm)
+        | (np.nan_to_num(lat_dmm) % 100 >= 60) | (np.nan_to_num(lon_dmm) % 100 >= 60)
+    )
+    hemisferio = ~(np.isin(ns, ("N", "S")) & np.isin(ew, ("E", "W")))
+
+    # Los campos no numéricos (NaN, inf) ya están marcados en `formato`: sin avisos por lote
+    with np.errstate(invalid="ignore"):
+        lat_grados = lat_dmm // 100
+        lon_grados = lon_dmm // 100
+        latitud = (lat_grados + (lat_dmm - lat_grados * 100) / 60) * np.where(ns == "S", -1.0, 1.0)
+        longitud = (lon_grados + (lon_dmm - lon_grados * 100) / 60) * np.where(ew == "W", -1.0, 1.0)
+        rango = ~((np.abs(latitud) <= 90) & (np.abs(longitud) <= 180))
+
+    motivos = np.select(
+        [vacio, formato, hemisferio, rango],
+        [MOTIVO_VACIO, MOTIVO_FORMATO, MOTIVO_HEMISFERIO, MOTIVO_RANGO],
+        default="",
+    ).astype(object)
+    validos = motivos == ""
+    motivos[validos] = None
+
+    return LoteGNSS(
+        validos=validos,
+        motivos=motivos,
+        latitud=np.where(validos, latitud, np.nan),
+        longitud=np.where(validos, longitud, np.nan),
+        fecha=_fechas(_columna_float(campos[4::NUM_CAMPOS]), _columna_float(campos[5::NUM_CAMPOS])),
+        altitud=_columna_float(campos[6::NUM_CAMPOS]),
+        velocidad=_columna_float(campos[7::NUM_CAMPOS]) * NUDOS_A_KMH,
+    )
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+from dotenv import load_dotenv
+from observabilidad import BCRYPT_SEGUNDOS
+
+load_dotenv()
+
+# Coste de bcrypt. Al cambiarlo, los hashes antiguos se regeneran en el siguiente login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+BCRYPT_PROCESOS = int(os.getenv("BCRYPT_PROCESOS", str(os.cpu_count() or 1)))
+# Trabajos de bcrypt admitidos a la vez (en ejecución o esperando un proceso libre)
+BCRYPT_MAX_PENDIENTES = int(os.getenv("BCRYPT_MAX_PENDIENTES", str(BCRYPT_PROCESOS * 4)))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+_pool = None
+_semaforo = None
+
+
+def _hashear(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verificar_y_actualizar(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    try:
+        return pwd_context.verify_and_update(password, hashed_password)
+    except (ValueError, TypeError):
+        # Hash corrupto o vacío: se trata como credenciales inválidas
+        return False, None
+
+
+def _obtener_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=BCRYPT_PROCESOS)
+    return _pool
+
+
+async def _ejecutar(operacion: str, funcion, *args):
+    global _semaforo
+    if _semaforo is None:
+        _semaforo = asyncio.Semaphore(BCRYPT_MAX_PENDIENTES)
+    inicio = time.perf_counter()
+    try:
+        async with _semaforo:
+            return await asyncio.get_running_loop().run_in_executor(_obtener_pool(), funcion, *args)
+    finally:
+        BCRYPT_SEGUNDOS.labels(operacion).observe(time.perf_counter() - inicio)
+
+
+async def hash_password(password: str) -> str:
+    """ Hashea la contraseña usando bcrypt en el pool de procesos """
+    return await _ejecutar("hash", _hashear, password)
+
+
+async def verify_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Verifica la contraseña en el pool de procesos.
+    Devuelve (válida, nuevo_hash); nuevo_hash no es None si el hash usa otro coste y hay que guardarlo
+    """
+    return await _ejecutar("verificar", _verificar_y_actualizar, plain_password, hashed_password)
+
+
+def get_password_hash(password: str) -> str:
+    """ Versión síncrona para scripts y la creación del usuario root """
+    return _hashear(password)
+
+
+def cerrar_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True)
+        _pool = None
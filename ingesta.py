@@ -0,0 +1,192 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+MODO_CONFIRMAR = "confirmar"  # se responde cuando el lote que contiene el fix ha hecho commit
+MODO_ENCOLAR = "encolar"  # se responde al encolar; un fallo de la BBDD o una caída pierde lo pendiente
+
+
+class ColaLlena(Exception):
+    pass
+
+
+class _Pendiente:
+    __slots__ = ("filas", "usuarios", "futuro")
+
+    def __init__(self, filas: list, usuarios: dict, futuro: Optional[asyncio.Future]):
+        self.filas = filas
+        self.usuarios = usuarios
+        self.futuro = futuro
+
+
+class BufferIngesta:
+    """
+    Buffer de escritura diferida con commit agrupado. Las peticiones dejan sus filas ya validadas en una cola
+    acotada y una única tarea las escribe con `escribir(filas, usuarios) -> ids` cada `max_filas` filas
+    o cada `intervalo_ms` milisegundos, lo que llegue antes: un commit (y un fsync) por lote en lugar de uno por fix.
+    """
+
+    def __init__(
+        self,
+        escribir: Callable[[list, dict], Awaitable[list]],
+        modo: str = MODO_CONFIRMAR,
+        max_filas: int = 500,
+        intervalo_ms: float = 50,
+        max_cola: int = 20000,
+    ):
+        if modo not in (MODO_CONFIRMAR, MODO_ENCOLAR):
+            raise ValueError(f"Modo de ingesta desconocido: {modo}")
+        self.escribir = escribir
+        self.modo = modo
+        self.max_filas = max_filas
+        self.intervalo = intervalo_ms / 1000
+        self.max_cola = max_cola
+
+        self._cola = deque()
+        self._filas_en_cola = 0
+        self._hay_datos = None
+        self._tarea = None
+        self._cerrando = False
+
+        self.lotes = 0
+        self.filas_escritas = 0
+        self.rechazadas = 0
+        self.perdidas = 0
+        self.errores = 0
+        self.lotes_divididos = 0
+        self.ultimo_lote_ms = 0.0
+
+    def iniciar(self):
+        if self._tarea is None:
+            self._cerrando = False
+            self._hay_datos = asyncio.Event()
+            self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        """ Deja de aceptar filas y escribe todo lo pendiente antes de terminar """
+        if self._tarea is None:
+            return
+        self._cerrando = True
+        self._hay_datos.set()
+        await self._tarea
+        self._tarea = None
+
+    def pendientes(self) -> int:
+        return self._filas_en_cola
+
+    def encolar(self, filas: list, usuarios: dict) -> Optional[asyncio.Future]:
+        """
+        Encola las filas de una petición. En modo confirmar devuelve un futuro que se resuelve con sus ids;
+        lanza ColaLlena si no caben (el cliente debe reintentar más tarde)
+        """
+        if self._tarea is None or self._cerrando or self._filas_en_cola + len(filas) > self.max_cola:
+            self.rechazadas += len(filas)
+            raise ColaLlena()
+        futuro = asyncio.get_running_loop().create_future() if self.modo == MODO_CONFIRMAR else None
+        self._cola.append(_Pendiente(filas, usuarios, futuro))
+        self._filas_en_cola += len(filas)
+        self._hay_datos.set()
+        return futuro
+
+    async def guardar(self, filas: list, usuarios: dict) -> Optional[list]:
+        """ Ids de las filas en modo confirmar; None en modo encolar """
+        futuro = self.encolar(filas, usuarios)
+        if futuro is None:
+            return None
+        return await futuro
+
+    def espera_estimada(self) -> int:
+        """ Segundos aproximados hasta que la cola tenga hueco, para la cabecera Retry-After """
+        if not self.lotes or not self.ultimo_lote_ms:
+            return 1
+        lotes = self._filas_en_cola / max(self.max_filas, 1)
+        return max(1, round(lotes * self.ultimo_lote_ms / 1000))
+
+    async def _bucle(self):
+        while True:
+            if not self._cola:
+                if self._cerrando:
+                    return
+                self._hay_datos.clear()
+                await self._hay_datos.wait()
+                continue
+
+            # Se da margen a que se junten más filas salvo que ya haya un lote completo
+            limite = time.monotonic() + self.intervalo
+            while self._filas_en_cola < self.max_filas and not self._cerrando:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    break
+                self._hay_datos.clear()
+                try:
+                    await asyncio.wait_for(self._hay_datos.wait(), restante)
+                except asyncio.TimeoutError:
+                    break
+            await self._escribir_lote(self._siguiente_lote())
+
+    def _siguiente_lote(self) -> list:
+        lote = []
+        filas = 0
+        while self._cola and (not lote or filas + len(self._cola[0].filas) <= self.max_filas):
+            pendiente = self._cola.popleft()
+            lote.append(pendiente)
+            filas += len(pendiente.filas)
+        self._filas_en_cola -= filas
+        return lote
+
+    async def _escribir_lote(self, lote: list):
+        filas = [fila for pendiente in lote for fila in pendiente.filas]
+        usuarios = {}
+        for pendiente in lote:
+            usuarios.update(pendiente.usuarios)
+
+        inicio = time.perf_counter()
+        try:
+            ids = await self.escribir(filas, usuarios)
+        except Exception as e:
+            self.errores += 1
+            if len(lote) > 1:
+                # Una fila mala (p. ej. de un dispositivo recién borrado) no debe hacer fallar al resto:
+                # cada petición se reintenta en su propia transacción y solo falla la que la contiene
+                logger.warning("Error al escribir un lote de %d registros (%s); se reintenta por petición", len(filas), e)
+                self.lotes_divididos += 1
+                for pendiente in lote:
+                    await self._escribir_lote([pendiente])
+                return
+            logger.error("Error al escribir un lote de %d registros: %s", len(filas), e)
+            for pendiente in lote:
+                if pendiente.futuro is not None:
+                    if not pendiente.futuro.done():
+                        pendiente.futuro.set_exception(e)
+                else:
+                    self.perdidas += len(pendiente.filas)
+            return
+        self.ultimo_lote_ms = (time.perf_counter() - inicio) * 1000
+        self.lotes += 1
+        self.filas_escritas += len(filas)
+
+        desplazamiento = 0
+        for pendiente in lote:
+            fin = desplazamiento + len(pendiente.filas)
+            if pendiente.futuro is not None and not pendiente.futuro.done():
+                pendiente.futuro.set_result(ids[desplazamiento:fin])
+            desplazamiento = fin
+
+    def estadisticas(self) -> dict:
+        return {
+            "modo": self.modo,
+            "en_cola": self._filas_en_cola,
+            "max_cola": self.max_cola,
+            "lotes": self.lotes,
+            "filas_escritas": self.filas_escritas,
+            "filas_por_lote": self.filas_escritas / self.lotes if self.lotes else 0,
+            "ultimo_lote_ms": self.ultimo_lote_ms,
+            "rechazadas": self.rechazadas,
+            "perdidas": self.perdidas,
+            "errores": self.errores,
+            "lotes_divididos": self.lotes_divididos,
+        }
@@ -1,27 +1,92 @@
+import dataclasses
 import datetime
+import json
+import logging
+import math
 import re
 import os
-from database import SessionLocal, UsuarioDB, DispositivoDB, RegistroDB, RolDB
+import socket
+from database import engine, async_engine, esperar_bbdd, SessionLocal, AsyncSessionLocal, UsuarioDB, DispositivoDB, RegistroDB, RolDB, CorreoFallidoDB, UltimaPosicionDB, GeocercaDB, EventoGeocercaDB
 import models
+import hashing
+import gnss
+import asyncio
+import numpy as np
+import simplificacion
+import particiones
+import geocercas
+import proximidad
+import protocolo_binario
+import ingesta
+import observabilidad
+import serializacion
+import exportacion
+from correo import ColaCorreo, Correo
+from hashing import hash_password, verify_password
+from cache import CacheTTL, normalizar_mac, variantes_mac
+from tiempo_real import Difusor
+from estado_compartido import crear_estado
+from filtro_ingesta import FiltroIngesta, MOTIVO_LIMITE, MOTIVO_DUPLICADO
+from paginacion import paginar, recorrer, decodificar_cursor, CABECERA_CURSOR, LIMITE_POR_DEFECTO, LIMITE_MAXIMO
 from uuid import uuid4
 from typing import List, Optional
-from passlib.context import CryptContext
 from jose import JWTError, jwt
-from fastapi import FastAPI, HTTPException, Depends
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response, WebSocket
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, insert, select, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, joinedload, raiseload
 from starlette.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
 from dotenv import load_dotenv
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-
-
-app = FastAPI()
+from contextlib import asynccontextmanager
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # El esquema lo crea `python migraciones.py`; aquí solo se espera a que la BBDD acepte conexiones
+    await esperar_bbdd()
+    estado_compartido.suscribir(CANAL_INVALIDACIONES, aplicar_invalidacion)
+    estado_compartido.suscribir(CANAL_GEOCERCAS, aplicar_cambio_geocercas)
+    estado_compartido.suscribir(CANAL_TIEMPO_REAL, aplicar_tiempo_real)
+    await estado_compartido.iniciar()
+    cola_correo.iniciar()
+    if buffer_ingesta is not None:
+        buffer_ingesta.iniciar()
+    await asyncio.to_thread(cargar_geocercas)
+    await asyncio.to_thread(cargar_posiciones)
+    tarea_mantenimiento = asyncio.create_task(particiones.bucle_mantenimiento(engine))
+    transporte_udp = None
+    if UDP_PUERTO:
+        transporte_udp, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: protocolo_udp, local_addr=(os.getenv("UDP_HOST", "0.0.0.0"), int(UDP_PUERTO)),
+            # Con varios workers todos escuchan el mismo puerto y el kernel reparte los datagramas
+            reuse_port=hasattr(socket, "SO_REUSEPORT"),
+        )
+    yield
+    if transporte_udp is not None:
+        transporte_udp.close()
+        await protocolo_udp.esperar_pendientes()
+    if buffer_ingesta is not None:
+        # Lo ya aceptado se escribe antes de cerrar
+        await buffer_ingesta.detener()
+    await estado_compartido.detener()
+    tarea_mantenimiento.cancel()
+    cola_correo.detener()
+    hashing.cerrar_pool()
+    await async_engine.dispose()
+    engine.dispose()
+    observabilidad.cerrar_proceso()
+
+app = FastAPI(lifespan=lifespan)
 
 ruta_inicial = "/api/v2.2/"
 base_url = "192.168.49.2:30080"
 
+# Latencia y códigos de respuesta por ruta para /metrics
+app.add_middleware(observabilidad.MiddlewareMetricas)
+
 # Middleware CORS para permitir peticiones desde cualquier origen
 app.add_middleware(
     CORSMiddleware,
@@ -29,21 +94,102 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Permite todos los métodos (GET, POST, etc.)
     allow_headers=["*"],  # Permite todos los encabezados
+    expose_headers=[CABECERA_CURSOR, "X-Instantanea"],  # Cursor de paginación e instantánea de las exportaciones
 )
 
-# Configuración del hash bcrypt
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 load_dotenv()
+observabilidad.configurar_logging()
+logger = logging.getLogger(__name__)
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = 120
+MAX_REGISTROS_LOTE = 1000
+# Fechas más adelantadas que esto (relojes mal puestos, años GNSS "80" -> 2080) se rechazan: irían a la
+# partición por defecto de registros
+MAX_ADELANTO_FECHA = datetime.timedelta(seconds=float(os.getenv("INGESTA_MAX_ADELANTO_S", "86400")))
+MOTIVO_FUTURO = "Fecha en el futuro"
+UDP_PUERTO = os.getenv("UDP_PUERTO")  # sin definir = no se escucha UDP
+# "directo" (un commit por petición), "confirmar" o "encolar" (buffer con commit agrupado, ver ingesta.py)
+INGESTA_MODO = os.getenv("INGESTA_MODO", "directo")
 PASSWORD_GMAIL = os.getenv("PASSWORD_GMAIL")
 MI_CORREO = os.getenv("MY_EMAIL")
 
+# Cache MAC -> dispositivo para el camino de ingesta
+cache_dispositivos = CacheTTL(
+    max_entradas=int(os.getenv("CACHE_MAC_MAX_ENTRADAS", "10000")),
+    ttl=float(os.getenv("CACHE_MAC_TTL", "300")),
+    ttl_negativo=float(os.getenv("CACHE_MAC_TTL_NEGATIVO", "30")),
+)
+
+# Cache id de usuario -> Principal para no consultar la BBDD en cada petición autenticada
+cache_principales = CacheTTL(
+    max_entradas=int(os.getenv("CACHE_PRINCIPALES_MAX_ENTRADAS", "10000")),
+    ttl=float(os.getenv("CACHE_PRINCIPALES_TTL", "60")),
+    ttl_negativo=float(os.getenv("CACHE_PRINCIPALES_TTL_NEGATIVO", "10")),
+)
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Pub/sub en proceso de las posiciones aceptadas por la ingesta
+difusor = Difusor(max_cola=int(os.getenv("WS_MAX_COLA", "100")))
+
+# Geocercas activas en memoria, evaluadas en cada fix aceptado
+indice_geocercas = geocercas.IndiceGeocercas(celda=float(os.getenv("GEOCERCAS_CELDA", "0.01")))
+
+# Última posición de cada dispositivo en memoria para /dispositivos/cercanos
+indice_posiciones = proximidad.IndicePosiciones(celda=float(os.getenv("PROXIMIDAD_CELDA", "0.01")))
+
+# Invalidaciones, cambios de geocercas y tiempo real entre workers/pods. Sin ESTADO_COMPARTIDO_URL todo
+# vive en este proceso (un solo worker); con redis://... cada cambio se aplica aquí y se anuncia al resto
+estado_compartido = crear_estado(os.getenv("ESTADO_COMPARTIDO_URL"))
+CANAL_INVALIDACIONES = "invalidaciones"
+CANAL_GEOCERCAS = "geocercas"
+CANAL_TIEMPO_REAL = "tiempo_real"
+caches = {"dispositivos": cache_dispositivos, "principales": cache_principales}
+
+# Límite de envíos y descarte de fixes repetidos por dispositivo, antes de escribir en la BBDD; con varios
+# workers o pods se comprueba también contra los contadores de estado_compartido
+filtro_ingesta = FiltroIngesta(
+    envios_por_s=float(os.getenv("INGESTA_ENVIOS_POR_S", "2")),
+    rafaga=int(os.getenv("INGESTA_RAFAGA", "10")),
+    metros=float(os.getenv("INGESTA_DUPLICADO_METROS", "0")),
+    segundos=float(os.getenv("INGESTA_DUPLICADO_SEGUNDOS", "1")),
+    max_dispositivos=int(os.getenv("INGESTA_FILTRO_MAX_DISPOSITIVOS", "100000")),
+    estado=estado_compartido,
+)
+
+def invalidar_cache(nombre: str, clave):
+    caches[nombre].invalidar(clave)
+    estado_compartido.publicar(CANAL_INVALIDACIONES, {"cache": nombre, "clave": clave})
+
+def aplicar_invalidacion(mensaje: dict):
+    caches[mensaje["cache"]].invalidar(mensaje["clave"])
+
+def registrar_correo_fallido(correo: Correo):
+    """ Los correos que agotan los reintentos quedan en la tabla correos_fallidos """
+    with SessionLocal() as db:
+        db.add(CorreoFallidoDB(
+            destinatario=correo.destinatario,
+            asunto=correo.asunto,
+            cuerpo=correo.cuerpo,
+            intentos=correo.intentos,
+            error=correo.ultimo_error,
+        ))
+        db.commit()
+
+# Cola de correo saliente; SMTP_HOST/SMTP_PORT permiten usar un servidor SMTP local en pruebas
+cola_correo = ColaCorreo(
+    host=os.getenv("SMTP_HOST", "smtp.gmail.com"),
+    puerto=int(os.getenv("SMTP_PORT", "587")),
+    remitente=MI_CORREO,
+    usuario=os.getenv("SMTP_USER", MI_CORREO),
+    password=os.getenv("SMTP_PASSWORD", PASSWORD_GMAIL),
+    starttls=os.getenv("SMTP_STARTTLS", "true").lower() == "true",
+    max_intentos=int(os.getenv("CORREO_MAX_INTENTOS", "5")),
+    al_fallar=registrar_correo_fallido,
+)
+
 # Dependencia para obtener la sesión de la base de datos
 def get_db():
     db = SessionLocal()
@@ -52,15 +198,11 @@ def get_db():
     finally:
         db.close()
 
-'''--------------------- AUTENTICACIÓN ---------------------'''
-def hash_password(password: str) -> str:
-    """ Hashea la contraseña usando bcrypt """
-    return pwd_context.hash(password)
-
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """ Verifica si la contraseña en texto plano coincide con el hash almacenado """
-    return pwd_context.verify(plain_password, hashed_password)
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
+'''--------------------- AUTENTICACIÓN ---------------------'''
 # Función para crear el token de acceso JWT
 def create_access_token(data: dict, expires_delta: Optional[datetime.timedelta] = None, time: int = ACCESS_TOKEN_EXPIRE_MINUTES) -> str:
     to_encode = data.copy()
@@ -81,27 +223,51 @@ def verify_token(token: str) -> dict:
         return None
 
 # Función para obtener el usuario actual desde el token
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    return await principal_desde_token(token, db)
+
+async def principal_desde_token(token: str, db: AsyncSession) -> models.Principal:
     payload = verify_token(token)
     if payload is None:
         raise HTTPException(status_code=401, detail="Invalid token")
     username = payload.get("sub")
     if username is None:
         raise HTTPException(status_code=401, detail="Invalid token")
-    user = db.query(UsuarioDB).filter(UsuarioDB.username == username).first()
-    if user is None:
+
+    usuario_id = payload.get("uid")
+    if usuario_id is None:
+        # Tokens emitidos antes de incluir el id del usuario
+        principal = await cargar_principal(db, UsuarioDB.username == username)
+    else:
+        encontrado, principal = cache_principales.obtener(usuario_id)
+        if not encontrado:
+            principal = await cargar_principal(db, UsuarioDB.id == usuario_id)
+            cache_principales.guardar(usuario_id, principal)
+
+    if principal is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    return principal
 
-@app.post(ruta_inicial + "token_email", response_model=models.MostrarToken)
-def login_for_access_token_with_username(form_data: models.UsuarioLoginWithEmail, db: Session = Depends(get_db)):
-    user = db.query(UsuarioDB).filter(UsuarioDB.email == form_data.email).first()
+async def cargar_principal(db: AsyncSession, condicion) -> Optional[models.Principal]:
+    user = (await db.execute(select(UsuarioDB).options(joinedload(UsuarioDB.rol)).where(condicion))).scalars().first()
+    if user is None:
+        return None
+    return models.Principal(id=user.id, username=user.username, rol=user.rol.nombre)
 
-    if not user or not verify_password(form_data.password, user.password):
+async def emitir_token(db: AsyncSession, user: Optional[UsuarioDB], password: str) -> dict:
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    valida, nuevo_hash = await verify_password(password, user.password)
+    if not valida:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    # El coste de bcrypt configurado ha cambiado: se guarda el hash regenerado
+    if nuevo_hash:
+        user.password = nuevo_hash
+        await db.commit()
 
     access_token = create_access_token(
-        data={"sub": user.username, "role": user.rol.nombre}
+        data={"sub": user.username, "uid": user.id, "role": user.rol.nombre}
     )
     return {
         "usuario_id": user.id,
@@ -110,72 +276,66 @@ def login_for_access_token_with_username(form_data: models.UsuarioLoginWithEmail
         "role": user.rol.nombre
     }
 
-@app.post(ruta_inicial + "token_username", response_model=models.MostrarToken)
-def login_for_access_token_with_username(form_data: models.UsuarioLoginWithUsername, db: Session = Depends(get_db)):
-    user = db.query(UsuarioDB).filter(UsuarioDB.username == form_data.username).first()
-    print(user)
-    if not user or not verify_password(form_data.password, user.password):
-        raise HTTPException(status_code=401, detail="Invalid credentials")
+@app.post(ruta_inicial + "token_email", response_model=models.MostrarToken)
+async def login_for_access_token_with_email(form_data: models.UsuarioLoginWithEmail, db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(select(UsuarioDB).options(joinedload(UsuarioDB.rol)).where(UsuarioDB.email == form_data.email))).scalars().first()
+    return await emitir_token(db, user, form_data.password)
 
-    access_token = create_access_token(
-        data={"sub": user.username, "role": user.rol.nombre}
-    )
-    return {
-        "usuario_id": user.id,
-        "access_token": access_token,
-        "token_type": "bearer",
-        "role": user.rol.nombre
-    }
+@app.post(ruta_inicial + "token_username", response_model=models.MostrarToken)
+async def login_for_access_token_with_username(form_data: models.UsuarioLoginWithUsername, db: AsyncSession = Depends(get_async_db)):
+    user = (await db.execute(select(UsuarioDB).options(joinedload(UsuarioDB.rol)).where(UsuarioDB.username == form_data.username))).scalars().first()
+    return await emitir_token(db, user, form_data.password)
 
 
 '''--------------------- USUARIOS ---------------------'''
 
 @app.get(ruta_inicial + "usuarios", response_model=List[models.MostrarUsuario])
-def obtener_usuarios(db: Session = Depends(get_db), current_user: UsuarioDB = Depends(get_current_user)):
-    return db.query(UsuarioDB).all()
+def obtener_usuarios(
+    response: Response,
+    limite: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    query = db.query(UsuarioDB).options(joinedload(UsuarioDB.rol), raiseload("*"))
+    return serializacion.respuesta_modelos(
+        models.LISTA_USUARIOS, paginar(query, [UsuarioDB.id], cursor, limite, response), response
+    )
 
 @app.post(ruta_inicial + "usuarios", response_model=models.MostrarUsuario)
-def crear_usuario(usuario: models.UsuarioCreacion, db: Session = Depends(get_db)):
+async def crear_usuario(usuario: models.UsuarioCreacion, db: AsyncSession = Depends(get_async_db)):
     """ Crea un nuevo usuario con la contraseña hasheada """
-    hashed_password = hash_password(usuario.password)  # Hasheamos la contraseña
+    hashed_password = await hash_password(usuario.password)  # Hasheamos la contraseña fuera del event loop
     nuevo_usuario = UsuarioDB(username=usuario.username, password=hashed_password, email=usuario.email, rol_id=usuario.rol_id)
     db.add(nuevo_usuario)
-    db.commit()
-    db.refresh(nuevo_usuario)
+    await db.commit()
+    await db.refresh(nuevo_usuario, attribute_names=["rol"])
     return nuevo_usuario
 
 @app.get(ruta_inicial + "usuarios/{usuario_id}", response_model=models.MostrarUsuario)
-def obtener_usuario(usuario_id: int, db: Session = Depends(get_db), current_user: UsuarioDB = Depends(get_current_user)):
+def obtener_usuario(usuario_id: int, db: Session = Depends(get_db), current_user: models.Principal = Depends(get_current_user)):
     usuario = db.query(UsuarioDB).filter(UsuarioDB.id == usuario_id).first()
     if not usuario:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     return usuario
 
 @app.delete(ruta_inicial + "usuarios/{usuario_id}")
-def eliminar_usuario(usuario_id: int, db: Session = Depends(get_db),current_user: UsuarioDB = Depends(get_current_user)):
+def eliminar_usuario(usuario_id: int, db: Session = Depends(get_db),current_user: models.Principal = Depends(get_current_user)):
     usuario = db.query(UsuarioDB).filter(UsuarioDB.id == usuario_id).first()
     if not usuario:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    dispositivos = db.query(DispositivoDB.id, DispositivoDB.mac).filter(DispositivoDB.usuario_id == usuario_id).all()
+    ids_geocercas = ids_geocercas_de(db, [dispositivo.id for dispositivo in dispositivos], usuario_id)
     db.delete(usuario)
     db.commit()
+    invalidar_cache("principales", usuario_id)
+    for dispositivo in dispositivos:
+        invalidar_cache("dispositivos", normalizar_mac(dispositivo.mac))
+        olvidar_dispositivo(dispositivo.id)
+    for geocerca_id in ids_geocercas:
+        desindexar_geocerca(geocerca_id)
     return {"message": "Usuario eliminado"}
 
-def enviar_correo(destinatario: str, asunto: str, cuerpo: str):
-    mensaje = MIMEMultipart()
-    mensaje['From'] = MI_CORREO
-    mensaje['To'] = destinatario
-    mensaje['Subject'] = asunto
-    mensaje.attach(MIMEText(cuerpo, 'plain', 'utf-8'))
-    try:
-        servidor = smtplib.SMTP('smtp.gmail.com', 587)
-        servidor.starttls()
-        servidor.login(MI_CORREO, PASSWORD_GMAIL)
-        servidor.sendmail(MI_CORREO, destinatario, mensaje.as_string())
-        servidor.quit()
-        print("Correo enviado correctamente")
-    except Exception as e:
-        print("Error al enviar correo:", e)
-
 # Endpoint para solicitar cambio de contraseña
 @app.post(ruta_inicial + "usuarios/cambiar_contrasena/{usuario_id}")
 def pedir_cambio_contrasena(usuario_id: int, db: Session = Depends(get_db)):
@@ -184,11 +344,15 @@ def pedir_cambio_contrasena(usuario_id: int, db: Session = Depends(get_db)):
 
     if not usuario:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    if not usuario.email:
+        raise HTTPException(status_code=400, detail="El usuario no tiene correo electrónico")
 
     destinatario = usuario.email
     asunto = "Cambio de contrasena"
     mensaje = f"Para cambiar tu contrasena, haz clic en el siguiente enlace: http://{base_url}{ruta_inicial}usuarios/cambiar_contrasena/{usuario_id}/{token}"
-    enviar_correo(destinatario=destinatario, asunto=asunto, cuerpo=mensaje)
+    # Se responde en cuanto el correo está en la cola; el envío ocurre en segundo plano
+    if not cola_correo.encolar(destinatario=destinatario, asunto=asunto, cuerpo=mensaje):
+        raise HTTPException(status_code=503, detail="Cola de correo llena, inténtalo más tarde")
 
     return {
         "mensaje": "Se ha enviado un correo para cambiar la contraseña",
@@ -196,21 +360,21 @@ def pedir_cambio_contrasena(usuario_id: int, db: Session = Depends(get_db)):
 
 # Endpoint para realizar el cambio de contraseña
 @app.post(ruta_inicial + "usuarios/cambiar_contrasena/{usuario_id}/{token}")
-def cambiar_contrasena( usuario_id: int, token: str , datos: models.UsuarioCambioContrasena ,db: Session = Depends(get_db)):
+async def cambiar_contrasena( usuario_id: int, token: str , datos: models.UsuarioCambioContrasena ,db: AsyncSession = Depends(get_async_db)):
     payload = verify_token(token)
     if payload is None or payload.get("sub") != "cambiar_contrasena":
         raise HTTPException(status_code=401, detail="Invalid token")
 
     # Verificar si el usuario existe
-    usuario = db.query(UsuarioDB).filter(UsuarioDB.id == usuario_id).first()
+    usuario = await db.get(UsuarioDB, usuario_id)
     if not usuario:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
     # Cambiar la contraseña
-    hashed_password = hash_password(datos.nueva_contrasena)
+    hashed_password = await hash_password(datos.nueva_contrasena)
     usuario.password = hashed_password
-    db.commit()
-    db.refresh(usuario)
+    await db.commit()
+    invalidar_cache("principales", usuario_id)
     return {"message": "Contraseña cambiada exitosamente"}
 
 
@@ -218,8 +382,77 @@ def cambiar_contrasena( usuario_id: int, token: str , datos: models.UsuarioCambi
 '''--------------------- DISPOSITIVOS ---------------------'''
 
 @app.get(ruta_inicial + "dispositivos", response_model=List[models.MostrarDispositivo])
-def obtener_dispositivos(db: Session = Depends(get_db), current_user: UsuarioDB = Depends(get_current_user)):
-    return db.query(DispositivoDB).all()
+def obtener_dispositivos(
+    response: Response,
+    limite: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    query = db.query(DispositivoDB).options(
+        joinedload(DispositivoDB.usuario).joinedload(UsuarioDB.rol),
+        raiseload("*"),
+    )
+    return serializacion.respuesta_modelos(
+        models.LISTA_DISPOSITIVOS, paginar(query, [DispositivoDB.id], cursor, limite, response), response
+    )
+
+
+# Último fix por dispositivo: O(dispositivos), sin tocar el historial de registros
+@app.get(ruta_inicial + "dispositivos/posiciones_actuales", response_model=List[models.PosicionActual])
+async def obtener_posiciones_actuales(
+    actualizado_desde: Optional[datetime.datetime] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    query = select(UltimaPosicionDB)
+    if actualizado_desde is not None:
+        query = query.where(UltimaPosicionDB.actualizado > actualizado_desde)
+    return serializacion.respuesta_modelos(models.LISTA_POSICIONES, (await db.execute(query)).scalars().all())
+
+@app.get(ruta_inicial + "dispositivos/usuario/{usuario_id}/posiciones_actuales", response_model=List[models.PosicionActual])
+async def obtener_posiciones_actuales_por_usuario(
+    usuario_id: int,
+    actualizado_desde: Optional[datetime.datetime] = None,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    query = (
+        select(UltimaPosicionDB)
+        .join(DispositivoDB, DispositivoDB.id == UltimaPosicionDB.dispositivo_id)
+        .where(DispositivoDB.usuario_id == usuario_id)
+    )
+    if actualizado_desde is not None:
+        query = query.where(UltimaPosicionDB.actualizado > actualizado_desde)
+    return serializacion.respuesta_modelos(models.LISTA_POSICIONES, (await db.execute(query)).scalars().all())
+
+
+RADIO_MAXIMO_CERCANOS = 100000  # metros
+
+# Antes de dispositivos/{dispositivo_id}: "cercanos" no es un id
+@app.get(ruta_inicial + "dispositivos/cercanos", response_model=List[models.DispositivoCercano])
+async def obtener_dispositivos_cercanos(
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    radio: float = Query(..., gt=0, le=RADIO_MAXIMO_CERCANOS, description="Metros"),
+    usuario_id: Optional[int] = None,
+    limite: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    """
+    Dispositivos cuya última posición está a `radio` metros o menos, del más cercano al más lejano.
+    Sin `usuario_id` se buscan los del usuario autenticado; solo root y admin pueden pedir los de otro usuario
+    o, sin `usuario_id`, los de todos
+    """
+    if current_user.rol not in ("root", "admin"):
+        if usuario_id is not None and usuario_id != current_user.id:
+            raise HTTPException(status_code=403, detail="No puedes consultar los dispositivos de otro usuario")
+        usuario_id = current_user.id
+    cercanos = indice_posiciones.cercanos(lat, lon, radio, usuario_id, limite)
+    return serializacion.respuesta_json([
+        {"dispositivo_id": dispositivo_id, "distancia": distancia, "latitud": latitud, "longitud": longitud, "fecha": fecha}
+        for dispositivo_id, distancia, latitud, longitud, fecha in cercanos
+    ])
 
 
 def validacion_mac(mac):
@@ -228,7 +461,7 @@ def validacion_mac(mac):
     return re.match(patron, mac) is not None
 
 @app.post(ruta_inicial + "dispositivos/{id_usuario}", response_model=models.MostrarDispositivo)
-def crear_dispositivo(id_usuario: int,dispositivo: models.CrearDispositivo, db: Session = Depends(get_db), current_user: UsuarioDB = Depends(get_current_user)):
+def crear_dispositivo(id_usuario: int,dispositivo: models.CrearDispositivo, db: Session = Depends(get_db), current_user: models.Principal = Depends(get_current_user)):
     usuario_existente = db.query(UsuarioDB).filter(UsuarioDB.id == id_usuario).first()
 
     if not usuario_existente:
@@ -241,37 +474,100 @@ def crear_dispositivo(id_usuario: int,dispositivo: models.CrearDispositivo, db:
     db.add(nuevo_dispositivo)
     db.commit()
     db.refresh(nuevo_dispositivo)
+    # Puede haber una entrada negativa cacheada para esta MAC
+    invalidar_cache("dispositivos", normalizar_mac(nuevo_dispositivo.mac))
     return nuevo_dispositivo
 
 # Obtener dispositivo por id
 @app.get(ruta_inicial + "dispositivos/{dispositivo_id}", response_model=models.MostrarDispositivo)
-def obtener_dispositivo(dispositivo_id: int, db: Session = Depends(get_db), current_user: UsuarioDB = Depends(get_current_user)):
+def obtener_dispositivo(dispositivo_id: int, db: Session = Depends(get_db), current_user: models.Principal = Depends(get_current_user)):
     dispositivo = db.query(DispositivoDB).filter(DispositivoDB.id == dispositivo_id).first()
     if not dispositivo:
         raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
     return dispositivo
 
 @app.get(ruta_inicial + "dispositivos/usuario/{usuario_id}", response_model=List[models.MostrarDispositivoSinUsuario])
-def obtener_dispositivo_por_usuario(usuario_id: int, db: Session = Depends(get_db), current_user: UsuarioDB = Depends(get_current_user)):
-    dispositivos = db.query(DispositivoDB).filter(DispositivoDB.usuario_id == usuario_id).all()
+def obtener_dispositivo_por_usuario(usuario_id: int, db: Session = Depends(get_db), current_user: models.Principal = Depends(get_current_user)):
+    dispositivos = db.query(DispositivoDB).options(raiseload("*")).filter(DispositivoDB.usuario_id == usuario_id).all()
     if not dispositivos:
         raise HTTPException(status_code=404, detail="No se encontraron dispositivos para este usuario")
-    return dispositivos
+    return serializacion.respuesta_modelos(models.LISTA_DISPOSITIVOS_SIN_USUARIO, dispositivos)
+
+# Trayecto simplificado de un dispositivo en una ventana de tiempo (por defecto, las últimas 24 h)
+@app.get(ruta_inicial + "dispositivos/{dispositivo_id}/ruta")
+async def obtener_ruta(
+    dispositivo_id: int,
+    desde: Optional[datetime.datetime] = None,
+    hasta: Optional[datetime.datetime] = None,
+    tolerancia: float = Query(10.0, ge=0, description="Tolerancia de Douglas-Peucker en metros (0 = sin simplificar)"),
+    max_puntos: Optional[int] = Query(None, ge=2, le=100000, description="Submuestreo temporal tras la simplificación"),
+    formato: str = Query("json", pattern="^(json|polilinea)$"),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    hasta = hasta or datetime.datetime.utcnow()
+    desde = desde or hasta - datetime.timedelta(days=1)
+    filas = (await db.execute(
+        select(RegistroDB.fecha, RegistroDB.latitud, RegistroDB.longitud)
+        .where(
+            RegistroDB.dispositivo_id == dispositivo_id,
+            RegistroDB.fecha >= desde,
+            RegistroDB.fecha < hasta,
+            RegistroDB.latitud.is_not(None),
+        )
+        .order_by(RegistroDB.fecha, RegistroDB.id)
+    )).all()
+
+    fechas = np.array([fila.fecha for fila in filas], dtype="datetime64[ms]")
+    latitud = np.array([fila.latitud for fila in filas], dtype=np.float64)
+    longitud = np.array([fila.longitud for fila in filas], dtype=np.float64)
+
+    indices = np.arange(len(filas))
+    if tolerancia > 0:
+        indices = np.flatnonzero(simplificacion.douglas_peucker(latitud, longitud, tolerancia))
+    if max_puntos is not None and len(indices) > max_puntos:
+        segundos = fechas[indices].astype(np.int64) / 1000
+        indices = indices[simplificacion.submuestreo_temporal(segundos, max_puntos)]
+
+    fechas, latitud, longitud = fechas[indices], latitud[indices], longitud[indices]
+    respuesta = {
+        "dispositivo_id": dispositivo_id,
+        "puntos_originales": len(filas),
+        "num_puntos": len(indices),
+    }
+    if formato == "polilinea":
+        # Polilínea codificada + segundos desde `inicio` en deltas
+        segundos = fechas.astype("datetime64[s]").astype(np.int64)
+        respuesta["inicio"] = fechas[0].item().isoformat() if len(fechas) else None
+        respuesta["polilinea"] = simplificacion.codificar_polilinea(latitud, longitud)
+        respuesta["tiempos"] = simplificacion.codificar_deltas(segundos - segundos[0]) if len(segundos) else []
+    else:
+        respuesta["puntos"] = [
+            {"fecha": fecha.isoformat(), "latitud": lat, "longitud": lon}
+            for fecha, lat, lon in zip(fechas.tolist(), latitud.tolist(), longitud.tolist())
+        ]
+    return respuesta
 
 @app.delete(ruta_inicial + "dispositivos/{dispositivo_id}")
-def eliminar_dispositivo(dispositivo_id: int, db: Session = Depends(get_db),current_user: UsuarioDB = Depends(get_current_user)):
+def eliminar_dispositivo(dispositivo_id: int, db: Session = Depends(get_db),current_user: models.Principal = Depends(get_current_user)):
     dispositivo = db.query(DispositivoDB).filter(DispositivoDB.id == dispositivo_id).first()
     if not dispositivo:
         raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    ids_geocercas = ids_geocercas_de(db, [dispositivo_id])
     db.delete(dispositivo)
     db.commit()
+    invalidar_cache("dispositivos", normalizar_mac(dispositivo.mac))
+    olvidar_dispositivo(dispositivo_id)
+    for geocerca_id in ids_geocercas:
+        desindexar_geocerca(geocerca_id)
     return {"message": "Dispositivo eliminado"}
 
 @app.patch(ruta_inicial + "dispositivos/{dispositivo_id}", response_model=models.MostrarDispositivo)
-def actualizar_dispositivo(dispositivo_id: int, dispositivo: models.ActualizarDispositivo, db: Session = Depends(get_db),current_user: UsuarioDB = Depends(get_current_user)):
+def actualizar_dispositivo(dispositivo_id: int, dispositivo: models.ActualizarDispositivo, db: Session = Depends(get_db),current_user: models.Principal = Depends(get_current_user)):
     dispositivo_existente = db.query(DispositivoDB).filter(DispositivoDB.id == dispositivo_id).first()
     if not dispositivo_existente:
         raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    mac_anterior = dispositivo_existente.mac
     
     if(dispositivo.mac is not None):
         if validacion_mac(dispositivo.mac):
@@ -285,82 +581,955 @@ def actualizar_dispositivo(dispositivo_id: int, dispositivo: models.ActualizarDi
 
     db.commit()
     db.refresh(dispositivo_existente)
+    invalidar_cache("dispositivos", normalizar_mac(mac_anterior))
+    invalidar_cache("dispositivos", normalizar_mac(dispositivo_existente.mac))
     return dispositivo_existente
 
 
 '''--------------------- ROLES ---------------------'''
 @app.get(ruta_inicial + "roles", response_model=List[models.Rol])
-def obtener_roles(db: Session = Depends(get_db), current_user: UsuarioDB = Depends(get_current_user)):
+def obtener_roles(db: Session = Depends(get_db), current_user: models.Principal = Depends(get_current_user)):
     return db.query(RolDB).all()
 
+'''--------------------- CACHE ---------------------'''
+@app.get(ruta_inicial + "cache/estadisticas")
+def estadisticas_cache(current_user: models.Principal = Depends(get_current_user)):
+    return {
+        "dispositivos": cache_dispositivos.estadisticas(),
+        "principales": cache_principales.estadisticas(),
+        "tiempo_real": difusor.estadisticas(),
+        "geocercas": indice_geocercas.estadisticas(),
+        "proximidad": indice_posiciones.estadisticas(),
+        "udp": protocolo_udp.estadisticas(),
+        "filtro_ingesta": filtro_ingesta.estadisticas(),
+        "ingesta": buffer_ingesta.estadisticas() if buffer_ingesta is not None else {"modo": INGESTA_MODO},
+        "estado_compartido": estado_compartido.estadisticas(),
+    }
+
+'''--------------------- MÉTRICAS ---------------------'''
+# Fuera de ruta_inicial y sin autenticación, como espera el scraper de Prometheus
+@app.get("/metrics", include_in_schema=False)
+def metricas():
+    cuerpo, tipo = observabilidad.exportar()
+    return Response(content=cuerpo, media_type=tipo)
+
+'''--------------------- SALUD ---------------------'''
+# Sondas de Kubernetes, fuera de ruta_inicial y sin autenticación
+SALUD_TIMEOUT = float(os.getenv("SALUD_TIMEOUT", "2"))
+
+@app.get("/salud/vida", include_in_schema=False)
+async def salud_vida():
+    """ Solo comprueba que el event loop responde: una BBDD caída no se arregla reiniciando el pod """
+    return {"estado": "ok"}
+
+
+def estado_pool(pool) -> dict:
+    return {
+        "tamano": pool.size(),
+        "en_uso": pool.checkedout(),
+        "libres": pool.checkedin(),
+        "desbordamiento": pool.overflow(),
+    }
+
+
+def comprobar_bbdd_sync():
+    with engine.connect() as conexion:
+        conexion.execute(text("SELECT 1"))
+
+
+async def comprobar_bbdd_async():
+    async with async_engine.connect() as conexion:
+        await conexion.execute(text("SELECT 1"))
+
+
+@app.get("/salud/listo", include_in_schema=False)
+async def salud_listo(response: Response):
+    """
+    503 si alguna BBDD o el estado compartido no responden en SALUD_TIMEOUT segundos. Un pool agotado
+    también da 503 (no se consigue conexión a tiempo) y saca el pod del balanceo hasta que se libere
+    """
+    comprobaciones = {}
+    for nombre, comprobacion in (
+        ("bbdd_sync", asyncio.to_thread(comprobar_bbdd_sync)),
+        ("bbdd_async", comprobar_bbdd_async()),
+        ("estado_compartido", estado_compartido.ping()),
+    ):
+        try:
+            resultado = await asyncio.wait_for(comprobacion, SALUD_TIMEOUT)
+            comprobaciones[nombre] = "ok" if resultado is not False else "error"
+        except asyncio.TimeoutError:
+            comprobaciones[nombre] = "timeout"
+        except Exception as e:
+            comprobaciones[nombre] = f"error: {e.__class__.__name__}"
+    listo = all(valor == "ok" for valor in comprobaciones.values())
+    if not listo:
+        response.status_code = 503
+    return {
+        "estado": "ok" if listo else "no listo",
+        "comprobaciones": comprobaciones,
+        "pools": {"sync": estado_pool(engine.pool), "async": estado_pool(async_engine.pool)},
+    }
+
 '''--------------------- REGISTROS ---------------------'''
 
+# Columnas de un registro con su dispositivo, en el orden de serializacion.fila_registro
+COLUMNAS_REGISTRO = (
+    RegistroDB.id, RegistroDB.fecha, RegistroDB.latitud, RegistroDB.longitud, RegistroDB.altitud, RegistroDB.velocidad,
+    RegistroDB.dispositivo_id, DispositivoDB.mac, DispositivoDB.nombre, DispositivoDB.active, DispositivoDB.usuario_id,
+)
+ORDEN_REGISTROS = [RegistroDB.fecha, RegistroDB.id]
+TAMANO_PAGINA_NDJSON = 5000
+
+def consulta_registros(db: Session, dispositivo_id=None, desde=None, hasta=None,
+                       lat_min=None, lat_max=None, lon_min=None, lon_max=None):
+    """ Tuplas de columnas (sin objetos ORM) de los registros que cumplen los filtros """
+    query = db.query(*COLUMNAS_REGISTRO).join(DispositivoDB, DispositivoDB.id == RegistroDB.dispositivo_id)
+    if dispositivo_id is not None:
+        query = query.filter(RegistroDB.dispositivo_id == dispositivo_id)
+    if desde is not None:
+        query = query.filter(RegistroDB.fecha >= desde)
+    if hasta is not None:
+        query = query.filter(RegistroDB.fecha < hasta)
+    if lat_min is not None:
+        query = query.filter(RegistroDB.latitud >= lat_min)
+    if lat_max is not None:
+        query = query.filter(RegistroDB.latitud <= lat_max)
+    if lon_min is not None:
+        query = query.filter(RegistroDB.longitud >= lon_min)
+    if lon_max is not None:
+        query = query.filter(RegistroDB.longitud <= lon_max)
+    return query
+
+
+def transmitir_registros(filtros: dict, desde: Optional[list]):
+    # La sesión de Depends(get_db) se cierra antes de enviar el cuerpo: el flujo abre la suya
+    with SessionLocal() as db:
+        for filas in recorrer(consulta_registros(db, **filtros), ORDEN_REGISTROS, desde, TAMANO_PAGINA_NDJSON):
+            yield [serializacion.fila_registro(fila) for fila in filas]
+
+
 @app.get(ruta_inicial + "registros", response_model=List[models.MostrarRegistro])
-def obtener_registros(db: Session = Depends(get_db), current_user: UsuarioDB = Depends(get_current_user)):
-    return db.query(RegistroDB).all()
+def obtener_registros(
+    request: Request,
+    response: Response,
+    limite: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    cursor: Optional[str] = None,
+    dispositivo_id: Optional[int] = None,
+    desde: Optional[datetime.datetime] = None,
+    hasta: Optional[datetime.datetime] = None,
+    lat_min: Optional[float] = None,
+    lat_max: Optional[float] = None,
+    lon_min: Optional[float] = None,
+    lon_max: Optional[float] = None,
+    db: Session = Depends(get_db),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    """
+    Historial paginado por (fecha, id); la siguiente página se pide con la cabecera X-Siguiente-Cursor.
+    Con `Accept: application/x-ndjson` se envían todas las filas desde el cursor, una por línea, sin `limite`
+    """
+    filtros = {
+        "dispositivo_id": dispositivo_id, "desde": desde, "hasta": hasta,
+        "lat_min": lat_min, "lat_max": lat_max, "lon_min": lon_min, "lon_max": lon_max,
+    }
+    if serializacion.pide_ndjson(request):
+        inicio = decodificar_cursor(cursor, ORDEN_REGISTROS) if cursor else None
+        return serializacion.respuesta_ndjson(transmitir_registros(filtros, inicio))
+    filas = paginar(consulta_registros(db, **filtros), ORDEN_REGISTROS, cursor, limite, response)
+    return serializacion.respuesta_json([serializacion.fila_registro(fila) for fila in filas], response)
+
 
+# Columnas de la exportación, en el orden de exportacion.COLUMNAS
+COLUMNAS_EXPORTACION = (
+    RegistroDB.id, RegistroDB.fecha, RegistroDB.dispositivo_id,
+    RegistroDB.latitud, RegistroDB.longitud, RegistroDB.altitud, RegistroDB.velocidad,
+)
+TAMANO_LOTE_EXPORTACION = int(os.getenv("TAMANO_LOTE_EXPORTACION", "10000"))
+
+def consulta_exportacion(instantanea: int, dispositivo_id=None, usuario_id=None, desde=None, hasta=None, reanudar=None):
+    """ Registros con id <= instantanea que cumplen los filtros, detrás de (fecha, id) = `reanudar` si se da """
+    consulta = select(*COLUMNAS_EXPORTACION).where(RegistroDB.id <= instantanea)
+    if usuario_id is not None:
+        consulta = consulta.join(DispositivoDB, DispositivoDB.id == RegistroDB.dispositivo_id).where(
+            DispositivoDB.usuario_id == usuario_id
+        )
+    if dispositivo_id is not None:
+        consulta = consulta.where(RegistroDB.dispositivo_id == dispositivo_id)
+    if desde is not None:
+        consulta = consulta.where(RegistroDB.fecha >= desde)
+    if hasta is not None:
+        consulta = consulta.where(RegistroDB.fecha < hasta)
+    if reanudar is not None:
+        consulta = consulta.where(tuple_(*ORDEN_REGISTROS) > tuple_(*reanudar))
+    return consulta.order_by(*ORDEN_REGISTROS)
+
+
+def lotes_exportacion(consulta):
+    # Un solo cursor de servidor (yield_per activa stream_results en psycopg2): una instantánea MVCC
+    # y como mucho TAMANO_LOTE_EXPORTACION filas en memoria. Ocupa una conexión del pool mientras dura
+    with SessionLocal() as db:
+        resultado = db.execute(consulta.execution_options(yield_per=TAMANO_LOTE_EXPORTACION))
+        for lote in resultado.partitions():
+            yield lote
+
+
+@app.get(ruta_inicial + "registros/exportar")
+def exportar_registros(
+    formato: str = Query(exportacion.FORMATO_CSV, pattern=f"^({exportacion.FORMATO_CSV}|{exportacion.FORMATO_COLUMNAR})$"),
+    dispositivo_id: Optional[int] = None,
+    usuario_id: Optional[int] = None,
+    desde: Optional[datetime.datetime] = None,
+    hasta: Optional[datetime.datetime] = None,
+    instantanea: Optional[int] = Query(None, ge=0),
+    reanudar_fecha: Optional[datetime.datetime] = None,
+    reanudar_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    """
+    Historial completo en flujo, ordenado por (fecha, id), como CSV con gzip o en el formato columnar de exportacion.py.
+    Solo incluye registros con id <= `instantanea` (por defecto el último al empezar, devuelto en X-Instantanea).
+    Para continuar una descarga cortada se repite la petición con la misma `instantanea` y la fecha e id
+    de la última fila recibida entera en `reanudar_fecha` y `reanudar_id`
+    """
+    if (reanudar_fecha is None) != (reanudar_id is None):
+        raise HTTPException(status_code=400, detail="reanudar_fecha y reanudar_id van juntos")
+    if reanudar_id is not None and instantanea is None:
+        raise HTTPException(status_code=400, detail="Para reanudar hace falta la instantánea de la primera descarga")
+    if instantanea is None:
+        instantanea = db.query(func.max(RegistroDB.id)).scalar() or 0
+    reanudar = (reanudar_fecha, reanudar_id) if reanudar_id is not None else None
+    lotes = lotes_exportacion(consulta_exportacion(instantanea, dispositivo_id, usuario_id, desde, hasta, reanudar))
+
+    if formato == exportacion.FORMATO_CSV:
+        # Al reanudar no se repite la cabecera: las partes descomprimidas se concatenan tal cual
+        cuerpo = exportacion.csv_gzip(lotes, cabecera=reanudar_id is None)
+    else:
+        cuerpo = exportacion.columnar(lotes)
+    tipo, nombre = exportacion.FORMATOS[formato]
+    return StreamingResponse(cuerpo, media_type=tipo, headers={
+        "Content-Disposition": f'attachment; filename="{nombre}"',
+        "X-Instantanea": str(instantanea),
+        # El cuerpo se genera y comprime al vuelo: se reanuda por (fecha, id), no por bytes
+        "Accept-Ranges": "none",
+    })
+
+
+async def resolver_dispositivos(db: AsyncSession, macs) -> dict:
+    """ Resuelve cada MAC a su dispositivo (o None) pasando primero por la cache """
+    resultado = {}
+    pendientes = {}
+    for mac in set(macs):
+        clave = normalizar_mac(mac)
+        encontrado, dispositivo = cache_dispositivos.obtener(clave)
+        if encontrado:
+            resultado[mac] = dispositivo
+        else:
+            pendientes.setdefault(clave, []).append(mac)
+
+    if pendientes:
+        candidatas = set()
+        for clave in pendientes:
+            candidatas.update(variantes_mac(clave))
+        encontrados = {
+            normalizar_mac(dispositivo.mac): models.Dispositivo.model_validate(dispositivo, from_attributes=True)
+            for dispositivo in (await db.execute(select(DispositivoDB).where(DispositivoDB.mac.in_(candidatas)))).scalars()
+        }
+        for clave, originales in pendientes.items():
+            dispositivo = encontrados.get(clave)
+            cache_dispositivos.guardar(clave, dispositivo)
+            for mac in originales:
+                resultado[mac] = dispositivo
+
+    return resultado
+
+
+async def actualizar_ultimas_posiciones(db: AsyncSession, filas: list) -> list:
+    """
+    Upsert en ultimas_posiciones del fix más reciente de cada dispositivo de `filas`; devuelve las posiciones
+    que se han aplicado (no las que la BBDD ya tenía más recientes)
+    """
+    ultimas = {}
+    for fila in filas:
+        actual = ultimas.get(fila["dispositivo_id"])
+        if actual is None or fila["fecha"] >= actual["fecha"]:
+            ultimas[fila["dispositivo_id"]] = fila
+
+    ahora = datetime.datetime.utcnow()
+    valores = [
+        {
+            "dispositivo_id": fila["dispositivo_id"],
+            "registro_id": fila["id"],
+            "fecha": fila["fecha"],
+            "latitud": fila["latitud"],
+            "longitud": fila["longitud"],
+            "altitud": fila["altitud"],
+            "velocidad": fila["velocidad"],
+            "actualizado": ahora,
+        }
+        for fila in ultimas.values()
+    ]
+    dialecto = sqlite if db.bind.dialect.name == "sqlite" else postgresql
+    stmt = dialecto.insert(UltimaPosicionDB).values(valores)
+    # Un fix antiguo reenviado tarde no pisa una posición más reciente
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UltimaPosicionDB.dispositivo_id],
+        set_={columna: stmt.excluded[columna] for columna in valores[0] if columna != "dispositivo_id"},
+        where=UltimaPosicionDB.fecha <= stmt.excluded.fecha,
+    ).returning(UltimaPosicionDB.dispositivo_id)
+    aplicadas = set((await db.execute(stmt)).scalars())
+    return [valor for valor in valores if valor["dispositivo_id"] in aplicadas]
+
+
+def mensajes_posiciones(posiciones: list) -> list:
+    """ [(dispositivo_id, mensaje)] con lo que reciben los clientes suscritos por WebSocket """
+    return [
+        (posicion["dispositivo_id"], {
+            **posicion,
+            "coordenadas": f"{posicion['latitud']},{posicion['longitud']}",
+            "fecha": posicion["fecha"].isoformat(),
+            "actualizado": posicion["actualizado"].isoformat(),
+        })
+        for posicion in posiciones
+    ]
+
+
+def evaluar_geocercas(filas: list, usuarios: dict) -> list:
+    """ Transiciones de geocerca de `filas` (ya con id), en orden cronológico; `usuarios` es dispositivo_id -> usuario_id """
+    eventos = []
+    for fila in sorted(filas, key=lambda fila: fila["fecha"]):
+        transiciones = indice_geocercas.evaluar(
+            fila["dispositivo_id"], usuarios.get(fila["dispositivo_id"]), fila["latitud"], fila["longitud"], fila["fecha"]
+        )
+        for geocerca_id, tipo in transiciones:
+            eventos.append({
+                "geocerca_id": geocerca_id,
+                "dispositivo_id": fila["dispositivo_id"],
+                "registro_id": fila["id"],
+                "tipo": tipo,
+                "fecha": fila["fecha"],
+                "latitud": fila["latitud"],
+                "longitud": fila["longitud"],
+            })
+    return eventos
+
+
+def mensajes_eventos_geocerca(eventos: list) -> list:
+    return [
+        (evento["dispositivo_id"], {
+            "evento": evento["tipo"],
+            **evento,
+            "fecha": evento["fecha"].isoformat(),
+        })
+        for evento in eventos
+    ]
+
+
+def difundir(mensajes: list, dispositivo_ids):
+    """
+    Entrega local a los WebSocket de este worker y un único mensaje por lote al resto, que reparte
+    las posiciones a sus clientes y adopta el estado de geocerca y la última posición de estos dispositivos
+    """
+    for dispositivo_id, mensaje in mensajes:
+        difusor.publicar(dispositivo_id, mensaje)
+    if not estado_compartido.distribuido:
+        return
+    estados = [
+        (dispositivo_id, fecha.isoformat(), dentro)
+        for dispositivo_id, fecha, dentro in indice_geocercas.estados(dispositivo_ids)
+    ]
+    posiciones = [
+        (dispositivo_id, usuario_id, latitud, longitud, fecha.isoformat())
+        for dispositivo_id, usuario_id, latitud, longitud, fecha in indice_posiciones.posiciones(dispositivo_ids)
+    ]
+    estado_compartido.publicar(CANAL_TIEMPO_REAL, {"mensajes": mensajes, "estados": estados, "posiciones": posiciones})
+
+
+def aplicar_tiempo_real(mensaje: dict):
+    for dispositivo_id, fecha, dentro in mensaje["estados"]:
+        indice_geocercas.fijar_estado(dispositivo_id, datetime.datetime.fromisoformat(fecha), dentro)
+    # Workers de una versión anterior no envían posiciones
+    for dispositivo_id, usuario_id, latitud, longitud, fecha in mensaje.get("posiciones", ()):
+        indice_posiciones.actualizar(dispositivo_id, usuario_id, latitud, longitud, datetime.datetime.fromisoformat(fecha))
+    for dispositivo_id, datos in mensaje["mensajes"]:
+        difusor.publicar(dispositivo_id, datos)
+
+
+async def almacenar_registros(db: AsyncSession, filas: list, usuarios: dict) -> list:
+    """
+    Camino común de escritura de fixes ya validados: INSERT multi-fila, última posición y eventos de geocerca
+    en una sola transacción, y publicación en tiempo real tras el commit. Devuelve los ids en el orden de `filas`
+    """
+    ids = (await db.execute(insert(RegistroDB).returning(RegistroDB.id, sort_by_parameter_order=True), filas)).scalars().all()
+    for fila, nuevo_id in zip(filas, ids):
+        fila["id"] = nuevo_id
+    posiciones = await actualizar_ultimas_posiciones(db, filas)
+    eventos = evaluar_geocercas(filas, usuarios)
+    if eventos:
+        await db.execute(insert(EventoGeocercaDB), eventos)
+    await db.commit()
+    for posicion in posiciones:
+        indice_posiciones.actualizar(
+            posicion["dispositivo_id"], usuarios.get(posicion["dispositivo_id"]),
+            posicion["latitud"], posicion["longitud"], posicion["fecha"],
+        )
+    difundir(
+        mensajes_posiciones(posiciones) + mensajes_eventos_geocerca(eventos),
+        {fila["dispositivo_id"] for fila in filas},
+    )
+    return ids
 
-# Funcion para formatear la fecha
-def formateo(datos_gnss):
+
+async def escribir_lote_diferido(filas: list, usuarios: dict) -> list:
     try:
-        print(f"Datos GNSS recibidos: {datos_gnss}")  # Debugging
+        async with AsyncSessionLocal() as db:
+            return await almacenar_registros(db, filas, usuarios)
+    finally:
+        actualizar_cola_ingesta()
+
+buffer_ingesta = None
+if INGESTA_MODO != "directo":
+    buffer_ingesta = ingesta.BufferIngesta(
+        escribir_lote_diferido,
+        modo=INGESTA_MODO,
+        max_filas=int(os.getenv("INGESTA_MAX_FILAS", "500")),
+        intervalo_ms=float(os.getenv("INGESTA_INTERVALO_MS", "50")),
+        max_cola=int(os.getenv("INGESTA_MAX_COLA", "20000")),
+    )
 
-        # Eliminar el prefijo "+CGPSINFO:" si está presente
-        datos_gnss = re.sub(r"^\+CGPSINFO:\s*", "", datos_gnss)
 
-        partes = datos_gnss.split(',')[:4]  # Solo tomamos las primeras 4 partes (lat, N/S, lon, E/W)
+def actualizar_cola_ingesta():
+    # Se fija al encolar y al escribir (no con set_function): así también funciona con varios workers
+    if buffer_ingesta is not None:
+        observabilidad.INGESTA_EN_COLA.set(buffer_ingesta.pendientes())
 
-        if len(partes) < 4:
-            raise ValueError("Formato de datos GNSS incorrecto.")
 
-        lat_dmm, ns, lon_dmm, ew = map(str.strip, partes)
+def contar_rechazo(canal: str, motivo: str, cantidad: int = 1):
+    observabilidad.REGISTROS_RECHAZADOS.labels(canal, motivo).inc(cantidad)
 
-        # Convertir latitud
-        lat_grados = int(lat_dmm[:2])
-        lat_minutos = float(lat_dmm[2:]) / 60
-        lat_decimal = lat_grados + lat_minutos
-        if ns == 'S':
-            lat_decimal *= -1
 
-        # Convertir longitud
-        lon_grados = int(lon_dmm[:3])
-        lon_minutos = float(lon_dmm[3:]) / 60
-        lon_decimal = lon_grados + lon_minutos
-        if ew == 'W':
-            lon_decimal *= -1
+def fecha_futura(fecha: datetime.datetime, ahora: datetime.datetime) -> bool:
+    return fecha > ahora + MAX_ADELANTO_FECHA
 
-        coordenadas = f"{lat_decimal},{lon_decimal}"
 
-        print(f"Coordenadas convertidas: {coordenadas}")  # Debugging
-        return coordenadas
+async def marcar_duplicados(filas: list, canal: str) -> list:
+    """ Para cada fila, si filtro_ingesta la descarta por repetida; cuenta los descartes """
+    duplicados = await filtro_ingesta.duplicados_de(filas)
+    if any(duplicados):
+        contar_rechazo(canal, MOTIVO_DUPLICADO, sum(duplicados))
+    return duplicados
 
-    except Exception as e:
-        print("Fallo en el formateo:", e)
-        return None
+
+async def guardar_registros(db: AsyncSession, filas: list, usuarios: dict, canal: str) -> Optional[list]:
+    """ Escribe directamente o a través del buffer; en modo "encolar" no hay ids todavía (None) """
+    if buffer_ingesta is None:
+        ids = await almacenar_registros(db, filas, usuarios)
+        await filtro_ingesta.recordar(filas)
+        observabilidad.REGISTROS_ACEPTADOS.labels(canal).inc(len(filas))
+        return ids
+    # La conexión de la petición (la de resolver_dispositivos) vuelve al pool antes de esperar al escritor,
+    # que necesita otra del mismo pool: si no, con tantas peticiones como conexiones el lote nunca se escribe
+    await db.close()
+    try:
+        ids = await buffer_ingesta.guardar(filas, usuarios)
+        await filtro_ingesta.recordar(filas)
+        observabilidad.REGISTROS_ACEPTADOS.labels(canal).inc(len(filas))
+        return ids
+    except ingesta.ColaLlena:
+        observabilidad.REGISTROS_RECHAZADOS.labels(canal, "Ingesta saturada").inc(len(filas))
+        raise HTTPException(
+            status_code=503,
+            detail="Ingesta saturada, inténtalo más tarde",
+            headers={"Retry-After": str(buffer_ingesta.espera_estimada())},
+        )
+    except Exception:
+        # El escritor ya lo ha registrado; el lote no se escribió y el tracker puede reintentar
+        observabilidad.REGISTROS_RECHAZADOS.labels(canal, "Error de escritura").inc(len(filas))
+        raise HTTPException(
+            status_code=503,
+            detail="No se pudo escribir el lote, inténtalo más tarde",
+            headers={"Retry-After": str(buffer_ingesta.espera_estimada())},
+        )
+    finally:
+        actualizar_cola_ingesta()
 
 
 @app.post(ruta_inicial + "registros", response_model=models.MostrarRegistro)
-def crear_registro(registro: models.CrearRegistro, db: Session = Depends(get_db)):
-    dispositivo_existente = db.query(DispositivoDB).filter(DispositivoDB.mac == registro.mac).first()
+async def crear_registro(registro: models.CrearRegistro, response: Response, db: AsyncSession = Depends(get_async_db)):
+    dispositivo_existente = (await resolver_dispositivos(db, [registro.mac]))[registro.mac]
     if not dispositivo_existente:
+        contar_rechazo("rest", "Dispositivo no encontrado")
         raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
-    print(f"Dispositivo encontrado: {dispositivo_existente}")  
+    espera = (await filtro_ingesta.permitir_envios([dispositivo_existente.id]))[dispositivo_existente.id]
+    if espera:
+        contar_rechazo("rest", MOTIVO_LIMITE)
+        raise HTTPException(status_code=429, detail=MOTIVO_LIMITE, headers={"Retry-After": str(math.ceil(espera))})
     if not registro.coordenadas:
+        contar_rechazo("rest", gnss.MOTIVO_VACIO)
         raise HTTPException(status_code=400, detail="Datos GNSS no proporcionados")
 
-    # Llamamos a la función formateo para obtener las coordenadas
-    coordenadas = formateo(registro.coordenadas)
-
-    if coordenadas is None:
+    fix = gnss.parsear_linea(registro.coordenadas)
+    if fix is None:
+        contar_rechazo("rest", gnss.MOTIVO_FORMATO)
         raise HTTPException(status_code=400, detail="Datos GNSS inválidos o no disponibles")
 
-    nuevo_registro = RegistroDB(
-        coordenadas=coordenadas,  # Solo almacenamos las coordenadas
-        dispositivo_id=dispositivo_existente.id
+    ahora = datetime.datetime.utcnow()
+    if fecha_futura(registro.fecha or fix.fecha or ahora, ahora):
+        contar_rechazo("rest", MOTIVO_FUTURO)
+        raise HTTPException(status_code=400, detail=MOTIVO_FUTURO)
+
+    fila = {
+        "fecha": registro.fecha or fix.fecha or ahora,
+        "latitud": fix.latitud,
+        "longitud": fix.longitud,
+        "altitud": fix.altitud,
+        "velocidad": fix.velocidad,
+        "dispositivo_id": dispositivo_existente.id,
+    }
+    if (await marcar_duplicados([fila], "rest"))[0]:
+        raise HTTPException(status_code=409, detail=MOTIVO_DUPLICADO)
+    ids = await guardar_registros(db, [fila], {dispositivo_existente.id: dispositivo_existente.usuario_id}, "rest")
+    if ids is None:
+        # Aceptado pero aún sin escribir
+        response.status_code = 202
+    # El dispositivo sale de la cache: sin carga perezosa al serializar
+    return models.MostrarRegistro(
+        id=ids[0] if ids else None,
+        fecha=fila["fecha"],
+        coordenadas=f"{fila['latitud']},{fila['longitud']}",
+        altitud=fila["altitud"],
+        velocidad=fila["velocidad"],
+        dispositivo=dispositivo_existente,
+    )
+
+
+# Ingesta en bloque: los trackers reenvían de golpe los fixes acumulados sin conexión
+@app.post(ruta_inicial + "registros/lote", response_model=List[models.ResultadoRegistroLote])
+async def crear_registros_lote(registros: List[models.CrearRegistro], response: Response, db: AsyncSession = Depends(get_async_db)):
+    if len(registros) > MAX_REGISTROS_LOTE:
+        raise HTTPException(status_code=413, detail=f"Máximo {MAX_REGISTROS_LOTE} registros por lote")
+
+    # Una sola resolución (cache o consulta IN) para todas las MAC distintas del lote
+    dispositivos = await resolver_dispositivos(db, [registro.mac for registro in registros])
+
+    # Todas las líneas GNSS se convierten y validan de una vez
+    lote = gnss.parsear_lote([registro.coordenadas for registro in registros])
+
+    resultados = []
+    filas = []
+    usuarios = {}
+    # El lote es un solo envío por dispositivo: dispositivo_id -> sin fichas
+    esperas = await filtro_ingesta.permitir_envios({dispositivo.id for dispositivo in dispositivos.values() if dispositivo})
+    limitados = {dispositivo_id: espera > 0 for dispositivo_id, espera in esperas.items()}
+    ahora = datetime.datetime.utcnow()
+    for indice, registro in enumerate(registros):
+        dispositivo = dispositivos.get(registro.mac)
+        if dispositivo is None:
+            resultados.append(models.ResultadoRegistroLote(indice=indice, aceptado=False, detalle="Dispositivo no encontrado"))
+            contar_rechazo("lote", "Dispositivo no encontrado")
+            continue
+        if limitados[dispositivo.id]:
+            resultados.append(models.ResultadoRegistroLote(indice=indice, aceptado=False, detalle=MOTIVO_LIMITE))
+            contar_rechazo("lote", MOTIVO_LIMITE)
+            continue
+
+        fix = lote.fix(indice)
+        if fix is None:
+            resultados.append(models.ResultadoRegistroLote(indice=indice, aceptado=False, detalle=lote.motivos[indice]))
+            contar_rechazo("lote", lote.motivos[indice])
+            continue
+        if fecha_futura(registro.fecha or fix.fecha or ahora, ahora):
+            resultados.append(models.ResultadoRegistroLote(indice=indice, aceptado=False, detalle=MOTIVO_FUTURO))
+            contar_rechazo("lote", MOTIVO_FUTURO)
+            continue
+
+        filas.append({
+            "fecha": registro.fecha or fix.fecha or ahora,
+            "latitud": fix.latitud,
+            "longitud": fix.longitud,
+            "altitud": fix.altitud,
+            "velocidad": fix.velocidad,
+            "dispositivo_id": dispositivo.id,
+        })
+        usuarios[dispositivo.id] = dispositivo.usuario_id
+        resultados.append(models.ResultadoRegistroLote(indice=indice, aceptado=True))
+
+    duplicados = await marcar_duplicados(filas, "lote")
+    if any(duplicados):
+        for resultado, duplicado in zip([resultado for resultado in resultados if resultado.aceptado], duplicados):
+            if duplicado:
+                resultado.aceptado = False
+                resultado.detalle = MOTIVO_DUPLICADO
+        filas = [fila for fila, duplicado in zip(filas, duplicados) if not duplicado]
+
+    if filas:
+        ids = await guardar_registros(db, filas, usuarios, "lote")
+        if ids is None:
+            response.status_code = 202
+        else:
+            aceptados = (resultado for resultado in resultados if resultado.aceptado)
+            for resultado, nuevo_id in zip(aceptados, ids):
+                resultado.id = nuevo_id
+
+    return resultados
+
+
+# Ingesta binaria (protocolo_binario.py) para trackers con datos móviles: ~12 bytes por fix frente a ~90 en JSON
+async def ingerir_tramas(db: AsyncSession, tramas: list, canal: str) -> tuple:
+    """ Valida y guarda los fixes de las tramas por el mismo camino que crear_registro; devuelve (aceptados, rechazados) """
+    dispositivos = await resolver_dispositivos(db, [trama.mac for trama in tramas])
+    filas = []
+    indices = []
+    usuarios = {}
+    rechazados = []
+    # Cada petición o datagrama es un envío por dispositivo: dispositivo_id -> sin fichas
+    esperas = await filtro_ingesta.permitir_envios({dispositivo.id for dispositivo in dispositivos.values() if dispositivo})
+    limitados = {dispositivo_id: espera > 0 for dispositivo_id, espera in esperas.items()}
+    indice = 0
+    ahora = datetime.datetime.utcnow()
+    for trama in tramas:
+        dispositivo = dispositivos.get(trama.mac)
+        for fix in trama.fixes:
+            if dispositivo is None:
+                rechazados.append(models.ResultadoRegistroLote(indice=indice, aceptado=False, detalle="Dispositivo no encontrado"))
+                contar_rechazo(canal, "Dispositivo no encontrado")
+            elif limitados[dispositivo.id]:
+                rechazados.append(models.ResultadoRegistroLote(indice=indice, aceptado=False, detalle=MOTIVO_LIMITE))
+                contar_rechazo(canal, MOTIVO_LIMITE)
+            elif fix is None:
+                rechazados.append(models.ResultadoRegistroLote(indice=indice, aceptado=False, detalle=gnss.MOTIVO_RANGO))
+                contar_rechazo(canal, gnss.MOTIVO_RANGO)
+            elif fecha_futura(fix.fecha or ahora, ahora):
+                rechazados.append(models.ResultadoRegistroLote(indice=indice, aceptado=False, detalle=MOTIVO_FUTURO))
+                contar_rechazo(canal, MOTIVO_FUTURO)
+            else:
+                filas.append({
+                    "fecha": fix.fecha or ahora,
+                    "latitud": fix.latitud,
+                    "longitud": fix.longitud,
+                    "altitud": fix.altitud,
+                    "velocidad": fix.velocidad,
+                    "dispositivo_id": dispositivo.id,
+                })
+                indices.append(indice)
+                usuarios[dispositivo.id] = dispositivo.usuario_id
+            indice += 1
+    duplicados = await marcar_duplicados(filas, canal)
+    if any(duplicados):
+        rechazados.extend(
+            models.ResultadoRegistroLote(indice=indice, aceptado=False, detalle=MOTIVO_DUPLICADO)
+            for indice, duplicado in zip(indices, duplicados) if duplicado
+        )
+        rechazados.sort(key=lambda resultado: resultado.indice)
+        filas = [fila for fila, duplicado in zip(filas, duplicados) if not duplicado]
+    if filas:
+        await guardar_registros(db, filas, usuarios, canal)
+    return len(filas), rechazados
+
+
+# Lo que ocupan MAX_REGISTROS_LOTE fixes en el peor caso: una trama por fix, con altitud y velocidad
+MAX_BYTES_BINARIO = MAX_REGISTROS_LOTE * (protocolo_binario.CABECERA.size + protocolo_binario.FIX_EXTENDIDO.size)
+
+
+async def leer_cuerpo(request: Request, max_bytes: int) -> bytearray:
+    """ Cuerpo de la petición; 413 en cuanto pasa de `max_bytes`, sin leer el resto """
+    longitud = request.headers.get("content-length", "")
+    if longitud.isdigit() and int(longitud) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Máximo {max_bytes} bytes por petición")
+    # Content-Length puede faltar (chunked) o mentir: se cuenta también lo leído
+    cuerpo = bytearray()
+    async for trozo in request.stream():
+        cuerpo += trozo
+        if len(cuerpo) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Máximo {max_bytes} bytes por petición")
+    return cuerpo
+
+
+@app.post(ruta_inicial + "registros/binario", response_model=models.ResultadoBinario)
+async def crear_registros_binario(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """ Cuerpo application/octet-stream con una o varias tramas seguidas """
+    cuerpo = await leer_cuerpo(request, MAX_BYTES_BINARIO)
+    try:
+        tramas = protocolo_binario.decodificar(cuerpo)
+    except protocolo_binario.ErrorTrama as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if sum(len(trama.fixes) for trama in tramas) > MAX_REGISTROS_LOTE:
+        raise HTTPException(status_code=413, detail=f"Máximo {MAX_REGISTROS_LOTE} registros por petición")
+    aceptados, rechazados = await ingerir_tramas(db, tramas, "binario")
+    return models.ResultadoBinario(aceptados=aceptados, rechazados=rechazados)
+
+
+async def procesar_datagrama(tramas: list) -> tuple:
+    if sum(len(trama.fixes) for trama in tramas) > MAX_REGISTROS_LOTE:
+        return 0, sum(len(trama.fixes) for trama in tramas)
+    async with AsyncSessionLocal() as db:
+        try:
+            aceptados, rechazados = await ingerir_tramas(db, tramas, "udp")
+        except HTTPException:
+            # Buffer de ingesta lleno: sin acuse, el tracker reintentará
+            raise ingesta.ColaLlena()
+    return aceptados, len(rechazados)
+
+protocolo_udp = protocolo_binario.ProtocoloUDP(procesar_datagrama)
+
+
+'''--------------------- GEOCERCAS ---------------------'''
+
+def geocerca_indexable(geocerca: GeocercaDB) -> geocercas.Geocerca:
+    return geocercas.Geocerca(
+        id=geocerca.id,
+        tipo=geocerca.tipo,
+        dispositivo_id=geocerca.dispositivo_id,
+        usuario_id=geocerca.usuario_id,
+        latitud=geocerca.latitud,
+        longitud=geocerca.longitud,
+        radio=geocerca.radio,
+        vertices=tuple(tuple(vertice) for vertice in geocerca.vertices or ()),
+    )
+
+
+def cargar_geocercas():
+    """ Carga las geocercas activas y fija el estado inicial de cada dispositivo con su última posición """
+    with SessionLocal() as db:
+        indice_geocercas.cargar(
+            geocerca_indexable(geocerca) for geocerca in db.query(GeocercaDB).filter(GeocercaDB.activa.is_(True))
+        )
+        posiciones = db.query(UltimaPosicionDB, DispositivoDB.usuario_id).join(
+            DispositivoDB, DispositivoDB.id == UltimaPosicionDB.dispositivo_id
+        )
+        for posicion, usuario_id in posiciones:
+            indice_geocercas.evaluar(posicion.dispositivo_id, usuario_id, posicion.latitud, posicion.longitud, posicion.fecha)
+    logger.info("Geocercas cargadas: %s", indice_geocercas.estadisticas())
+
+
+def cargar_posiciones():
+    """ Última posición de cada dispositivo, de ultimas_posiciones, para las consultas de proximidad """
+    with SessionLocal() as db:
+        indice_posiciones.cargar(db.query(
+            UltimaPosicionDB.dispositivo_id, DispositivoDB.usuario_id,
+            UltimaPosicionDB.latitud, UltimaPosicionDB.longitud, UltimaPosicionDB.fecha,
+        ).join(DispositivoDB, DispositivoDB.id == UltimaPosicionDB.dispositivo_id))
+    logger.info("Posiciones cargadas: %s", indice_posiciones.estadisticas())
+
+
+def ids_geocercas_de(db: Session, dispositivos: list, usuario_id: Optional[int] = None) -> list:
+    """ Geocercas que se borrarán en cascada con estos dispositivos (y usuario) """
+    condicion = GeocercaDB.dispositivo_id.in_(dispositivos)
+    if usuario_id is not None:
+        condicion = condicion | (GeocercaDB.usuario_id == usuario_id)
+    return [geocerca_id for (geocerca_id,) in db.query(GeocercaDB.id).filter(condicion)]
+
+
+def validar_forma(tipo: str, latitud, longitud, radio, vertices):
+    if tipo == geocercas.TIPO_CIRCULO:
+        if latitud is None or longitud is None or radio is None:
+            raise HTTPException(status_code=400, detail="Un círculo necesita latitud, longitud y radio")
+        if not gnss.coordenadas_validas(latitud, longitud) or radio <= 0:
+            raise HTTPException(status_code=400, detail="Centro o radio inválidos")
+    elif tipo == geocercas.TIPO_POLIGONO:
+        if not vertices or len(vertices) < 3 or any(len(vertice) != 2 for vertice in vertices):
+            raise HTTPException(status_code=400, detail="Un polígono necesita al menos 3 vértices [lat, lon]")
+        if not all(gnss.coordenadas_validas(lat, lon) for lat, lon in vertices):
+            raise HTTPException(status_code=400, detail="Vértices fuera de rango")
+    else:
+        raise HTTPException(status_code=400, detail="Tipo de geocerca inválido (circulo o poligono)")
+
+
+def reindexar_geocerca(geocerca: GeocercaDB):
+    if not geocerca.activa:
+        desindexar_geocerca(geocerca.id)
+        return
+    indexable = geocerca_indexable(geocerca)
+    indice_geocercas.guardar(indexable)
+    estado_compartido.publicar(CANAL_GEOCERCAS, {"accion": "guardar", "geocerca": dataclasses.asdict(indexable)})
+
+
+def desindexar_geocerca(geocerca_id: int):
+    indice_geocercas.eliminar(geocerca_id)
+    estado_compartido.publicar(CANAL_GEOCERCAS, {"accion": "eliminar", "id": geocerca_id})
+
+
+def olvidar_dispositivo(dispositivo_id: int):
+    """ Estado de geocercas y última posición en memoria de un dispositivo borrado """
+    indice_geocercas.olvidar_dispositivo(dispositivo_id)
+    indice_posiciones.olvidar(dispositivo_id)
+    estado_compartido.publicar(CANAL_GEOCERCAS, {"accion": "olvidar_dispositivo", "id": dispositivo_id})
+
+
+def aplicar_cambio_geocercas(mensaje: dict):
+    if mensaje["accion"] == "guardar":
+        datos = mensaje["geocerca"]
+        indice_geocercas.guardar(geocercas.Geocerca(
+            **{**datos, "vertices": tuple(tuple(vertice) for vertice in datos["vertices"])}
+        ))
+    elif mensaje["accion"] == "eliminar":
+        indice_geocercas.eliminar(mensaje["id"])
+    elif mensaje["accion"] == "olvidar_dispositivo":
+        indice_geocercas.olvidar_dispositivo(mensaje["id"])
+        indice_posiciones.olvidar(mensaje["id"])
+
+
+@app.get(ruta_inicial + "geocercas", response_model=List[models.MostrarGeocerca])
+def obtener_geocercas(
+    response: Response,
+    limite: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    cursor: Optional[str] = None,
+    dispositivo_id: Optional[int] = None,
+    usuario_id: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    query = db.query(GeocercaDB)
+    if dispositivo_id is not None:
+        query = query.filter(GeocercaDB.dispositivo_id == dispositivo_id)
+    if usuario_id is not None:
+        query = query.filter(GeocercaDB.usuario_id == usuario_id)
+    return serializacion.respuesta_modelos(
+        models.LISTA_GEOCERCAS, paginar(query, [GeocercaDB.id], cursor, limite, response), response
+    )
+
+@app.post(ruta_inicial + "geocercas", response_model=models.MostrarGeocerca)
+def crear_geocerca(geocerca: models.CrearGeocerca, db: Session = Depends(get_db), current_user: models.Principal = Depends(get_current_user)):
+    if (geocerca.dispositivo_id is None) == (geocerca.usuario_id is None):
+        raise HTTPException(status_code=400, detail="Indica dispositivo_id o usuario_id (solo uno)")
+    validar_forma(geocerca.tipo, geocerca.latitud, geocerca.longitud, geocerca.radio, geocerca.vertices)
+    if geocerca.dispositivo_id is not None and db.get(DispositivoDB, geocerca.dispositivo_id) is None:
+        raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
+    if geocerca.usuario_id is not None and db.get(UsuarioDB, geocerca.usuario_id) is None:
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+
+    es_circulo = geocerca.tipo == geocercas.TIPO_CIRCULO
+    nueva_geocerca = GeocercaDB(
+        nombre=geocerca.nombre,
+        tipo=geocerca.tipo,
+        latitud=geocerca.latitud if es_circulo else None,
+        longitud=geocerca.longitud if es_circulo else None,
+        radio=geocerca.radio if es_circulo else None,
+        vertices_json=None if es_circulo else json.dumps(geocerca.vertices),
+        dispositivo_id=geocerca.dispositivo_id,
+        usuario_id=geocerca.usuario_id,
+        activa=geocerca.activa,
     )
+    db.add(nueva_geocerca)
+    db.commit()
+    db.refresh(nueva_geocerca)
+    reindexar_geocerca(nueva_geocerca)
+    return nueva_geocerca
+
+@app.get(ruta_inicial + "geocercas/{geocerca_id}", response_model=models.MostrarGeocerca)
+def obtener_geocerca(geocerca_id: int, db: Session = Depends(get_db), current_user: models.Principal = Depends(get_current_user)):
+    geocerca = db.get(GeocercaDB, geocerca_id)
+    if not geocerca:
+        raise HTTPException(status_code=404, detail="Geocerca no encontrada")
+    return geocerca
+
+@app.patch(ruta_inicial + "geocercas/{geocerca_id}", response_model=models.MostrarGeocerca)
+def actualizar_geocerca(geocerca_id: int, datos: models.ActualizarGeocerca, db: Session = Depends(get_db), current_user: models.Principal = Depends(get_current_user)):
+    geocerca = db.get(GeocercaDB, geocerca_id)
+    if not geocerca:
+        raise HTTPException(status_code=404, detail="Geocerca no encontrada")
+
+    latitud = datos.latitud if datos.latitud is not None else geocerca.latitud
+    longitud = datos.longitud if datos.longitud is not None else geocerca.longitud
+    radio = datos.radio if datos.radio is not None else geocerca.radio
+    vertices = datos.vertices if datos.vertices is not None else geocerca.vertices
+    validar_forma(geocerca.tipo, latitud, longitud, radio, vertices)
+
+    if geocerca.tipo == geocercas.TIPO_CIRCULO:
+        geocerca.latitud, geocerca.longitud, geocerca.radio = latitud, longitud, radio
+    else:
+        geocerca.vertices_json = json.dumps(vertices)
+    if datos.nombre is not None:
+        geocerca.nombre = datos.nombre
+    if datos.activa is not None:
+        geocerca.activa = datos.activa
 
-    db.add(nuevo_registro)
     db.commit()
-    db.refresh(nuevo_registro)
-    return nuevo_registro
+    db.refresh(geocerca)
+    reindexar_geocerca(geocerca)
+    return geocerca
+
+@app.delete(ruta_inicial + "geocercas/{geocerca_id}")
+def eliminar_geocerca(geocerca_id: int, db: Session = Depends(get_db), current_user: models.Principal = Depends(get_current_user)):
+    geocerca = db.get(GeocercaDB, geocerca_id)
+    if not geocerca:
+        raise HTTPException(status_code=404, detail="Geocerca no encontrada")
+    db.delete(geocerca)
+    db.commit()
+    desindexar_geocerca(geocerca_id)
+    return {"message": "Geocerca eliminada"}
+
+@app.get(ruta_inicial + "geocercas/{geocerca_id}/eventos", response_model=List[models.EventoGeocerca])
+def obtener_eventos_geocerca(
+    geocerca_id: int,
+    response: Response,
+    limite: int = Query(LIMITE_POR_DEFECTO, ge=1, le=LIMITE_MAXIMO),
+    cursor: Optional[str] = None,
+    dispositivo_id: Optional[int] = None,
+    desde: Optional[datetime.datetime] = None,
+    hasta: Optional[datetime.datetime] = None,
+    db: Session = Depends(get_db),
+    current_user: models.Principal = Depends(get_current_user),
+):
+    """ Entradas y salidas registradas, paginadas por (fecha, id) """
+    query = db.query(EventoGeocercaDB).filter(EventoGeocercaDB.geocerca_id == geocerca_id)
+    if dispositivo_id is not None:
+        query = query.filter(EventoGeocercaDB.dispositivo_id == dispositivo_id)
+    if desde is not None:
+        query = query.filter(EventoGeocercaDB.fecha >= desde)
+    if hasta is not None:
+        query = query.filter(EventoGeocercaDB.fecha < hasta)
+    return serializacion.respuesta_modelos(
+        models.LISTA_EVENTOS_GEOCERCA,
+        paginar(query, [EventoGeocercaDB.fecha, EventoGeocercaDB.id], cursor, limite, response),
+        response,
+    )
 
+
+'''--------------------- TIEMPO REAL ---------------------'''
+
+@app.websocket(ruta_inicial + "ws/posiciones")
+async def posiciones_en_vivo(websocket: WebSocket, token: str, dispositivos: Optional[str] = None):
+    """
+    Envía cada posición nueva de los dispositivos suscritos. El token JWT va en el parámetro `token`
+    (los navegadores no permiten cabeceras en WebSocket) y `dispositivos` es una lista de ids separada por comas;
+    sin ella se suscribe a todos los dispositivos del usuario
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            principal = await principal_desde_token(token, db)
+        except HTTPException:
+            await websocket.close(code=1008)
+            return
+        propios = set((await db.execute(select(DispositivoDB.id).where(DispositivoDB.usuario_id == principal.id))).scalars())
+
+    try:
+        pedidos = {int(valor) for valor in dispositivos.split(",") if valor.strip()} if dispositivos else propios
+    except ValueError:
+        await websocket.close(code=1003)
+        return
+    # Solo root y admin pueden seguir dispositivos de otros usuarios
+    if principal.rol not in ("root", "admin"):
+        pedidos &= propios
+
+    await websocket.accept()
+    suscripcion = difusor.suscribir(pedidos)
+
+    async def enviar():
+        while True:
+            await websocket.send_json(await suscripcion.cola.get())
+
+    async def recibir():
+        # Solo para detectar la desconexión del cliente
+        while True:
+            await websocket.receive_text()
+
+    tareas = [asyncio.create_task(enviar()), asyncio.create_task(recibir())]
+    try:
+        await asyncio.wait(tareas, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        difusor.cancelar(suscripcion)
+        for tarea in tareas:
+            tarea.cancel()
+        # Recoge la desconexión (WebSocketDisconnect) y las cancelaciones sin propagarlas
+        await asyncio.gather(*tareas, return_exceptions=True)
@@ -0,0 +1,118 @@
+import logging
+import sys
+from sqlalchemy import text
+from database import engine, esperar_bbdd_sync, inicializar_bbdd, UltimaPosicionDB, ResumenHorarioDB
+import particiones
+
+TAMANO_LOTE = 5000
+
+
+def _parsear_coordenadas(coordenadas):
+    try:
+        latitud, longitud = (float(parte) for parte in coordenadas.split(","))
+        return latitud, longitud
+    except (ValueError, AttributeError):
+        return None
+
+
+def migrar_coordenadas(tamano_lote: int = TAMANO_LOTE, eliminar_columna: bool = False):
+    """ Pasa registros.coordenadas ("lat,lon") a las columnas numéricas latitud/longitud """
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE registros ADD COLUMN IF NOT EXISTS latitud DOUBLE PRECISION"))
+        conn.execute(text("ALTER TABLE registros ADD COLUMN IF NOT EXISTS longitud DOUBLE PRECISION"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_registros_lat_lon ON registros (latitud, longitud)"))
+        tiene_coordenadas = conn.execute(text(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = 'registros' AND column_name = 'coordenadas'"
+        )).first() is not None
+
+    if not tiene_coordenadas:
+        print("La columna coordenadas ya no existe. Nada que rellenar.")
+        return
+
+    # Relleno por lotes: cada lote es una transacción corta
+    ultimo_id = 0
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            filas = conn.execute(text(
+                "SELECT id, coordenadas FROM registros "
+                "WHERE id > :ultimo_id AND latitud IS NULL AND coordenadas IS NOT NULL "
+                "ORDER BY id LIMIT :limite"
+            ), {"ultimo_id": ultimo_id, "limite": tamano_lote}).all()
+            if not filas:
+                break
+            ultimo_id = filas[-1].id
+
+            valores = []
+            for fila in filas:
+                coordenadas = _parsear_coordenadas(fila.coordenadas)
+                if coordenadas is None:
+                    print(f"Registro {fila.id} con coordenadas inválidas: {fila.coordenadas!r}")
+                    continue
+                valores.append({"id": fila.id, "latitud": coordenadas[0], "longitud": coordenadas[1]})
+
+            if valores:
+                conn.execute(text("UPDATE registros SET latitud = :latitud, longitud = :longitud WHERE id = :id"), valores)
+            total += len(valores)
+        print(f"Rellenados {total} registros (hasta id {ultimo_id})")
+
+    if eliminar_columna:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE registros DROP COLUMN coordenadas"))
+        print("Columna coordenadas eliminada.")
+
+
+def crear_indices_paginacion():
+    """ Índices para la paginación por (fecha, id) y el filtrado por dispositivo y rango de fechas """
+    with engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_registros_dispositivo_fecha ON registros (dispositivo_id, fecha)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_registros_fecha_id ON registros (fecha, id)"))
+
+
+def crear_columnas_gnss():
+    """ Altitud y velocidad extraídas de las líneas +CGPSINFO """
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE registros ADD COLUMN IF NOT EXISTS altitud DOUBLE PRECISION"))
+        conn.execute(text("ALTER TABLE registros ADD COLUMN IF NOT EXISTS velocidad DOUBLE PRECISION"))
+
+
+def rellenar_ultimas_posiciones():
+    """ Crea ultimas_posiciones y la rellena con el fix más reciente de cada dispositivo """
+    UltimaPosicionDB.__table__.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO ultimas_posiciones "
+            "(dispositivo_id, registro_id, fecha, latitud, longitud, altitud, velocidad, actualizado) "
+            "SELECT DISTINCT ON (dispositivo_id) dispositivo_id, id, fecha, latitud, longitud, altitud, velocidad, now() "
+            "FROM registros WHERE latitud IS NOT NULL AND dispositivo_id IS NOT NULL "
+            "ORDER BY dispositivo_id, fecha DESC, id DESC "
+            "ON CONFLICT (dispositivo_id) DO NOTHING"
+        ))
+
+
+def particionar_registros():
+    """ Crea resumen_horario y pasa registros a particiones mensuales (salvo con --sin-particionar) """
+    ResumenHorarioDB.__table__.create(bind=engine, checkfirst=True)
+    # En una instalación nueva registros está vacía y el cambio es inmediato; en una con datos copia por lotes
+    if "--sin-particionar" not in sys.argv:
+        particiones.particionar_registros(engine)
+
+
+def main():
+    # Los módulos compartidos con la API (particiones, database) informan por logging
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    esperar_bbdd_sync()
+    inicializar_bbdd()
+    if engine.dialect.name != "postgresql":
+        # Una BBDD nueva ya tiene el esquema actual; lo siguiente adapta instalaciones Postgres antiguas
+        return
+    migrar_coordenadas(eliminar_columna="--eliminar-coordenadas" in sys.argv)
+    crear_indices_paginacion()
+    crear_columnas_gnss()
+    rellenar_ultimas_posiciones()
+    particionar_registros()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, TypeAdapter, field_validator
 from uuid import UUID, uuid4
-from datetime import datetime
-from typing import Optional
+from datetime import datetime, timezone
+from typing import List, Optional
 
       
 
@@ -17,15 +17,13 @@ class MostrarToken(BaseModel):
     token_type: str
     role: str
     usuario_id: int
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 """ ------- ROL ------- """
 class Rol(BaseModel):
     id: Optional[int] = None
     nombre: str 
-    class Config:
-        orm_mode = True   
+    model_config = ConfigDict(from_attributes=True)
 
 """ ------- USUARIOS ------- """
 class UsuarioLoginWithUsername(BaseModel):
@@ -42,29 +40,31 @@ class Usuario(BaseModel):
     password: str
     email: Optional[str] = None
     rol_id: int = 3
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class UsuarioCreacion(BaseModel):
     username: str
     password: str
     email: Optional[str] = None
     rol_id: int = 3
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class UsuarioCambioContrasena(BaseModel):
     nueva_contrasena: str  
-    class Config:
-        orm_mode = True  
+    model_config = ConfigDict(from_attributes=True)
+
+class Principal(BaseModel):
+    """ Usuario autenticado tal y como lo ven los endpoints protegidos """
+    id: int
+    username: str
+    rol: str
 
 class MostrarUsuario(BaseModel):
     id: Optional[int] = None
     username: str
     email: Optional[str] = None
     rol: Rol  
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 """ ------- DISPOSITIVOS ------- """
 class Dispositivo(BaseModel):
@@ -73,8 +73,7 @@ class Dispositivo(BaseModel):
     nombre: Optional[str] = None
     active: Optional[bool] = None
     usuario_id: Optional[int] = None
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class MostrarDispositivo(BaseModel):
     id: Optional[int] = None
@@ -82,31 +81,27 @@ class MostrarDispositivo(BaseModel):
     nombre: Optional[str] = None
     active: Optional[bool] = None
     usuario: MostrarUsuario
-    class Config:
-        orm_mode = True      
+    model_config = ConfigDict(from_attributes=True)
 
 class MostrarDispositivoSinUsuario(BaseModel):
     id: Optional[int] = None
     mac: Optional[str] = None
     nombre: Optional[str] = None
     active: Optional[bool] = None
-    class Config:
-        orm_mode = True        
+    model_config = ConfigDict(from_attributes=True)
 
 class CrearDispositivo(BaseModel):
     mac: str
     nombre: str
     active: Optional[bool] = None
-    class Config:
-        orm_mode = True          
+    model_config = ConfigDict(from_attributes=True)
 
 class ActualizarDispositivo(BaseModel):
     mac: Optional[str] = None
     nombre: Optional[str] = None
     active: Optional[bool] = None
     usuario_id: Optional[int] = None
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 """ ------- REGISTRO ------- """
@@ -115,20 +110,113 @@ class Registro(BaseModel):
     fecha: Optional[datetime] = None
     coordenadas: str
     dispositivo_id: int
-    class Config:
-        orm_mode = True 
+    model_config = ConfigDict(from_attributes=True)
 
 class MostrarRegistro(BaseModel):
     id: Optional[int] = None
     fecha: Optional[datetime] = None
-    coordenadas: str
+    coordenadas: Optional[str] = None
+    altitud: Optional[float] = None
+    velocidad: Optional[float] = None
     dispositivo: Dispositivo 
-    class Config:
-        orm_mode = True  
+    model_config = ConfigDict(from_attributes=True)
+
+class PosicionActual(BaseModel):
+    dispositivo_id: int
+    registro_id: Optional[int] = None
+    fecha: Optional[datetime] = None
+    coordenadas: str
+    latitud: float
+    longitud: float
+    altitud: Optional[float] = None
+    velocidad: Optional[float] = None
+    actualizado: datetime
+    model_config = ConfigDict(from_attributes=True)
+
+class DispositivoCercano(BaseModel):
+    dispositivo_id: int
+    distancia: float  # metros
+    latitud: float
+    longitud: float
+    fecha: Optional[datetime] = None
+    model_config = ConfigDict(from_attributes=True)
 
 class CrearRegistro(BaseModel):
     fecha: Optional[datetime] = None
     coordenadas: str
     mac: str
-    class Config:
-        orm_mode = True       
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+
+    @field_validator("fecha")
+    @classmethod
+    def fecha_utc(cls, fecha: Optional[datetime]) -> Optional[datetime]:
+        """ Las fechas con zona ("...Z", "+02:00") pasan a UTC sin zona, como las de la BBDD y los fixes GNSS """
+        if fecha is not None and fecha.tzinfo is not None:
+            fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+        return fecha
+
+class ResultadoRegistroLote(BaseModel):
+    indice: int
+    aceptado: bool
+    id: Optional[int] = None
+    detalle: Optional[str] = None
+
+
+""" ------- GEOCERCAS ------- """
+class CrearGeocerca(BaseModel):
+    nombre: str
+    tipo: str  # "circulo" | "poligono"
+    latitud: Optional[float] = None
+    longitud: Optional[float] = None
+    radio: Optional[float] = None  # metros
+    vertices: Optional[List[List[float]]] = None  # [[lat, lon], ...]
+    dispositivo_id: Optional[int] = None
+    usuario_id: Optional[int] = None
+    activa: bool = True
+
+class ActualizarGeocerca(BaseModel):
+    nombre: Optional[str] = None
+    latitud: Optional[float] = None
+    longitud: Optional[float] = None
+    radio: Optional[float] = None
+    vertices: Optional[List[List[float]]] = None
+    activa: Optional[bool] = None
+
+class MostrarGeocerca(BaseModel):
+    id: int
+    nombre: str
+    tipo: str
+    latitud: Optional[float] = None
+    longitud: Optional[float] = None
+    radio: Optional[float] = None
+    vertices: Optional[List[List[float]]] = None
+    dispositivo_id: Optional[int] = None
+    usuario_id: Optional[int] = None
+    activa: bool
+    model_config = ConfigDict(from_attributes=True)
+
+class EventoGeocerca(BaseModel):
+    id: int
+    geocerca_id: int
+    dispositivo_id: int
+    registro_id: Optional[int] = None
+    tipo: str
+    fecha: datetime
+    latitud: float
+    longitud: float
+    model_config = ConfigDict(from_attributes=True)
+
+class ResultadoBinario(BaseModel):
+    aceptados: int
+    rechazados: List[ResultadoRegistroLote]
+
+
+""" ------- LISTAS ------- """
+# Adaptadores construidos una vez al importar: las listas grandes se validan y se serializan a bytes
+# directamente con pydantic-core (ver serializacion.py) en lugar de pasar por la ruta genérica de FastAPI
+LISTA_USUARIOS = TypeAdapter(List[MostrarUsuario])
+LISTA_DISPOSITIVOS = TypeAdapter(List[MostrarDispositivo])
+LISTA_DISPOSITIVOS_SIN_USUARIO = TypeAdapter(List[MostrarDispositivoSinUsuario])
+LISTA_POSICIONES = TypeAdapter(List[PosicionActual])
+LISTA_GEOCERCAS = TypeAdapter(List[MostrarGeocerca])
+LISTA_EVENTOS_GEOCERCA = TypeAdapter(List[EventoGeocerca])
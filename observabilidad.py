@@ -0,0 +1,180 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Métricas en formato Prometheus (GET /metrics) y configuración de logs.
+# Los buckets de BBDD y pool son más finos que los HTTP: una consulta típica tarda menos de un milisegundo.
+BUCKETS_BBDD = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+BUCKETS_BCRYPT = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Con varios workers (servidor.py) cada proceso escribe sus métricas en este directorio y /metrics las suma
+MULTIPROCESO = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+PETICIONES_SEGUNDOS = Histogram(
+    "http_peticion_segundos", "Latencia de las peticiones HTTP por ruta", ["metodo", "ruta"],
+)
+PETICIONES = Counter(
+    "http_peticiones_total", "Peticiones HTTP por ruta y código de respuesta", ["metodo", "ruta", "codigo"],
+)
+CONSULTAS_SEGUNDOS = Histogram(
+    "bbdd_consulta_segundos", "Duración de las sentencias SQL", ["engine", "operacion"], buckets=BUCKETS_BBDD,
+)
+CONSULTAS_ERRORES = Counter("bbdd_consulta_errores_total", "Sentencias SQL que fallaron", ["engine"])
+ESPERA_POOL = Histogram(
+    "bbdd_pool_espera_segundos", "Espera para obtener una conexión del pool", ["engine"], buckets=BUCKETS_BBDD,
+)
+BCRYPT_SEGUNDOS = Histogram(
+    "bcrypt_segundos", "Duración de bcrypt incluida la espera por un proceso libre", ["operacion"],
+    buckets=BUCKETS_BCRYPT,
+)
+REGISTROS_ACEPTADOS = Counter("registros_aceptados_total", "Fixes aceptados por canal de ingesta", ["canal"])
+REGISTROS_RECHAZADOS = Counter(
+    "registros_rechazados_total", "Fixes rechazados por canal de ingesta y motivo", ["canal", "motivo"],
+)
+INGESTA_EN_COLA = Gauge("ingesta_en_cola", "Filas pendientes en el buffer de ingesta", multiprocess_mode="livesum")
+
+OPERACIONES_SQL = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+RUTA_DESCONOCIDA = "sin_ruta"  # 404 y similares: no se usa la ruta real para no disparar la cardinalidad
+
+
+def exportar() -> tuple:
+    """ Cuerpo y content type de la respuesta de /metrics """
+    if MULTIPROCESO:
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+        return generate_latest(registro), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def cerrar_proceso():
+    """ Al parar un worker sus gauges "livesum" dejan de contar """
+    if MULTIPROCESO:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class MiddlewareMetricas:
+    """
+    Middleware ASGI puro (sin BaseHTTPMiddleware, que añade una tarea por petición).
+    La etiqueta es la plantilla de la ruta ("/api/v2.2/dispositivos/{dispositivo_id}"), no la URL
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        codigo = 500
+
+        async def enviar(mensaje):
+            nonlocal codigo
+            if mensaje["type"] == "http.response.start":
+                codigo = mensaje["status"]
+            await send(mensaje)
+
+        inicio = time.perf_counter()
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            duracion = time.perf_counter() - inicio
+            ruta = scope.get("route")
+            plantilla = getattr(ruta, "path", RUTA_DESCONOCIDA)
+            PETICIONES_SEGUNDOS.labels(scope["method"], plantilla).observe(duracion)
+            PETICIONES.labels(scope["method"], plantilla, str(codigo)).inc()
+
+
+def _operacion(sentencia: str) -> str:
+    palabra = sentencia.lstrip()[:6].upper()
+    return palabra if palabra in OPERACIONES_SQL else "OTRA"
+
+
+def instrumentar_engine(engine, nombre: str):
+    """ Mide cada sentencia con los eventos de cursor; para un AsyncEngine se pasa su sync_engine """
+
+    def antes(conn, cursor, sentencia, parametros, contexto, executemany):
+        conn.info.setdefault("inicio_consulta", []).append(time.perf_counter())
+
+    def despues(conn, cursor, sentencia, parametros, contexto, executemany):
+        inicio = conn.info["inicio_consulta"].pop()
+        CONSULTAS_SEGUNDOS.labels(nombre, _operacion(sentencia)).observe(time.perf_counter() - inicio)
+
+    def error(contexto):
+        CONSULTAS_ERRORES.labels(nombre).inc()
+        pila = contexto.connection.info.get("inicio_consulta") if contexto.connection is not None else None
+        if pila:
+            pila.pop()
+
+    event.listen(engine, "before_cursor_execute", antes)
+    event.listen(engine, "after_cursor_execute", despues)
+    event.listen(engine, "handle_error", error)
+
+
+class _EsperaMedida:
+    """ No hay evento de "inicio de checkout": se mide envolviendo el _do_get del pool """
+    nombre_engine = "sync"
+
+    def _do_get(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            ESPERA_POOL.labels(self.nombre_engine).observe(time.perf_counter() - inicio)
+
+
+# Con el espacio de nombres de SQLAlchemy sus logs siguen el nivel del logger "sqlalchemy" (WARNING por defecto)
+class QueuePoolMedido(_EsperaMedida, QueuePool):
+    nombre_engine = "sync"
+    _sqla_logger_namespace = "sqlalchemy.pool.impl.QueuePool"
+
+
+class AsyncQueuePoolMedido(_EsperaMedida, AsyncAdaptedQueuePool):
+    nombre_engine = "async"
+    _sqla_logger_namespace = "sqlalchemy.pool.impl.AsyncAdaptedQueuePool"
+
+
+class FormatoJSON(logging.Formatter):
+    def format(self, registro: logging.LogRecord) -> str:
+        salida = {
+            "fecha": self.formatTime(registro),
+            "nivel": registro.levelname,
+            "logger": registro.name,
+            "mensaje": registro.getMessage(),
+        }
+        if registro.exc_info:
+            salida["excepcion"] = self.formatException(registro.exc_info)
+        return json.dumps(salida, ensure_ascii=False)
+
+
+_escuchador = None
+
+
+def configurar_logging():
+    """
+    LOG_LEVEL (INFO por defecto) y LOG_FORMATO ("texto" o "json"). La escritura a stdout la hace un hilo
+    aparte (QueueHandler + QueueListener): en el event loop un log solo cuesta encolar el registro
+    """
+    global _escuchador
+    if _escuchador is not None:
+        return
+    salida = logging.StreamHandler()
+    if os.getenv("LOG_FORMATO", "texto") == "json":
+        salida.setFormatter(FormatoJSON())
+    else:
+        salida.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    cola = queue.SimpleQueue()
+    raiz = logging.getLogger()
+    raiz.handlers = [logging.handlers.QueueHandler(cola)]
+    raiz.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    _escuchador = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    _escuchador.start()
+    atexit.register(_escuchador.stop)
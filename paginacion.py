@@ -0,0 +1,62 @@
+import base64
+import datetime
+import json
+from typing import Optional
+from fastapi import HTTPException, Response
+from sqlalchemy import tuple_
+
+LIMITE_POR_DEFECTO = 100
+LIMITE_MAXIMO = 1000
+CABECERA_CURSOR = "X-Siguiente-Cursor"
+
+
+def codificar_cursor(valores) -> str:
+    """ Cursor opaco con los valores de las columnas de orden de la última fila """
+    serializables = [valor.isoformat() if isinstance(valor, datetime.datetime) else valor for valor in valores]
+    return base64.urlsafe_b64encode(json.dumps(serializables).encode()).decode()
+
+
+def decodificar_cursor(cursor: str, columnas) -> list:
+    try:
+        valores = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(valores) != len(columnas):
+            raise ValueError("Número de valores incorrecto")
+        return [
+            datetime.datetime.fromisoformat(valor) if columna.type.python_type is datetime.datetime else valor
+            for columna, valor in zip(columnas, valores)
+        ]
+    except (ValueError, TypeError, NotImplementedError):
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+
+def paginar(query, columnas, cursor: str, limite: int, response: Response) -> list:
+    """
+    Paginación por clave (keyset) sobre las columnas dadas, en orden ascendente.
+    Si quedan más filas, el cursor de la siguiente página va en la cabecera X-Siguiente-Cursor.
+    """
+    if cursor:
+        query = query.filter(tuple_(*columnas) > tuple_(*decodificar_cursor(cursor, columnas)))
+
+    filas = query.order_by(*columnas).limit(limite + 1).all()
+    if len(filas) > limite:
+        filas = filas[:limite]
+        ultima = filas[-1]
+        response.headers[CABECERA_CURSOR] = codificar_cursor([getattr(ultima, columna.key) for columna in columnas])
+    return filas
+
+
+def recorrer(query, columnas, desde: Optional[list], tamano: int):
+    """
+    Todas las filas a partir de `desde` (valores de un cursor ya decodificado) en páginas de `tamano` por clave.
+    Cada página es una consulta corta: no queda un cursor de servidor abierto mientras el cliente lee
+    """
+    while True:
+        pagina = query
+        if desde is not None:
+            pagina = pagina.filter(tuple_(*columnas) > tuple_(*desde))
+        filas = pagina.order_by(*columnas).limit(tamano).all()
+        if filas:
+            yield filas
+        if len(filas) < tamano:
+            return
+        desde = [getattr(filas[-1], columna.key) for columna in columnas]
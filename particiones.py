@@ -0,0 +1,267 @@
+import asyncio
+import datetime
+import logging
+import os
+import re
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+RETENCION_MESES = int(os.getenv("RETENCION_MESES", "0"))  # 0 = se conserva todo
+MESES_ADELANTE = int(os.getenv("PARTICIONES_MESES_ADELANTE", "2"))
+INTERVALO_MANTENIMIENTO = float(os.getenv("MANTENIMIENTO_INTERVALO", "3600"))
+TAMANO_LOTE = 10000
+CLAVE_BLOQUEO = 723001  # pg_advisory_lock: un solo pod hace el mantenimiento a la vez
+
+# registros se particiona por mes (registros_pAAAA_MM) más una partición por defecto para fechas fuera de rango.
+# Al caducar un mes su detalle se resume por dispositivo y hora en resumen_horario y la partición se
+# elimina con DROP TABLE en lugar de borrar fila a fila.
+
+PATRON_PARTICION = re.compile(r"^registros_p(\d{4})_(\d{2})$")
+
+RESUMEN = """
+INSERT INTO resumen_horario (dispositivo_id, hora, num_registros, latitud_media, longitud_media,
+                             latitud_min, latitud_max, longitud_min, longitud_max, velocidad_max)
+SELECT dispositivo_id, {hora}, count(*), avg(latitud), avg(longitud),
+       min(latitud), max(latitud), min(longitud), max(longitud), max(velocidad)
+FROM {tabla}
+WHERE dispositivo_id IS NOT NULL AND latitud IS NOT NULL {condicion}
+GROUP BY 1, 2
+ON CONFLICT (dispositivo_id, hora) DO UPDATE SET
+    latitud_media = (resumen_horario.latitud_media * resumen_horario.num_registros
+                     + excluded.latitud_media * excluded.num_registros)
+                    / (resumen_horario.num_registros + excluded.num_registros),
+    longitud_media = (resumen_horario.longitud_media * resumen_horario.num_registros
+                      + excluded.longitud_media * excluded.num_registros)
+                     / (resumen_horario.num_registros + excluded.num_registros),
+    num_registros = resumen_horario.num_registros + excluded.num_registros,
+    latitud_min = {minimo}(resumen_horario.latitud_min, excluded.latitud_min),
+    latitud_max = {maximo}(resumen_horario.latitud_max, excluded.latitud_max),
+    longitud_min = {minimo}(resumen_horario.longitud_min, excluded.longitud_min),
+    longitud_max = {maximo}(resumen_horario.longitud_max, excluded.longitud_max),
+    velocidad_max = {maximo}(resumen_horario.velocidad_max, excluded.velocidad_max)
+"""
+
+
+def resumir(conn, tabla: str, limite=None, hasta_id=None):
+    """ Acumula en resumen_horario el detalle de `tabla` (anterior a `limite` y con id <= `hasta_id`, si se indican) """
+    if conn.dialect.name == "postgresql":
+        funciones = {"hora": "date_trunc('hour', fecha)", "minimo": "least", "maximo": "greatest"}
+    else:
+        funciones = {"hora": "strftime('%Y-%m-%d %H:00:00.000000', fecha)", "minimo": "min", "maximo": "max"}
+    condicion = "AND fecha < :limite" if limite is not None else ""
+    if hasta_id is not None:
+        condicion += " AND id <= :hasta_id"
+    conn.execute(
+        text(RESUMEN.format(tabla=tabla, condicion=condicion, **funciones)), {"limite": limite, "hasta_id": hasta_id}
+    )
+
+
+def inicio_mes(fecha: datetime.datetime, desplazamiento: int = 0) -> datetime.datetime:
+    indice = fecha.year * 12 + fecha.month - 1 + desplazamiento
+    return datetime.datetime(indice // 12, indice % 12 + 1, 1)
+
+
+def nombre_particion(mes: datetime.datetime) -> str:
+    return f"registros_p{mes.year:04d}_{mes.month:02d}"
+
+
+def es_particionada(conn, tabla: str = "registros") -> bool:
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :tabla"
+    ), {"tabla": tabla}).first() is not None
+
+
+def crear_particion(conn, mes: datetime.datetime, padre: str = "registros"):
+    """
+    Partición de `mes`. Postgres no la crea si la partición por defecto ya tiene filas de ese mes (fechas
+    adelantadas): esas filas se sacan antes y se vuelven a insertar en la nueva, en la misma transacción
+    """
+    nombre = nombre_particion(mes)
+    if conn.execute(text("SELECT to_regclass(:nombre)"), {"nombre": nombre}).scalar() is not None:
+        return
+    por_defecto = f"{padre}_default"
+    rango = {"desde": mes, "hasta": inicio_mes(mes, 1)}
+    mover = conn.execute(text("SELECT to_regclass(:nombre)"), {"nombre": por_defecto}).scalar() is not None
+    if mover:
+        conn.execute(text(f"LOCK TABLE {por_defecto} IN SHARE ROW EXCLUSIVE MODE"))
+        mover = conn.execute(text(
+            f"SELECT 1 FROM {por_defecto} WHERE fecha >= :desde AND fecha < :hasta LIMIT 1"
+        ), rango).first() is not None
+    if mover:
+        conn.execute(text(f"CREATE TEMP TABLE particion_movidas (LIKE {por_defecto})"))
+        conn.execute(text(
+            f"WITH movidas AS (DELETE FROM {por_defecto} WHERE fecha >= :desde AND fecha < :hasta RETURNING *) "
+            "INSERT INTO particion_movidas SELECT * FROM movidas"
+        ), rango)
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {nombre} PARTITION OF {padre} "
+        f"FOR VALUES FROM ('{mes.isoformat()}') TO ('{inicio_mes(mes, 1).isoformat()}')"
+    ))
+    if mover:
+        conn.execute(text(f"INSERT INTO {padre} SELECT * FROM particion_movidas"))
+        conn.execute(text("DROP TABLE particion_movidas"))
+        logger.warning("Filas de %s pasadas de %s a %s", mes.strftime("%Y-%m"), por_defecto, nombre)
+
+
+def asegurar_particiones(conn, meses_adelante: int = MESES_ADELANTE):
+    """ Particiones del mes actual y de los `meses_adelante` siguientes """
+    actual = inicio_mes(datetime.datetime.utcnow())
+    for desplazamiento in range(meses_adelante + 1):
+        crear_particion(conn, inicio_mes(actual, desplazamiento))
+
+
+def particiones_existentes(conn) -> list:
+    nombres = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'registros'"
+    )).scalars()
+    meses = []
+    for nombre in nombres:
+        coincidencia = PATRON_PARTICION.match(nombre)
+        if coincidencia:
+            meses.append(datetime.datetime(int(coincidencia.group(1)), int(coincidencia.group(2)), 1))
+    return sorted(meses)
+
+
+def aplicar_retencion_particiones(conn, limite: datetime.datetime) -> list:
+    """ Resume y elimina las particiones que terminan antes de `limite`; devuelve sus nombres """
+    eliminadas = []
+    for mes in particiones_existentes(conn):
+        if inicio_mes(mes, 1) > limite:
+            break
+        nombre = nombre_particion(mes)
+        resumir(conn, nombre)
+        conn.execute(text(f"ALTER TABLE registros DETACH PARTITION {nombre}"))
+        conn.execute(text(f"DROP TABLE {nombre}"))
+        conn.commit()
+        eliminadas.append(nombre)
+
+    # Lo que cayó en la partición por defecto se trata con DELETE: debería ser poco
+    if conn.execute(text("SELECT to_regclass('registros_default')")).scalar() is not None:
+        resumir(conn, "registros_default", limite)
+        conn.execute(text("DELETE FROM registros_default WHERE fecha < :limite"), {"limite": limite})
+    conn.commit()
+    return eliminadas
+
+
+def aplicar_retencion_sin_particiones(conn, limite: datetime.datetime) -> int:
+    """
+    Alternativa para tablas sin particionar (o SQLite): resumen y DELETE por lotes de ids. Cada lote se resume
+    y se borra en la misma transacción, así un corte a medias no lo cuenta dos veces en resumen_horario
+    """
+    total = 0
+    while True:
+        hasta_id = conn.execute(text(
+            "SELECT max(id) FROM (SELECT id FROM registros WHERE fecha < :limite ORDER BY id LIMIT :lote) t"
+        ), {"limite": limite, "lote": TAMANO_LOTE}).scalar()
+        if hasta_id is None:
+            conn.commit()
+            return total
+        resumir(conn, "registros", limite, hasta_id)
+        total += conn.execute(text(
+            "DELETE FROM registros WHERE fecha < :limite AND id <= :hasta_id"
+        ), {"limite": limite, "hasta_id": hasta_id}).rowcount
+        conn.commit()
+
+
+def mantenimiento(engine, retencion_meses: int = RETENCION_MESES):
+    """ Crea las particiones futuras y aplica la retención. Pensado para ejecutarse periódicamente """
+    limite = inicio_mes(datetime.datetime.utcnow(), -retencion_meses) if retencion_meses > 0 else None
+    with engine.connect() as conn:
+        if conn.dialect.name != "postgresql":
+            if limite is not None:
+                aplicar_retencion_sin_particiones(conn, limite)
+            return
+
+        bloqueado = conn.execute(text("SELECT pg_try_advisory_lock(:clave)"), {"clave": CLAVE_BLOQUEO}).scalar()
+        conn.commit()
+        if not bloqueado:
+            return
+        try:
+            if es_particionada(conn):
+                asegurar_particiones(conn)
+                conn.commit()
+                if limite is not None:
+                    eliminadas = aplicar_retencion_particiones(conn, limite)
+                    if eliminadas:
+                        logger.info("Particiones eliminadas por retención: %s", ", ".join(eliminadas))
+            elif limite is not None:
+                aplicar_retencion_sin_particiones(conn, limite)
+        finally:
+            conn.rollback()
+            conn.execute(text("SELECT pg_advisory_unlock(:clave)"), {"clave": CLAVE_BLOQUEO})
+            conn.commit()
+
+
+async def bucle_mantenimiento(engine, intervalo: float = INTERVALO_MANTENIMIENTO):
+    while True:
+        try:
+            await asyncio.to_thread(mantenimiento, engine)
+        except Exception as e:
+            logger.error("Error en el mantenimiento de registros: %s", e)
+        await asyncio.sleep(intervalo)
+
+
+def particionar_registros(engine, tamano_lote: int = TAMANO_LOTE):
+    """
+    Convierte `registros` en una tabla particionada por mes copiando los datos por lotes.
+    El cambio final de tablas se hace bajo LOCK, copiando antes lo que haya llegado durante la copia
+    """
+    with engine.begin() as conn:
+        if es_particionada(conn):
+            logger.info("registros ya está particionada.")
+            return
+        conn.execute(text("UPDATE registros SET fecha = now() AT TIME ZONE 'utc' WHERE fecha IS NULL"))
+        conn.execute(text("DROP TABLE IF EXISTS registros_nueva CASCADE"))
+        conn.execute(text("CREATE TABLE registros_nueva (LIKE registros INCLUDING DEFAULTS) PARTITION BY RANGE (fecha)"))
+        conn.execute(text("ALTER TABLE registros_nueva ALTER COLUMN fecha SET NOT NULL"))
+        conn.execute(text("ALTER TABLE registros_nueva ADD CONSTRAINT registros_nueva_pkey PRIMARY KEY (id, fecha)"))
+        conn.execute(text("CREATE INDEX ix_registros_nueva_lat_lon ON registros_nueva (latitud, longitud)"))
+        conn.execute(text("CREATE INDEX ix_registros_nueva_dispositivo_fecha ON registros_nueva (dispositivo_id, fecha)"))
+        conn.execute(text("CREATE INDEX ix_registros_nueva_fecha_id ON registros_nueva (fecha, id)"))
+        conn.execute(text("CREATE TABLE registros_nueva_default PARTITION OF registros_nueva DEFAULT"))
+
+        primera = conn.execute(text("SELECT min(fecha) FROM registros")).scalar() or datetime.datetime.utcnow()
+        mes = inicio_mes(primera)
+        ultimo = inicio_mes(datetime.datetime.utcnow(), MESES_ADELANTE)
+        while mes <= ultimo:
+            crear_particion(conn, mes, padre="registros_nueva")
+            mes = inicio_mes(mes, 1)
+        columnas = ", ".join(conn.execute(text(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = 'registros' ORDER BY ordinal_position"
+        )).scalars())
+
+    ultimo_id = 0
+    while True:
+        with engine.begin() as conn:
+            hasta = conn.execute(text(
+                "SELECT max(id) FROM (SELECT id FROM registros WHERE id > :ultimo_id ORDER BY id LIMIT :lote) t"
+            ), {"ultimo_id": ultimo_id, "lote": tamano_lote}).scalar()
+            if hasta is None:
+                break
+            conn.execute(text(
+                f"INSERT INTO registros_nueva ({columnas}) SELECT {columnas} FROM registros WHERE id > :desde AND id <= :hasta"
+            ), {"desde": ultimo_id, "hasta": hasta})
+        ultimo_id = hasta
+        logger.info("Copiados registros hasta id %s", ultimo_id)
+
+    with engine.begin() as conn:
+        conn.execute(text("LOCK TABLE registros IN EXCLUSIVE MODE"))
+        conn.execute(text(
+            f"INSERT INTO registros_nueva ({columnas}) SELECT {columnas} FROM registros WHERE id > :desde"
+        ), {"desde": ultimo_id})
+        conn.execute(text("ALTER SEQUENCE registros_id_seq OWNED BY NONE"))
+        conn.execute(text("DROP TABLE registros"))
+        conn.execute(text("ALTER TABLE registros_nueva RENAME TO registros"))
+        conn.execute(text("ALTER TABLE registros_nueva_default RENAME TO registros_default"))
+        conn.execute(text("ALTER SEQUENCE registros_id_seq OWNED BY registros.id"))
+        conn.execute(text("ALTER INDEX registros_nueva_pkey RENAME TO registros_pkey"))
+        for sufijo in ("lat_lon", "dispositivo_fecha", "fecha_id"):
+            conn.execute(text(f"ALTER INDEX ix_registros_nueva_{sufijo} RENAME TO ix_registros_{sufijo}"))
+        conn.execute(text(
+            "ALTER TABLE registros ADD CONSTRAINT registros_dispositivo_id_fkey "
+            "FOREIGN KEY (dispositivo_id) REFERENCES dispositivos (id) ON DELETE CASCADE"
+        ))
+    logger.info("registros particionada por mes.")
@@ -0,0 +1,165 @@
+import asyncio
+import datetime
+import logging
+import struct
+from typing import Awaitable, Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+import gnss
+
+logger = logging.getLogger(__name__)
+
+# Trama (little endian):
+#   cabecera  "GF" | versión u8 | flags u8 | MAC 6 bytes | número de fixes u16           -> 12 bytes
+#   fix       latitud i32 | longitud i32 (grados * 1e7) | segundos Unix u32 (0 = hora del servidor)   -> 12 bytes
+#   + si FLAG_EXTENDIDO: altitud i16 (m) | velocidad u16 (km/h * 10, 0xFFFF = sin dato)               -> 16 bytes
+# Varias tramas pueden ir seguidas en el mismo cuerpo HTTP o datagrama.
+MAGIA = b"GF"
+VERSION = 1
+FLAG_EXTENDIDO = 0x01
+ESCALA = 1e7
+SIN_VELOCIDAD = 0xFFFF
+SIN_ALTITUD = -0x8000
+
+CABECERA = struct.Struct("<2sBB6sH")
+FIX = struct.Struct("<iiI")
+FIX_EXTENDIDO = struct.Struct("<iiIhH")
+
+# Respuesta UDP: "GA" | aceptados u16 | rechazados u16
+ACUSE = struct.Struct("<2sHH")
+MAGIA_ACUSE = b"GA"
+
+
+class ErrorTrama(ValueError):
+    pass
+
+
+class Trama(NamedTuple):
+    mac: str
+    fixes: List[Optional[gnss.Fix]]  # None si el fix no es válido
+
+
+def mac_texto(mac: bytes) -> str:
+    return ":".join(f"{byte:02X}" for byte in mac)
+
+
+def _fix(latitud_e7: int, longitud_e7: int, segundos: int, altitud: Optional[int] = None,
+         velocidad: Optional[int] = None) -> Optional[gnss.Fix]:
+    latitud = latitud_e7 / ESCALA
+    longitud = longitud_e7 / ESCALA
+    if not gnss.coordenadas_validas(latitud, longitud):
+        return None
+    return gnss.Fix(
+        latitud=latitud,
+        longitud=longitud,
+        fecha=datetime.datetime.utcfromtimestamp(segundos) if segundos else None,
+        altitud=None if altitud is None or altitud == SIN_ALTITUD else float(altitud),
+        velocidad=None if velocidad is None or velocidad == SIN_VELOCIDAD else velocidad / 10,
+    )
+
+
+def iterar_tramas(datos) -> Iterator[Trama]:
+    """
+    Decodifica una o varias tramas seguidas. Trabaja sobre un memoryview: los fixes se leen con
+    struct.iter_unpack sobre cortes del buffer original, sin copiarlo
+    """
+    vista = memoryview(datos)
+    desplazamiento = 0
+    while desplazamiento < len(vista):
+        if len(vista) - desplazamiento < CABECERA.size:
+            raise ErrorTrama("Cabecera incompleta")
+        magia, version, flags, mac, num_fixes = CABECERA.unpack_from(vista, desplazamiento)
+        if magia != MAGIA:
+            raise ErrorTrama("Marca de trama incorrecta")
+        if version != VERSION:
+            raise ErrorTrama(f"Versión de trama no soportada: {version}")
+        desplazamiento += CABECERA.size
+
+        formato = FIX_EXTENDIDO if flags & FLAG_EXTENDIDO else FIX
+        fin = desplazamiento + num_fixes * formato.size
+        if fin > len(vista):
+            raise ErrorTrama("Trama truncada")
+        fixes = [_fix(*valores) for valores in formato.iter_unpack(vista[desplazamiento:fin])]
+        desplazamiento = fin
+        yield Trama(mac_texto(mac), fixes)
+
+
+def decodificar(datos) -> List[Trama]:
+    return list(iterar_tramas(datos))
+
+
+def codificar_trama(mac: str, fixes, extendido: bool = False) -> bytes:
+    """ Codifica [(latitud, longitud, fecha | None[, altitud, velocidad km/h])]; lo usan los clientes y las pruebas """
+    mac_bytes = bytes.fromhex(mac.replace(":", "").replace("-", ""))
+    if len(mac_bytes) != 6:
+        raise ErrorTrama("MAC inválida")
+    formato = FIX_EXTENDIDO if extendido else FIX
+    salida = bytearray(CABECERA.size + len(fixes) * formato.size)
+    CABECERA.pack_into(salida, 0, MAGIA, VERSION, FLAG_EXTENDIDO if extendido else 0, mac_bytes, len(fixes))
+    desplazamiento = CABECERA.size
+    for fix in fixes:
+        latitud, longitud, fecha = fix[0], fix[1], fix[2]
+        segundos = int(fecha.replace(tzinfo=datetime.timezone.utc).timestamp()) if fecha else 0
+        valores = [round(latitud * ESCALA), round(longitud * ESCALA), segundos]
+        if extendido:
+            altitud = fix[3] if len(fix) > 3 else None
+            velocidad = fix[4] if len(fix) > 4 else None
+            valores.append(SIN_ALTITUD if altitud is None else int(round(altitud)))
+            valores.append(SIN_VELOCIDAD if velocidad is None else min(int(round(velocidad * 10)), SIN_VELOCIDAD - 1))
+        formato.pack_into(salida, desplazamiento, *valores)
+        desplazamiento += formato.size
+    return bytes(salida)
+
+
+class ProtocoloUDP(asyncio.DatagramProtocol):
+    """
+    Recibe tramas por UDP y las pasa a `procesar(tramas) -> (aceptados, rechazados)`.
+    Cada datagrama se contesta con un acuse de 6 bytes; si hay demasiados en curso se descarta sin acuse
+    y el tracker reintenta
+    """
+
+    def __init__(self, procesar: Callable[[List[Trama]], Awaitable[Tuple[int, int]]], max_pendientes: int = 256):
+        self.procesar = procesar
+        self.max_pendientes = max_pendientes
+        self.transporte = None
+        self._pendientes = set()
+        self.recibidos = 0
+        self.descartados = 0
+        self.invalidos = 0
+
+    def connection_made(self, transport):
+        self.transporte = transport
+
+    def datagram_received(self, datos: bytes, direccion):
+        self.recibidos += 1
+        if len(self._pendientes) >= self.max_pendientes:
+            self.descartados += 1
+            return
+        try:
+            tramas = decodificar(datos)
+        except ErrorTrama:
+            self.invalidos += 1
+            return
+        tarea = asyncio.get_running_loop().create_task(self._atender(tramas, direccion))
+        self._pendientes.add(tarea)
+        tarea.add_done_callback(self._pendientes.discard)
+
+    async def _atender(self, tramas: List[Trama], direccion):
+        try:
+            aceptados, rechazados = await self.procesar(tramas)
+        except Exception as e:
+            logger.warning("Error al procesar datagrama: %s", e)
+            return
+        if self.transporte is not None:
+            self.transporte.sendto(ACUSE.pack(MAGIA_ACUSE, min(aceptados, 0xFFFF), min(rechazados, 0xFFFF)), direccion)
+
+    async def esperar_pendientes(self):
+        if self._pendientes:
+            await asyncio.gather(*self._pendientes, return_exceptions=True)
+
+    def estadisticas(self) -> dict:
+        return {
+            "recibidos": self.recibidos,
+            "descartados": self.descartados,
+            "invalidos": self.invalidos,
+            "en_curso": len(self._pendientes),
+        }
@@ -0,0 +1,186 @@
+import datetime
+import itertools
+import math
+import threading
+from collections import defaultdict
+from typing import Optional
+
+import numpy as np
+
+from geocercas import METROS_POR_GRADO, RADIO_TIERRA_M
+
+SIN_USUARIO = -1
+
+
+def distancias_m(latitud: float, longitud: float, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+    """ Haversine en metros de un punto a muchos, de una vez """
+    phi1 = math.radians(latitud)
+    phi2 = np.radians(latitudes)
+    dphi = phi2 - phi1
+    dlambda = np.radians(longitudes - longitud)
+    a = np.sin(dphi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 2 * RADIO_TIERRA_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class IndicePosiciones:
+    """
+    Última posición de cada dispositivo en memoria para consultas de proximidad. Las coordenadas viven en arrays
+    de NumPy (un hueco por dispositivo) y una rejilla de celdas de `celda` grados guarda qué huecos hay en cada
+    celda. Una consulta junta los huecos de las celdas que cubren el círculo y calcula el haversine de todos ellos
+    de golpe. Si el círculo cubre más de `max_celdas` celdas, cruza el antimeridiano o sus celdas tienen más de
+    una cuarta parte de los dispositivos, se filtran todos los huecos por la caja envolvente en su lugar.
+    """
+
+    def __init__(self, celda: float = 0.01, max_celdas: int = 2500, capacidad: int = 1024):
+        self.celda = celda
+        self.max_celdas = max_celdas
+        self._latitudes = np.zeros(capacidad)
+        self._longitudes = np.zeros(capacidad)
+        self._usuarios = np.full(capacidad, SIN_USUARIO, dtype=np.int64)
+        self._ids = np.full(capacidad, -1, dtype=np.int64)  # -1 = hueco libre
+        self._fechas = [None] * capacidad
+        self._claves = [None] * capacidad
+        self._huecos = {}  # dispositivo_id -> hueco
+        self._libres = []
+        self._ocupados = 0  # huecos usados alguna vez, desde el principio de los arrays
+        self._celdas = defaultdict(set)
+        self._lock = threading.Lock()
+        self.consultas = 0
+        self.candidatos = 0
+
+    def _clave(self, latitud: float, longitud: float) -> tuple:
+        return math.floor(latitud / self.celda), math.floor(longitud / self.celda)
+
+    def _crecer(self):
+        capacidad = len(self._ids) * 2
+        for nombre, relleno in (("_latitudes", 0.0), ("_longitudes", 0.0), ("_usuarios", SIN_USUARIO), ("_ids", -1)):
+            anterior = getattr(self, nombre)
+            nuevo = np.full(capacidad, relleno, dtype=anterior.dtype)
+            nuevo[:len(anterior)] = anterior
+            setattr(self, nombre, nuevo)
+        self._fechas.extend([None] * (capacidad - len(self._fechas)))
+        self._claves.extend([None] * (capacidad - len(self._claves)))
+
+    def _nuevo_hueco(self) -> int:
+        if self._libres:
+            return self._libres.pop()
+        if self._ocupados == len(self._ids):
+            self._crecer()
+        self._ocupados += 1
+        return self._ocupados - 1
+
+    def actualizar(self, dispositivo_id: int, usuario_id: Optional[int], latitud: float, longitud: float,
+                   fecha: datetime.datetime):
+        """ Un fix más antiguo que la posición guardada no la pisa (como en ultimas_posiciones) """
+        with self._lock:
+            hueco = self._huecos.get(dispositivo_id)
+            if hueco is None:
+                hueco = self._huecos[dispositivo_id] = self._nuevo_hueco()
+                self._ids[hueco] = dispositivo_id
+            elif fecha < self._fechas[hueco]:
+                return
+            clave = self._clave(latitud, longitud)
+            if clave != self._claves[hueco]:
+                self._sacar_de_celda(hueco)
+                self._celdas[clave].add(hueco)
+                self._claves[hueco] = clave
+            self._latitudes[hueco] = latitud
+            self._longitudes[hueco] = longitud
+            self._usuarios[hueco] = SIN_USUARIO if usuario_id is None else usuario_id
+            self._fechas[hueco] = fecha
+
+    def _sacar_de_celda(self, hueco: int):
+        clave = self._claves[hueco]
+        if clave is None:
+            return
+        huecos = self._celdas[clave]
+        huecos.discard(hueco)
+        if not huecos:
+            del self._celdas[clave]
+
+    def olvidar(self, dispositivo_id: int):
+        with self._lock:
+            hueco = self._huecos.pop(dispositivo_id, None)
+            if hueco is None:
+                return
+            self._sacar_de_celda(hueco)
+            self._claves[hueco] = None
+            self._fechas[hueco] = None
+            self._ids[hueco] = -1
+            self._usuarios[hueco] = SIN_USUARIO
+            self._libres.append(hueco)
+
+    def cargar(self, posiciones):
+        """ `posiciones` produce (dispositivo_id, usuario_id, latitud, longitud, fecha) """
+        for posicion in posiciones:
+            self.actualizar(*posicion)
+
+    def posiciones(self, dispositivo_ids) -> list:
+        """ [(dispositivo_id, usuario_id, latitud, longitud, fecha)] para sincronizar otros procesos """
+        with self._lock:
+            return [
+                (
+                    dispositivo_id,
+                    None if self._usuarios[hueco] == SIN_USUARIO else int(self._usuarios[hueco]),
+                    float(self._latitudes[hueco]),
+                    float(self._longitudes[hueco]),
+                    self._fechas[hueco],
+                )
+                for dispositivo_id in dispositivo_ids
+                if (hueco := self._huecos.get(dispositivo_id)) is not None
+            ]
+
+    def _candidatos(self, latitud: float, longitud: float, radio: float) -> np.ndarray:
+        margen_lat = radio / METROS_POR_GRADO
+        coseno = math.cos(math.radians(min(abs(latitud) + margen_lat, 90.0)))
+        margen_lon = margen_lat / coseno if coseno > 1e-6 else 360.0
+        cruza = longitud - margen_lon < -180 or longitud + margen_lon > 180
+        i_min, j_min = self._clave(latitud - margen_lat, longitud - margen_lon)
+        i_max, j_max = self._clave(latitud + margen_lat, longitud + margen_lon)
+        if not cruza and (i_max - i_min + 1) * (j_max - j_min + 1) <= self.max_celdas:
+            celdas = [
+                huecos for i in range(i_min, i_max + 1) for j in range(j_min, j_max + 1)
+                if (huecos := self._celdas.get((i, j)))
+            ]
+            total = sum(len(huecos) for huecos in celdas)
+            if total * 4 < len(self._huecos):
+                return np.fromiter(itertools.chain.from_iterable(celdas), dtype=np.int64, count=total)
+        # Con muchos candidatos sale más barato filtrar todos los huecos por la caja con NumPy
+        latitudes = self._latitudes[:self._ocupados]
+        mascara = (self._ids[:self._ocupados] >= 0) & (np.abs(latitudes - latitud) <= margen_lat)
+        if not cruza:
+            mascara &= np.abs(self._longitudes[:self._ocupados] - longitud) <= margen_lon
+        return np.flatnonzero(mascara)
+
+    def cercanos(self, latitud: float, longitud: float, radio: float, usuario_id: Optional[int] = None,
+                 limite: Optional[int] = None) -> list:
+        """ [(dispositivo_id, distancia en metros, latitud, longitud, fecha)] a `radio` metros o menos, del más cercano al más lejano """
+        with self._lock:
+            huecos = self._candidatos(latitud, longitud, radio)
+            self.consultas += 1
+            self.candidatos += len(huecos)
+            if usuario_id is not None:
+                huecos = huecos[self._usuarios[huecos] == usuario_id]
+            latitudes = self._latitudes[huecos]
+            longitudes = self._longitudes[huecos]
+            distancias = distancias_m(latitud, longitud, latitudes, longitudes)
+            dentro = np.flatnonzero(distancias <= radio)
+            if limite is not None and len(dentro) > limite:
+                # Solo se ordenan los `limite` más cercanos
+                dentro = dentro[np.argpartition(distancias[dentro], limite - 1)[:limite]]
+            orden = dentro[np.argsort(distancias[dentro], kind="stable")]
+            return [
+                (int(self._ids[huecos[k]]), float(distancias[k]), float(latitudes[k]), float(longitudes[k]),
+                 self._fechas[huecos[k]])
+                for k in orden
+            ]
+
+    def estadisticas(self) -> dict:
+        with self._lock:
+            return {
+                "dispositivos": len(self._huecos),
+                "celdas": len(self._celdas),
+                "capacidad": len(self._ids),
+                "consultas": self.consultas,
+                "candidatos_por_consulta": self.candidatos / self.consultas if self.consultas else 0.0,
+            }
@@ -0,0 +1,57 @@
+import orjson
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import TypeAdapter
+
+# Respuestas de listas sin la ruta genérica de FastAPI, que valida cada objeto ORM, lo convierte a dicts
+# (en otro viaje al threadpool si el endpoint es síncrono) y después lo codifica con json.dumps.
+# - respuesta_modelos: TypeAdapter precompilado (models.LISTA_*) que valida y escribe los bytes en pydantic-core.
+# - respuesta_json / respuesta_ndjson: filas ya construidas desde tuplas de columnas, codificadas con orjson.
+# El JSON es el mismo que con response_model; el response_model se mantiene para la documentación.
+TIPO_JSON = "application/json"
+TIPO_NDJSON = "application/x-ndjson"
+
+
+def _cabeceras(response: Response) -> dict:
+    """ Cabeceras fijadas en el Response inyectado (p. ej. el cursor de paginación) """
+    return dict(response.headers) if response is not None else {}
+
+
+def respuesta_modelos(adaptador: TypeAdapter, objetos, response: Response = None) -> Response:
+    contenido = adaptador.dump_json(adaptador.validate_python(objetos, from_attributes=True))
+    return Response(content=contenido, media_type=TIPO_JSON, headers=_cabeceras(response))
+
+
+def respuesta_json(contenido, response: Response = None) -> Response:
+    return Response(content=orjson.dumps(contenido), media_type=TIPO_JSON, headers=_cabeceras(response))
+
+
+def pide_ndjson(request: Request) -> bool:
+    return TIPO_NDJSON in request.headers.get("accept", "")
+
+
+def respuesta_ndjson(lotes) -> StreamingResponse:
+    """ `lotes` produce listas de dicts; cada lote se escribe de una vez, una fila JSON por línea """
+    def cuerpo():
+        for lote in lotes:
+            yield b"".join(orjson.dumps(fila, option=orjson.OPT_APPEND_NEWLINE) for fila in lote)
+    return StreamingResponse(cuerpo(), media_type=TIPO_NDJSON)
+
+
+def fila_registro(fila) -> dict:
+    """ Lo mismo que models.MostrarRegistro a partir de la tupla de main.COLUMNAS_REGISTRO """
+    id_, fecha, latitud, longitud, altitud, velocidad, dispositivo_id, mac, nombre, active, usuario_id = fila
+    return {
+        "id": id_,
+        "fecha": fecha,
+        "coordenadas": f"{latitud},{longitud}" if latitud is not None and longitud is not None else None,
+        "altitud": altitud,
+        "velocidad": velocidad,
+        "dispositivo": {
+            "id": dispositivo_id,
+            "mac": mac,
+            "nombre": nombre,
+            "active": active,
+            "usuario_id": usuario_id,
+        },
+    }
@@ -0,0 +1,71 @@
+import logging
+import math
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+logger = logging.getLogger("servidor")
+
+# Punto de entrada del contenedor: uvicorn con tantos workers como CPUs tenga asignadas el contenedor.
+# WEB_CONCURRENCY fija el número a mano. Sin ESTADO_COMPARTIDO_URL se fuerza un solo worker: las caches,
+# las geocercas y los WebSocket vivirían en cada proceso por separado y se desincronizarían.
+
+
+def cpus_disponibles() -> float:
+    """ Límite de CPU del cgroup (v2 y v1) o, si no hay, las CPUs en las que puede correr el proceso """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as fichero:
+            cuota, periodo = fichero.read().split()
+        if cuota != "max":
+            return min(cpus, int(cuota) / int(periodo))
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as cuota, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as periodo:
+                microsegundos = int(cuota.read())
+                if microsegundos > 0:
+                    return min(cpus, microsegundos / int(periodo.read()))
+        except (OSError, ValueError):
+            pass
+    return cpus
+
+
+def numero_workers() -> int:
+    if not os.getenv("ESTADO_COMPARTIDO_URL"):
+        if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+            logger.warning("WEB_CONCURRENCY ignorado: sin ESTADO_COMPARTIDO_URL solo se arranca un worker")
+        return 1
+    if os.getenv("WEB_CONCURRENCY"):
+        return max(1, int(os.environ["WEB_CONCURRENCY"]))
+    # Cada worker es un event loop con su pool de BBDD: uno por CPU (redondeando hacia arriba una cuota fraccionaria)
+    return max(1, math.ceil(cpus_disponibles()))
+
+
+def preparar_metricas(workers: int):
+    """ prometheus_client necesita un directorio común y vacío al arrancar para sumar las métricas de los workers """
+    if workers == 1:
+        os.environ.pop("PROMETHEUS_MULTIPROC_DIR", None)
+        return
+    directorio = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "metricas"))
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    workers = numero_workers()
+    preparar_metricas(workers)
+    logger.info("Arrancando %d worker(s)", workers)
+    uvicorn.run(
+        "main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=workers,
+        log_config=None,  # los logs los configura observabilidad.configurar_logging en cada worker
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import numpy as np
+
+RADIO_TIERRA_M = 6371008.8
+
+
+def proyectar(latitud: np.ndarray, longitud: np.ndarray):
+    """ Proyección equirectangular local a metros, suficiente para trayectos de un día """
+    lat0 = np.radians(np.mean(latitud)) if len(latitud) else 0.0
+    x = np.radians(longitud) * np.cos(lat0) * RADIO_TIERRA_M
+    y = np.radians(latitud) * RADIO_TIERRA_M
+    return x, y
+
+
+def douglas_peucker(latitud: np.ndarray, longitud: np.ndarray, tolerancia_m: float) -> np.ndarray:
+    """ Máscara de los puntos que se conservan; cada tramo calcula sus distancias de golpe con NumPy """
+    n = len(latitud)
+    conservar = np.zeros(n, dtype=bool)
+    if n <= 2:
+        conservar[:] = True
+        return conservar
+
+    x, y = proyectar(latitud, longitud)
+    conservar[0] = conservar[-1] = True
+    pila = [(0, n - 1)]
+    while pila:
+        inicio, fin = pila.pop()
+        if fin <= inicio + 1:
+            continue
+        dx = x[fin] - x[inicio]
+        dy = y[fin] - y[inicio]
+        px = x[inicio + 1:fin] - x[inicio]
+        py = y[inicio + 1:fin] - y[inicio]
+        norma = np.hypot(dx, dy)
+        if norma == 0:
+            distancias = np.hypot(px, py)
+        else:
+            distancias = np.abs(dy * px - dx * py) / norma
+        mayor = int(np.argmax(distancias))
+        if distancias[mayor] > tolerancia_m:
+            medio = inicio + 1 + mayor
+            conservar[medio] = True
+            pila.append((inicio, medio))
+            pila.append((medio, fin))
+    return conservar
+
+
+def submuestreo_temporal(segundos: np.ndarray, max_puntos: int) -> np.ndarray:
+    """ Índices de un punto por intervalo de tiempo (el primero de cada uno; del último, el último punto) """
+    n = len(segundos)
+    if n <= max_puntos:
+        return np.arange(n)
+    duracion = segundos[-1] - segundos[0]
+    if duracion <= 0:
+        return np.linspace(0, n - 1, max_puntos).astype(np.int64)
+    cubetas = np.floor((segundos - segundos[0]) / duracion * (max_puntos - 1)).astype(np.int64)
+    _, indices = np.unique(cubetas, return_index=True)
+    # Se sustituye en lugar de añadir: como mucho max_puntos índices
+    indices[-1] = n - 1
+    return indices
+
+
+def codificar_polilinea(latitud: np.ndarray, longitud: np.ndarray, precision: int = 5) -> str:
+    """ Encoded Polyline Algorithm Format (el de Google Maps, Leaflet, OSRM...) """
+    if len(latitud) == 0:
+        return ""
+    enteros = np.round(np.column_stack([latitud, longitud]) * 10 ** precision).astype(np.int64)
+    deltas = np.diff(enteros, axis=0, prepend=np.zeros((1, 2), dtype=np.int64)).ravel()
+    salida = []
+    for valor in deltas.tolist():
+        valor = ~(valor << 1) if valor < 0 else valor << 1
+        while valor >= 0x20:
+            salida.append(chr((0x20 | (valor & 0x1f)) + 63))
+            valor >>= 5
+        salida.append(chr(valor + 63))
+    return "".join(salida)
+
+
+def codificar_deltas(valores: np.ndarray) -> list:
+    """ Primer valor absoluto y después diferencias con el anterior """
+    if len(valores) == 0:
+        return []
+    return np.diff(valores, prepend=0).tolist()
@@ -0,0 +1,56 @@
+import asyncio
+from collections import defaultdict
+from typing import Iterable
+
+
+class Suscripcion:
+    def __init__(self, dispositivos: set, max_cola: int):
+        self.dispositivos = dispositivos
+        self.cola = asyncio.Queue(maxsize=max_cola)
+        self.descartados = 0
+
+
+class Difusor:
+    """
+    Pub/sub en proceso de posiciones por dispositivo.
+    Cada suscriptor tiene una cola acotada; si no da abasto se descartan sus mensajes más antiguos
+    para que un cliente lento nunca frene la ingesta.
+    """
+
+    def __init__(self, max_cola: int = 100):
+        self.max_cola = max_cola
+        self._por_dispositivo = defaultdict(set)
+        self.publicados = 0
+        self.descartados = 0
+
+    def suscribir(self, dispositivos: Iterable[int]) -> Suscripcion:
+        suscripcion = Suscripcion(set(dispositivos), self.max_cola)
+        for dispositivo_id in suscripcion.dispositivos:
+            self._por_dispositivo[dispositivo_id].add(suscripcion)
+        return suscripcion
+
+    def cancelar(self, suscripcion: Suscripcion):
+        for dispositivo_id in suscripcion.dispositivos:
+            suscriptores = self._por_dispositivo.get(dispositivo_id)
+            if suscriptores is not None:
+                suscriptores.discard(suscripcion)
+                if not suscriptores:
+                    del self._por_dispositivo[dispositivo_id]
+
+    def publicar(self, dispositivo_id: int, mensaje: dict):
+        """ Debe llamarse desde el event loop; nunca bloquea """
+        for suscripcion in self._por_dispositivo.get(dispositivo_id, ()):
+            if suscripcion.cola.full():
+                suscripcion.cola.get_nowait()
+                suscripcion.descartados += 1
+                self.descartados += 1
+            suscripcion.cola.put_nowait(mensaje)
+        self.publicados += 1
+
+    def estadisticas(self) -> dict:
+        return {
+            "suscripciones": len({s for subs in self._por_dispositivo.values() for s in subs}),
+            "dispositivos_con_suscriptores": len(self._por_dispositivo),
+            "publicados": self.publicados,
+            "descartados": self.descartados,
+        }